@@ -0,0 +1,22 @@
+# encoding: utf-8
+
+'''Docker "entrypoint" for Gunicorn with Uvicorn's ASGI workers.
+
+Set `SERVER_INTERFACE` to `asgi` to have `gunicorn.conf.py` use this instead of
+`entrypoint.py`. The async password reset views then wait on the directory on the
+event loop, and Wagtail's synchronous pages run in a thread pool.
+'''
+
+from django.core.asgi import get_asgi_application
+import os
+
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'jpl.edrn.biokey.policy.settings.ops')
+os.environ.setdefault('SECURE_COOKIES', 'True')
+os.environ.setdefault('STATIC_ROOT', '/app/static')
+os.environ.setdefault('MEDIA_ROOT', '/app/media')
+os.environ.setdefault('ASYNC_LDAP', 'True')
+
+application = get_asgi_application()  # noqa
+
+# The docker-compose context should provide the same env vars as for `entrypoint.py`.
@@ -1,6 +1,11 @@
 # flake8: noqa
+#
+# Gunicorn profile for BioKey. The defaults are Gunicorn's own; tune them for your hardware
+# with the environment variables below, after measuring with `django-admin biokey_serverbench`.
+# Nearly every request waits on LDAP far longer than it computes, so `gthread` with several
+# threads is the first thing to try.
 
-import multiprocessing
+import os
 
 wsgi_app = 'entrypoint:application'
 bind = ['0.0.0.0:8000']
@@ -9,10 +14,27 @@ daemon = False
 
 accesslog = '-'
 errorlog = '-'
-loglevel = 'debug'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'debug')
 
-# workers = multiprocessing.cpu_count() * 2 + 1
-# threads = 
-# worker_class = 'gevent'  # TODO: test this out
+# Worker class: sync, gthread, or anything else Gunicorn knows
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+
+# Processes, and threads per process for gthread
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+
+# Seconds to keep connections from the TLS front end open between requests
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '2'))
+
+# Seconds before a silent worker is killed and restarted
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+# With SERVER_INTERFACE=asgi, serve `asgi.py` with Uvicorn workers instead; threads don't apply
+if os.getenv('SERVER_INTERFACE', 'wsgi') == 'asgi':
+    wsgi_app = 'asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+elif worker_class == 'gthread':
+    # Let each thread keep its own pooled directory connection
+    os.environ.setdefault('LDAP_POOL_SIZE', str(threads))
 
 # TODO: syslog setttings?
@@ -0,0 +1,15 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey's Asynchronous Server Gateway Interface (ASGI).
+
+This module must—by contract—define a name `application` that represents the ASGI
+app. Async views run on the server's event loop; everything else, including Wagtail's
+pages, runs in a thread pool as usual.
+'''
+
+from django.core.asgi import get_asgi_application
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'jpl.edrn.biokey.policy.settings.ops')
+os.environ.setdefault('ASYNC_LDAP', 'True')
+application = get_asgi_application()  # noqa
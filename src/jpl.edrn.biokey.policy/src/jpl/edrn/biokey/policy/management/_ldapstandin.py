@@ -0,0 +1,291 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: a stand-in LDAP server for benchmarks.
+
+This speaks just enough LDAPv3 over plain TCP for BioKey's own traffic: simple binds (any
+password works), searches with equality, substring, presence, ordering, and boolean filters,
+adds, modifies, deletes, abandons, and the "Who am I?" extended operation. Entries live in
+memory. Every response is held back for `latency` seconds to simulate a distant directory;
+responses to different requests overlap rather than queue up, just like a real server's.
+
+Controls (such as paged results) are ignored, so every search comes back as a single page.
+The server runs its own event loop on a background thread so it can serve Gunicorn workers
+in other processes.
+'''
+
+import asyncio, datetime, logging, threading
+
+
+_logger = logging.getLogger(__name__)
+
+# Protocol operation tags (RFC 4511); APPLICATION class, constructed unless noted
+_bind_request, _bind_response       = 0x60, 0x61
+_unbind_request                     = 0x42  # primitive
+_search_request, _search_entry      = 0x63, 0x64
+_search_done                        = 0x65
+_modify_request, _modify_response   = 0x66, 0x67
+_add_request, _add_response         = 0x68, 0x69
+_delete_request, _delete_response   = 0x4a, 0x6b  # request is primitive
+_abandon_request                    = 0x50  # primitive
+_extended_request, _extended_response = 0x77, 0x78
+
+# What to answer each request with if it goes wrong
+_response_tags = {
+    _bind_request: _bind_response, _search_request: _search_done, _modify_request: _modify_response,
+    _add_request: _add_response, _delete_request: _delete_response, _extended_request: _extended_response,
+}
+
+# Result codes we use
+_success, _protocol_error, _no_such_object, _already_exists = 0, 2, 32, 68
+
+_whoami_oid = b'1.3.6.1.4.1.4203.1.11.3'
+
+
+# BER Encoding and Decoding
+# -------------------------
+
+def _encode_length(length: int) -> bytes:
+    if length < 0x80: return bytes([length])
+    octets = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(octets)]) + octets
+
+
+def _tlv(tag: int, value: bytes) -> bytes:
+    return bytes([tag]) + _encode_length(len(value)) + value
+
+
+def _integer(tag: int, value: int) -> bytes:
+    return _tlv(tag, value.to_bytes(max(1, (value.bit_length() + 8) // 8), 'big', signed=True))
+
+
+def _decode(data: bytes, pos: int = 0) -> tuple[int, bytes, int] | None:
+    '''Decode the TLV at `pos` in `data` into (tag, value, next position), or None if it's incomplete.'''
+    if len(data) < pos + 2: return None
+    tag, length, pos = data[pos], data[pos + 1], pos + 2
+    if length & 0x80:
+        count = length & 0x7f
+        if len(data) < pos + count: return None
+        length, pos = int.from_bytes(data[pos:pos + count], 'big'), pos + count
+    if len(data) < pos + length: return None
+    return tag, data[pos:pos + length], pos + length
+
+
+def _children(value: bytes) -> list[tuple[int, bytes]]:
+    children, pos = [], 0
+    while pos < len(value):
+        tag, child, pos = _decode(value, pos)
+        children.append((tag, child))
+    return children
+
+
+def _result(tag: int, code: int, message: str = '', extra: bytes = b'') -> bytes:
+    return _tlv(tag, _integer(0x0a, code) + _tlv(0x04, b'') + _tlv(0x04, message.encode('utf-8')) + extra)
+
+
+# Directory Model
+# ---------------
+
+def _normalize_dn(dn: str) -> str:
+    return ','.join(rdn.strip() for rdn in dn.split(',')).lower()
+
+
+def _timestamp() -> bytes:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%SZ').encode('ascii')
+
+
+class _Entry:
+    __slots__ = ('dn', 'attrs')
+
+    def __init__(self, dn: str, attrs: dict[str, list[bytes]]):
+        self.dn, self.attrs = dn, {}
+        for name, values in attrs.items():
+            self.set(name, values)
+        self.set('modifyTimestamp', [_timestamp()])
+
+    def get(self, name: str) -> list[bytes]:
+        return self.attrs.get(name.lower(), (name, []))[1]
+
+    def set(self, name: str, values: list[bytes]):
+        if values:
+            self.attrs[name.lower()] = (name, list(values))
+        else:
+            self.attrs.pop(name.lower(), None)
+
+
+def _matches(entry: _Entry, tag: int, value: bytes) -> bool:
+    if tag == 0xa0: return all(_matches(entry, *child) for child in _children(value))
+    if tag == 0xa1: return any(_matches(entry, *child) for child in _children(value))
+    if tag == 0xa2: return not _matches(entry, *_children(value)[0])
+    if tag == 0x87: return bool(entry.get(value.decode('utf-8')))
+    children = _children(value)
+    values = [i.lower() for i in entry.get(children[0][1].decode('utf-8'))]
+    if tag in (0xa3, 0xa8): return children[1][1].lower() in values
+    if tag == 0xa5: return any(i >= children[1][1].lower() for i in values)
+    if tag == 0xa6: return any(i <= children[1][1].lower() for i in values)
+    if tag == 0xa4:
+        parts = _children(children[1][1])
+        for candidate in values:
+            pos, ok = 0, True
+            for kind, part in parts:
+                part = part.lower()
+                if kind == 0x80:
+                    ok = candidate.startswith(part)
+                    pos = len(part)
+                elif kind == 0x81:
+                    found = candidate.find(part, pos)
+                    ok, pos = found >= 0, found + len(part)
+                else:
+                    ok = candidate.endswith(part) and len(candidate) - len(part) >= pos
+                if not ok: break
+            if ok: return True
+        return False
+    raise ValueError(f'Unsupported filter tag {tag:#x}')
+
+
+def _in_scope(dn: str, base: str, scope: int) -> bool:
+    if scope == 0: return dn == base
+    if not dn.endswith(',' + base): return scope == 2 and dn == base
+    return scope == 2 or ',' not in dn[:-len(base) - 1]
+
+
+class StandInLDAPServer:
+    '''An in-memory LDAP server on localhost that answers after `latency` seconds.'''
+
+    def __init__(self, latency: float = 0.0):
+        self.latency, self.port, self.operations = latency, None, 0
+        self._entries: dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._ready, self._thread, self._loop, self._stop = threading.Event(), None, None, None
+
+    @property
+    def uri(self) -> str:
+        return f'ldap://127.0.0.1:{self.port}'
+
+    def add_entry(self, dn: str, attrs: dict[str, list[bytes]]):
+        with self._lock:
+            self._entries[_normalize_dn(dn)] = _Entry(dn, attrs)
+
+    def entry(self, dn: str) -> dict[str, list[bytes]] | None:
+        with self._lock:
+            entry = self._entries.get(_normalize_dn(dn))
+            return {name: list(values) for name, values in entry.attrs.values()} if entry else None
+
+    # Operations; each returns the encoded protocol operations to send back
+
+    def _search(self, value: bytes) -> list[bytes]:
+        children = _children(value)
+        base, scope = _normalize_dn(children[0][1].decode('utf-8')), int.from_bytes(children[1][1], 'big')
+        size_limit, filter_tlv = int.from_bytes(children[3][1], 'big'), children[6]
+        wanted = {i.decode('utf-8').lower() for tag, i in _children(children[7][1])} if len(children) > 7 else set()
+        everything = not wanted or '*' in wanted
+        with self._lock:
+            entries = [e for dn, e in self._entries.items() if _in_scope(dn, base, scope) and _matches(e, *filter_tlv)]
+        responses = []
+        for entry in entries[:size_limit or None]:
+            attributes = b''.join(
+                _tlv(0x30, _tlv(0x04, name.encode('utf-8')) + _tlv(0x31, b''.join(_tlv(0x04, v) for v in values)))
+                for key, (name, values) in entry.attrs.items() if everything or key in wanted
+            )
+            responses.append(_tlv(_search_entry, _tlv(0x04, entry.dn.encode('utf-8')) + _tlv(0x30, attributes)))
+        responses.append(_result(_search_done, _success))
+        return responses
+
+    def _add(self, value: bytes) -> list[bytes]:
+        children = _children(value)
+        dn = children[0][1].decode('utf-8')
+        attrs = {}
+        for tag, attribute in _children(children[1][1]):
+            (_, name), (_, values) = _children(attribute)
+            attrs[name.decode('utf-8')] = [v for t, v in _children(values)]
+        with self._lock:
+            if _normalize_dn(dn) in self._entries: return [_result(_add_response, _already_exists, dn)]
+            self._entries[_normalize_dn(dn)] = _Entry(dn, attrs)
+        return [_result(_add_response, _success)]
+
+    def _modify(self, value: bytes) -> list[bytes]:
+        children = _children(value)
+        dn = children[0][1].decode('utf-8')
+        with self._lock:
+            entry = self._entries.get(_normalize_dn(dn))
+            if entry is None: return [_result(_modify_response, _no_such_object, dn)]
+            for tag, change in _children(children[1][1]):
+                (_, operation), (_, modification) = _children(change)
+                (_, name), (_, values) = _children(modification)
+                name, values = name.decode('utf-8'), [v for t, v in _children(values)]
+                operation = int.from_bytes(operation, 'big')
+                if operation == 0:
+                    entry.set(name, entry.get(name) + values)
+                elif operation == 1:
+                    entry.set(name, [v for v in entry.get(name) if values and v not in values])
+                else:
+                    entry.set(name, values)
+            entry.set('modifyTimestamp', [_timestamp()])
+        return [_result(_modify_response, _success)]
+
+    def _delete(self, value: bytes) -> list[bytes]:
+        with self._lock:
+            found = self._entries.pop(_normalize_dn(value.decode('utf-8')), None)
+        return [_result(_delete_response, _success if found else _no_such_object)]
+
+    def _extended(self, value: bytes) -> list[bytes]:
+        oid = _children(value)[0][1]
+        if oid == _whoami_oid: return [_result(_extended_response, _success, extra=_tlv(0x8b, b''))]
+        return [_result(_extended_response, _protocol_error, f'Unsupported extended operation {oid.decode()}')]
+
+    def _respond(self, tag: int, value: bytes) -> list[bytes] | None:
+        self.operations += 1
+        if tag == _bind_request: return [_result(_bind_response, _success)]
+        if tag == _search_request: return self._search(value)
+        if tag == _add_request: return self._add(value)
+        if tag == _modify_request: return self._modify(value)
+        if tag == _delete_request: return self._delete(value)
+        if tag == _extended_request: return self._extended(value)
+        if tag == _abandon_request: return []
+        return None
+
+    # Networking
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop, buffer = asyncio.get_running_loop(), b''
+
+        def send(msgid: bytes, responses: list[bytes]):
+            if writer.is_closing(): return
+            for response in responses:
+                writer.write(_tlv(0x30, _tlv(0x02, msgid) + response))
+
+        try:
+            while data := await reader.read(65536):
+                buffer += data
+                while (decoded := _decode(buffer)) is not None:
+                    tag, message, end = decoded
+                    buffer = buffer[end:]
+                    (_, msgid), (op, value) = _children(message)[:2]
+                    if op == _unbind_request: return
+                    try:
+                        responses = self._respond(op, value)
+                    except Exception as ex:
+                        _logger.exception('Stand-in LDAP server cannot handle operation %#x', op)
+                        responses = [_result(_response_tags.get(op, _extended_response), _protocol_error, str(ex))]
+                    if responses is None: return
+                    loop.call_later(self.latency, send, msgid, responses)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            loop.call_later(self.latency, writer.close)
+
+    async def _serve(self):
+        self._loop, self._stop = asyncio.get_running_loop(), asyncio.Event()
+        server = await asyncio.start_server(self._handle, '127.0.0.1', self.port or 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._stop.wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
@@ -0,0 +1,72 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: an SMTP sink for benchmarks.
+
+This speaks just enough SMTP over plain TCP for Django's SMTP email backend: greetings, EHLO
+and HELO, MAIL, RCPT, DATA, RSET, NOOP, and QUIT. Messages are counted and thrown away. A real
+mail server makes every new connection wait through STARTTLS and a login before the first
+message; here that's simulated by holding each new connection's greeting for `handshake`
+seconds. Every other reply is held for `latency` seconds to simulate a distant server.
+
+The server runs its own event loop on a background thread, like the stand-in LDAP server.
+'''
+
+import asyncio, threading
+
+
+class SMTPSink:
+    '''An SMTP server that accepts everything and keeps nothing.'''
+
+    def __init__(self, handshake: float = 0.0, latency: float = 0.0):
+        self.handshake, self.latency, self.port = handshake, latency, None
+        self.connections = self.messages = 0
+        self._ready, self._thread, self._loop, self._stop = threading.Event(), None, None, None
+
+    async def _reply(self, writer: asyncio.StreamWriter, text: str):
+        if self.latency: await asyncio.sleep(self.latency)
+        writer.write(text.encode('ascii') + b'\r\n')
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            if self.handshake: await asyncio.sleep(self.handshake)
+            await self._reply(writer, '220 localhost BioKey SMTP sink')
+            while line := await reader.readline():
+                verb = line[:4].upper()
+                if verb == b'EHLO':
+                    await self._reply(writer, '250-localhost\r\n250-8BITMIME\r\n250 SMTPUTF8')
+                elif verb == b'DATA':
+                    await self._reply(writer, '354 End data with <CR><LF>.<CR><LF>')
+                    while (line := await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    self.messages += 1
+                    await self._reply(writer, '250 OK: message discarded')
+                elif verb == b'QUIT':
+                    await self._reply(writer, '221 Bye')
+                    break
+                elif verb in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    await self._reply(writer, '250 OK')
+                else:
+                    await self._reply(writer, '502 Command not implemented')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        self._loop, self._stop = asyncio.get_running_loop(), asyncio.Event()
+        server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._stop.wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
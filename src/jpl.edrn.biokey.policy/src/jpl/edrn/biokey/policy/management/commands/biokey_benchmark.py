@@ -0,0 +1,279 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: micro-benchmarks.
+
+By default these run against the stand-in LDAP server (see `.._ldapstandin`), which keeps its
+entries in memory and adds a fixed latency to every round trip, so results are repeatable and
+nothing touches a real server.
+Give `--dit` to run the read-only benchmarks against a real directory information tree
+instead.
+'''
+
+from .._ldapstandin import StandInLDAPServer
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from jpl.edrn.biokey.usermgmt import _ldap, _mirror
+from jpl.edrn.biokey.usermgmt._accounts import decode_accounts
+from jpl.edrn.biokey.usermgmt._names import normalize
+from jpl.edrn.biokey.usermgmt.models import DirectoryInformationTree
+import argparse, concurrent.futures, datetime, gc, ldap, ldap.ldapobject, random, statistics, threading, time
+import tracemalloc, types
+
+
+def _stand_in_directory(latency: float) -> StandInLDAPServer:
+    '''Start a stand-in LDAP server that answers after `latency` seconds.'''
+    directory = StandInLDAPServer(latency)
+    directory.start()
+    return directory
+
+
+def _add_user(directory: StandInLDAPServer, base: str, uid: str, fn: str, ln: str):
+    directory.add_entry(f'uid={uid},{base}', {
+        'uid': [uid.encode('utf-8')], 'cn': [f'{fn} {ln}'.encode('utf-8')], 'sn': [ln.encode('utf-8')],
+        'mail': [f'{uid}@example.com'.encode('utf-8')], 'objectClass': [b'top', b'person', b'inetOrgPerson'],
+        'userPassword': [_ldap.generate_random_ldap_password()], 'description': [b'@@biokey={"consortium": "x"}'],
+    })
+
+
+def _connect(directory: StandInLDAPServer) -> ldap.ldapobject.LDAPObject:
+    connection = ldap.initialize(directory.uri)
+    connection.simple_bind_s('', '')
+    return connection
+
+
+# Pieces for realistic-looking names: 27,000 surnames, some accented or hyphenated
+_given_names = ('Robert', 'William', 'Katherine', 'Elizabeth', 'Michael', 'Margaret', 'Thomas', 'Jennifer', 'James')
+_nicknames = {'Robert': 'Bob', 'William': 'Bill', 'Katherine': 'Kate', 'Elizabeth': 'Liz', 'Michael': 'Mike',
+              'Margaret': 'Peggy', 'Thomas': 'Tom', 'Jennifer': 'Jen', 'James': 'Jim'}
+_syllables = (
+    ('Gar', 'Mén', 'Sch', 'Ab', 'Kow', 'Ro', 'Fitz', 'Mac', 'O', 'Van', 'Tan', 'Nú', 'Li', 'Ber', 'Wil',
+     'Ca', 'Du', 'Ha', 'Jo', 'Ke', 'Lo', 'Ma', 'Pe', 'Sa', 'To', 'Vi', 'Ye', 'Za', 'Bro', 'Cro'),
+    ('ci', 'de', 'mi', 'al', 'ski', 'dri', 'ger', 'ney', 'bri', 'der', 'aka', 'ñe', 'an', 'na', 'li',
+     'ro', 'ta', 've', 'lu', 'mo', 'sa', 'ni', 'ko', 'pe', 'ra', 'bo', 'cu', 'di', 'fe', 'go'),
+    ('a', 'z', 'dt', 'son', 'go', 'guez', 'ler', 'ton', 'ens', 'berg', 'mura', 'ez', 'ng', 'ard', 'lis',
+     'as', 'en', 'on', 'ik', 'ov', 'et', 'man', 'ley', 'ford', 'well', 'stein', 'ini', 'eau', 'sen', 'ux'),
+)
+
+
+def _synthetic_name(i: int) -> tuple[str, str]:
+    '''Make up the given name and surname of user `i`.'''
+    a, b, c = i % 30, i // 30 % 30, i // 900 % 30
+    ln = _syllables[0][a] + _syllables[1][b] + _syllables[2][c]
+    if i % 17 == 0: ln += '-' + _syllables[0][b] + _syllables[2][a]
+    return _given_names[i % len(_given_names)], ln
+
+
+class Command(BaseCommand):
+    help = 'Run BioKey micro-benchmarks'
+    _benchmarks = ('uids', 'signups', 'records', 'mirror')
+
+    def add_arguments(self, parser: argparse.ArgumentParser):
+        parser.add_argument('benchmark', choices=self._benchmarks, help='Which benchmark to run')
+        parser.add_argument(
+            '--count', type=int, default=5000, help='Number of entries to put in the stand-in (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.002,
+            help='Simulated seconds per stand-in round trip (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=20, help='How many times to repeat each trial (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=300, help='Number of simultaneous sign-ups (default: %(default)s)'
+        )
+        parser.add_argument('--dit', help='Slug of a real DirectoryInformationTree to use instead of the stand-in')
+
+    def _stand_in_dit(self, directory: StandInLDAPServer) -> types.SimpleNamespace:
+        return types.SimpleNamespace(
+            title='Stand-in', slug='standin', uri=directory.uri, user_base='ou=users,o=standin',
+            user_scope=ldap.SCOPE_ONELEVEL
+        )
+
+    def _stand_in_results(self, count: int, base: str, name) -> list[tuple[str, dict]]:
+        '''Get search results for `count` users under `base` from the stand-in; user `i` is called `name(i)`.'''
+        directory = _stand_in_directory(0.0)
+        try:
+            for i in range(count):
+                _add_user(directory, base, f'user{i}', *name(i))
+            connection = _connect(directory)
+            results = connection.search_s(base, ldap.SCOPE_ONELEVEL, '(uid=user*)', _ldap._attribute_sets['account'])
+            connection.unbind_s()
+            return results
+        finally:
+            directory.stop()
+
+    def _report(self, label: str, elapsed: float, repeat: int, round_trips: int | None = None):
+        per = elapsed / repeat * 1000.0
+        message = f'{label:<40} {per:10.3f} ms per call'
+        if round_trips is not None:
+            message += f' {round_trips / repeat:8.1f} round trips per call'
+        self.stdout.write(message)
+
+    def _probe_one_at_a_time(self, connection, fn: str, ln: str, dit) -> str:
+        '''The account naming we used to do: probe candidates one by one, up to 20 times.'''
+        uid = _ldap._account_name_base(fn, ln)
+        for attempt in range(20):
+            if len(connection.search_s(dit.user_base, dit.user_scope, f'(uid={uid})')) == 0:
+                return uid
+            uid = f'{uid}{random.randrange(start=100, stop=399, step=1)}'
+        raise ValueError('Ran out of attempts')
+
+    def bench_uids(self, count: int, latency: float, repeat: int, dit_slug: str | None, **options):
+        '''Time finding a free account name when thousands of names share its prefix.'''
+        if dit_slug:
+            dit = DirectoryInformationTree.objects.filter(slug=dit_slug).first()
+            if not dit: raise CommandError(f'No DIT with slug «{dit_slug}»')
+            self.stdout.write(f'Using the real directory at {dit.uri} under {dit.user_base}')
+            with _ldap.ldap_connection(dit) as connection:
+                for label, func in (
+                    ('one probe per candidate', self._probe_one_at_a_time),
+                    ('single prefix search', _ldap._generate_account_name),
+                ):
+                    start = time.perf_counter()
+                    for i in range(repeat): func(connection, 'John', 'Smith', dit)
+                    self._report(label, time.perf_counter() - start, repeat)
+            return
+
+        directory = _stand_in_directory(latency)
+        try:
+            dit = self._stand_in_dit(directory)
+            _add_user(directory, dit.user_base, 'jsmith', 'John', 'Smith')
+            for i in range(100, 100 + count):
+                _add_user(directory, dit.user_base, f'jsmith{i}', 'John', 'Smith')
+            self.stdout.write(f'Stand-in has {count + 1} «jsmith» entries, {latency * 1000.0} ms latency')
+            connection = _connect(directory)
+            for label, func in (
+                ('one probe per candidate', self._probe_one_at_a_time),
+                ('single prefix search', _ldap._generate_account_name),
+            ):
+                operations, start = directory.operations, time.perf_counter()
+                for i in range(repeat):
+                    uid = func(connection, 'John', 'Smith', dit)
+                    if directory.entry(f'uid={uid},{dit.user_base}') is not None:
+                        raise CommandError(f'{label} picked «{uid}» which is already taken')
+                self._report(label, time.perf_counter() - start, repeat, directory.operations - operations)
+            connection.unbind_s()
+        finally:
+            directory.stop()
+
+    def bench_signups(self, count: int, latency: float, concurrency: int, dit_slug: str | None, **options):
+        '''Stress account naming with many simultaneous sign-ups for "John Smith".
+
+        Each sign-up gets the same view of the stand-in directory and relies on the uid
+        reservations in the cache to stay out of the others' way. Any add that collides
+        with another is a failure. This needs the real cache (Redis) to be reachable.
+        '''
+        if dit_slug: raise CommandError('The signups benchmark only runs against the stand-in directory')
+        directory = _stand_in_directory(latency)
+        dit = self._stand_in_dit(directory)
+        for i in range(100, 100 + count):
+            _add_user(directory, dit.user_base, f'jsmith{i}', 'John', 'Smith')
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        barrier = threading.Barrier(concurrency)
+
+        def sign_up(i: int) -> str:
+            connection = _connect(directory)
+            try:
+                barrier.wait()
+                account, token = _ldap._provision_account(
+                    connection, 'John', 'Smith', '', f'john.smith.{i}@example.com', expiration, dit
+                )
+                return account['uid']
+            finally:
+                connection.unbind_s()
+
+        self.stdout.write(f'Firing {concurrency} simultaneous sign-ups for «John Smith» at {count} existing jsmith*')
+        start, uids, collisions = time.perf_counter(), [], 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(sign_up, i) for i in range(concurrency)]
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        uids.append(future.result())
+                    except ldap.ALREADY_EXISTS:
+                        collisions += 1
+        finally:
+            directory.stop()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'{len(uids)} created, {len(set(uids))} distinct, {collisions} collisions in {elapsed:.3f}s')
+        if collisions or len(set(uids)) != concurrency:
+            raise CommandError('Concurrent sign-ups collided')
+
+    def bench_records(self, count: int, repeat: int, dit_slug: str | None, **options):
+        '''Compare decoding search results eagerly into dicts with lazy `Account` records.
+
+        The bulk case we care about only wants one field (the email address) from each entry.
+        '''
+        if dit_slug: raise CommandError('The records benchmark only runs against the stand-in directory')
+        results = self._stand_in_results(count, 'ou=users,o=standin', lambda i: ('Test', f'User{i}'))
+        per_10k = 10000.0 / count
+        self.stdout.write(f'Decoding {count} entries, reporting per 10k entries')
+        for label, decode in (
+            ('eager dicts', lambda results: [i.to_dict() for i in decode_accounts(results)]),
+            ('lazy Account records', decode_accounts),
+        ):
+            start = time.perf_counter()
+            for i in range(repeat):
+                emails = [account['email'] for account in decode(results)]
+            elapsed = (time.perf_counter() - start) / repeat * per_10k * 1000.0
+            gc.collect()
+            tracemalloc.start()
+            records = decode(results)
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del records, emails
+            self.stdout.write(f'{label:<40} {elapsed:10.3f} ms {size * per_10k / 1024.0:12.1f} KiB retained')
+
+    def bench_mirror(self, count: int, latency: float, repeat: int, dit_slug: str | None, **options):
+        '''Time lookups by email and by name against the directory mirror with `count` users.
+
+        This needs `--dit` to hang the mirrored entries off of. They're added in a transaction
+        that's rolled back at the end, so nothing sticks. Try `--count 100000`. A live lookup
+        costs at least one round trip to the directory, which `--latency` stands for.
+
+        Besides exact names, we look people up the way they tend to misremember themselves: by
+        nickname, without accents, with only part of a hyphenated surname, and with a typo.
+        '''
+        if not dit_slug: raise CommandError('The mirror benchmark needs --dit')
+        dit = DirectoryInformationTree.objects.filter(slug=dit_slug).first()
+        if not dit: raise CommandError(f'No DIT with slug «{dit_slug}»')
+        results = self._stand_in_results(count, dit.user_base, _synthetic_name)
+        probes = [random.randrange(count) for i in range(repeat)]
+
+        with transaction.atomic():
+            start, now = time.perf_counter(), timezone.now()
+            for i in range(0, len(results), _mirror._batch_size):
+                _mirror._save([_mirror._entry(dit, dn, attrs, now) for dn, attrs in results[i:i + _mirror._batch_size]])
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {_mirror.DirectoryEntry._meta.db_table}')
+            self.stdout.write(f'Mirrored {count} entries in {time.perf_counter() - start:.3f}s')
+            self.stdout.write(f'A live lookup would cost at least {latency * 1000.0:.3f} ms for the round trip alone')
+            names = {i: _synthetic_name(i) for i in probes}
+            by_email, potential = _mirror.mirrored_accounts_by_email, _mirror.mirrored_potential_accounts
+            for label, lookup in (
+                ('by email', lambda i: [a['email'] for a in by_email(f'USER{i}@example.com', dit)]),
+                ('by full name', lambda i: potential(*names[i], dit)),
+                ('by surname', lambda i: potential('', names[i][1].lower(), dit)),
+                ('by nickname', lambda i: potential(_nicknames[names[i][0]], names[i][1], dit)),
+                ('without accents', lambda i: potential(names[i][0], normalize(names[i][1]), dit)),
+                ('by part of surname', lambda i: potential(names[i][0], names[i][1].split('-')[-1], dit)),
+                ('with a typo', lambda i: potential(names[i][0], names[i][1][:-2] + names[i][1][-1:-3:-1], dit)),
+            ):
+                timings, found = [], 0
+                for i in probes:
+                    began = time.perf_counter()
+                    emails = lookup(i)
+                    timings.append((time.perf_counter() - began) * 1000.0)
+                    found += f'user{i}@example.com' in emails
+                timings.sort()
+                p50, p99 = statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+                self.stdout.write(f'{label:<40} {p50:10.3f} ms p50 {p99:10.3f} ms p99 {found / len(probes):8.0%} found')
+            transaction.set_rollback(True)
+
+    def handle(self, *args, **options):
+        benchmark = options.pop('benchmark')
+        options['dit_slug'] = options.pop('dit')
+        func = getattr(self, f'bench_{benchmark}')
+        func(**options)
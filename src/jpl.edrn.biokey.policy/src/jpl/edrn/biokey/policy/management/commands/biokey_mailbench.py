@@ -0,0 +1,83 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: benchmark sending email from the worker.
+
+This sends `--messages` messages through the worker's email task, run right here rather than
+through Celery, from `--senders` threads at once, to an SMTP sink on localhost, and reports
+messages per second. It does so three ways: with a new connection for every message, as the
+worker used to, over the worker's persistent connection one message at a time, and over it in
+batches. The sink holds each new connection for `--handshake` seconds to stand in for STARTTLS
+and a login, and each reply for `--latency` seconds. Nothing is actually sent.
+'''
+
+from .._smtpsink import SMTPSink
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from jpl.edrn.biokey.usermgmt import tasks
+import argparse, concurrent.futures, time
+
+
+# Each way to send, by the settings for it
+_modes = {
+    'per-message': {'BIOKEY_SMTP_IDLE_TIMEOUT': 0},
+    'persistent':  {'BIOKEY_SMTP_IDLE_TIMEOUT': 30.0, 'BIOKEY_SMTP_BATCH_SIZE': 1},
+    'batched':     {'BIOKEY_SMTP_IDLE_TIMEOUT': 30.0, 'BIOKEY_SMTP_BATCH_SIZE': 50, 'BIOKEY_SMTP_BATCH_WINDOW': 0.005},
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark email throughput with and without a persistent SMTP connection'
+
+    def add_arguments(self, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--messages', type=int, default=200, help='Messages to send each way (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--handshake', type=float, default=0.1,
+            help='Seconds each new SMTP connection takes to get going (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.001, help='Seconds added to each SMTP reply (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--senders', type=int, default=8,
+            help='Threads sending at once, as in a threaded worker (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--mode', action='append', choices=_modes.keys(), help='Which way to send; repeat for more (default: all)'
+        )
+
+    def handle(self, *args, **options):
+        count, senders = options['messages'], options['senders']
+        sink = SMTPSink(options['handshake'], options['latency'])
+        sink.start()
+        try:
+            self.stdout.write(
+                f'Sending {count} messages each way from {senders} threads; {options["handshake"] * 1000.0} ms per '
+                f'new connection, {options["latency"] * 1000.0} ms per reply'
+            )
+            for mode in options['mode'] or _modes.keys():
+                overrides = {
+                    'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend', 'EMAIL_HOST': '127.0.0.1',
+                    'EMAIL_PORT': sink.port, 'EMAIL_HOST_USER': '', 'EMAIL_HOST_PASSWORD': '',
+                    'EMAIL_USE_TLS': False, 'EMAIL_USE_SSL': False, **_modes[mode],
+                }
+                with override_settings(**overrides):
+                    tasks.close_mail_connection()
+                    connections, messages, start = sink.connections, sink.messages, time.perf_counter()
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=senders) as executor:
+                        futures = [
+                            executor.submit(
+                                tasks._send_email_asynchronously, 'bench@example.com', ['mark@example.com'],
+                                f'Benchmark {i}', 'Nothing to see here', None, 0
+                            ) for i in range(count)
+                        ]
+                        for future in futures: future.result()
+                    elapsed = time.perf_counter() - start
+                    tasks.close_mail_connection()
+                self.stdout.write(
+                    f'{mode:<12} {count / elapsed:10.1f} msg/s {elapsed / count * 1000.0:10.1f} ms/msg '
+                    f'{sink.connections - connections:6} connections {sink.messages - messages:6} delivered'
+                )
+        finally:
+            sink.stop()
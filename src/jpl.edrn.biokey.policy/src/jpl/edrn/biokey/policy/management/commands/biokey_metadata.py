@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: move account metadata out of LDAP descriptions.
+
+BioKey used to keep each account's consortium and reset token as `@@biokey={json}` in its LDAP
+`description`; it now keeps them in the database. This copies every such entry's metadata
+over, streaming the directory a page at a time so memory stays flat however big it is. Rows
+already in the database are newer than any description, so they're left alone. Running it
+again is harmless.
+
+With `--strip`, each description then loses its `@@biokey` part (any text before it stays), so
+the directory no longer carries metadata that could go stale.
+'''
+
+from django.core.management.base import BaseCommand, CommandError
+from jpl.edrn.biokey.usermgmt._accounts import Account, _biokey_json_re
+from jpl.edrn.biokey.usermgmt._admission import READ
+from jpl.edrn.biokey.usermgmt._ldap import ldap_connection, paged_search
+from jpl.edrn.biokey.usermgmt._metadata import AccountMetadata, from_biokey
+from jpl.edrn.biokey.usermgmt.models import DirectoryInformationTree
+import argparse, ldap
+
+
+class Command(BaseCommand):
+    help = 'Copy BioKey account metadata from LDAP descriptions into the database'
+
+    def add_arguments(self, parser: argparse.ArgumentParser):
+        parser.add_argument('--dit', action='append', help='Slug of a DIT to migrate; repeat for more (default: all)')
+        parser.add_argument(
+            '--strip', action='store_true', help='Also remove the @@biokey metadata from the descriptions in LDAP'
+        )
+        parser.add_argument(
+            '--batch', type=int, default=500, help='Entries to save to the database at a time (default: %(default)s)'
+        )
+
+    def _strip(self, connection, batch: list[Account]):
+        for account in batch:
+            preceding = _biokey_json_re.match(account.desc).group(1).strip()
+            if preceding:
+                modlist = [(ldap.MOD_REPLACE, 'description', [preceding.encode('utf-8')])]
+            else:
+                modlist = [(ldap.MOD_DELETE, 'description', None)]
+            connection.modify_s(account.dn, modlist)
+
+    def _save(self, dit: DirectoryInformationTree, batch: list[Account]) -> int:
+        rows = [from_biokey(dit, account['uid'], account.biokey) for account in batch]
+        before = AccountMetadata.objects.filter(page_id=dit.pk).count()
+        AccountMetadata.objects.bulk_create(rows, ignore_conflicts=True)
+        return AccountMetadata.objects.filter(page_id=dit.pk).count() - before
+
+    def migrate(self, dit: DirectoryInformationTree, strip: bool, batch_size: int):
+        seen = saved = 0
+        batch = []
+        # Strip on a second connection so the modifications don't interleave with the paged search
+        with ldap_connection(dit, kind=READ) as reader, ldap_connection(dit) as writer:
+            filterstr, attrlist = '(description=*@@biokey=*)', ['uid', 'description']
+            for result in paged_search(reader, dit.user_base, dit.user_scope, filterstr, attrlist):
+                account = Account(result)
+                if not account.get('uid'): continue
+                batch.append(account)
+                seen += 1
+                if len(batch) >= batch_size:
+                    saved += self._save(dit, batch)
+                    if strip: self._strip(writer, batch)
+                    batch = []
+            if batch:
+                saved += self._save(dit, batch)
+                if strip: self._strip(writer, batch)
+        self.stdout.write(
+            f'{dit.slug}: {seen} entries with metadata, {saved} newly saved, {seen - saved} already in the database'
+            + (', descriptions stripped' if strip else '')
+        )
+
+    def handle(self, *args, **options):
+        dits = DirectoryInformationTree.objects.all()
+        if options['dit']:
+            dits = dits.filter(slug__in=options['dit'])
+            missing = set(options['dit']) - set(dits.values_list('slug', flat=True))
+            if missing: raise CommandError(f'No DITs with slugs {", ".join(sorted(missing))}')
+        for dit in dits:
+            self.migrate(dit, options['strip'], options['batch'])
@@ -0,0 +1,268 @@
+# encoding: utf-8
+
+'''🧬🔑 BioKey: benchmark whole servers.
+
+This starts Gunicorn serving the real app with each worker class we want to compare, hammers
+the password reset form at `/pwreset/…` at each of several levels of concurrent clients, and
+reports requests per second plus median and 99th percentile latency.
+
+To simulate a far-away directory, every LDAP request is held for `--latency` seconds. By
+default the servers talk to an in-memory stand-in LDAP server with a single account in it, so
+results are reproducible anywhere. With `--directory real`, they instead talk to the LDAP
+server of `--dit` through a proxy on localhost that adds the latency. Either way we point a
+temporary copy of the DIT at the stand-in or proxy so the real one is left alone; the copy is
+deleted afterwards. Since the proxy's address won't match the server's certificate, an ldaps
+URI needs `TLS_REQCERT never` (which the development image already has). Note that the real
+directory run generates a real reset token for `--uid`, replacing any it already has.
+
+The `gevent` worker class needs gevent installed, and `asgi` needs uvicorn.
+'''
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from jpl.edrn.biokey.usermgmt import _ldap
+from .._ldapstandin import StandInLDAPServer
+from jpl.edrn.biokey.usermgmt.models import DirectoryInformationTree
+from urllib.parse import urlsplit
+import argparse, asyncio, concurrent.futures, datetime, http.client, os, socket, statistics, subprocess, sys
+import threading, time
+
+
+_wsgi_app = 'jpl.edrn.biokey.policy.wsgi:application'
+_asgi_app = 'jpl.edrn.biokey.policy.asgi:application'
+
+# Each server we can run: (Gunicorn worker class, app, extra environment)
+_servers = {
+    'sync':    ('sync', _wsgi_app, {'ASYNC_LDAP': 'False'}),
+    'gthread': ('gthread', _wsgi_app, {'ASYNC_LDAP': 'False'}),
+    'gevent':  ('gevent', _wsgi_app, {'ASYNC_LDAP': 'False'}),
+    'asgi':    ('uvicorn.workers.UvicornWorker', _asgi_app, {'ASYNC_LDAP': 'True'}),
+}
+
+
+class _LatencyProxy:
+    '''A TCP proxy that delays everything sent to `host`:`port` by `latency` seconds.
+
+    Data is held back, not serialized: a request that arrives while another is being held is
+    released `latency` seconds after it arrived, so pipelined operations overlap as they
+    would over a slow network link.
+    '''
+
+    def __init__(self, host: str, port: int, latency: float):
+        self.host, self.port, self.latency, self.listen_port = host, port, latency, None
+        self._ready, self._thread, self._loop, self._stop = threading.Event(), None, None, None
+
+    async def _pump(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, latency: float):
+        loop, queue = asyncio.get_running_loop(), asyncio.Queue()
+
+        async def feed():
+            while data := await reader.read(65536):
+                await queue.put((loop.time() + latency, data))
+            await queue.put((None, b''))
+
+        feeder = asyncio.create_task(feed())
+        try:
+            while True:
+                deadline, data = await queue.get()
+                if deadline is None: break
+                await asyncio.sleep(max(0.0, deadline - loop.time()))
+                writer.write(data)
+                await writer.drain()
+        finally:
+            feeder.cancel()
+            writer.close()
+
+    async def _handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            client_writer.close()
+            return
+        try:
+            await asyncio.gather(
+                self._pump(client_reader, server_writer, self.latency), self._pump(server_reader, client_writer, 0.0),
+                return_exceptions=True
+            )
+        except asyncio.CancelledError:
+            pass  # Shutting down
+
+    async def _serve(self):
+        self._loop, self._stop = asyncio.get_running_loop(), asyncio.Event()
+        server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.listen_port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._stop.wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the password reset routes under different servers with a simulated slow directory'
+
+    def add_arguments(self, parser: argparse.ArgumentParser):
+        parser.add_argument('--dit', required=True, help='Slug of the DirectoryInformationTree to base the test on')
+        parser.add_argument(
+            '--directory', choices=('standin', 'real'), default='standin',
+            help='Use the stand-in LDAP server or the real one of the DIT (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--uid', default='benchmark',
+            help='Account to request resets for; must exist in a real directory (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--server', action='append', choices=_servers.keys(),
+            help='Which kind of worker to benchmark; repeat for more (default: all)'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.05, help='Seconds added to each LDAP request (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, nargs='+', default=[8, 32, 128],
+            help='Numbers of simultaneous clients to try (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--duration', type=float, default=20.0, help='Seconds to run each trial (default: %(default)s)'
+        )
+        parser.add_argument('--workers', type=int, default=4, help='Gunicorn worker processes (default: %(default)s)')
+        parser.add_argument(
+            '--threads', type=int, default=8, help='Threads per gthread worker (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--port', type=int, default=8123, help='Port for Gunicorn to listen on (default: %(default)s)'
+        )
+
+    def _bench_dit(self, dit: DirectoryInformationTree, uri: str) -> DirectoryInformationTree:
+        return dit.copy(
+            update_attrs={'slug': f'{dit.slug}-bench', 'title': f'{dit.title} (benchmark)', 'uri': uri},
+            copy_revisions=False, log_action=None
+        )
+
+    def _stand_in(self, dit: DirectoryInformationTree, uid: str, latency: float) -> StandInLDAPServer:
+        '''Start a stand-in LDAP server with just `uid` in it, ready for a password reset.'''
+        directory = StandInLDAPServer(latency)
+        directory.start()
+        directory.add_entry(f'uid={uid},{dit.user_base}', {
+            'objectClass': [b'top', b'person', b'organizationalPerson', b'inetOrgPerson'],
+            'uid': [uid.encode('utf-8')], 'cn': [b'Bench Mark'], 'sn': [b'Mark'],
+            'mail': [f'{uid}@example.com'.encode('utf-8')], 'userPassword': [_ldap.generate_random_ldap_password()],
+            'description': [b'@@biokey={}'],
+        })
+        return directory
+
+    def _start_server(self, name: str, port: int, workers: int, threads: int) -> subprocess.Popen:
+        worker_class, app, env = _servers[name]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), **env)
+        env.setdefault('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE)
+        command = [
+            sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+            '--worker-class', worker_class, '--log-level', 'warning', app
+        ]
+        if worker_class == 'gthread':
+            # Let each thread keep its own pooled directory connection
+            command[-1:-1] = ['--threads', str(threads)]
+            env.setdefault('LDAP_POOL_SIZE', str(threads))
+        server = subprocess.Popen(command, env=env)
+        deadline = time.monotonic() + 60.0
+        while time.monotonic() < deadline:
+            if server.poll() is not None: raise CommandError(f'The {name} server exited with {server.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+                return server
+            except OSError:
+                time.sleep(0.25)
+        server.terminate()
+        raise CommandError(f'The {name} server never started listening on {port}')
+
+    def _request(self, port: int, path: str) -> tuple[int, float]:
+        start = time.perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60.0)
+        try:
+            connection.request('GET', path, headers={'Host': 'localhost'})
+            response = connection.getresponse()
+            response.read()
+            return response.status, time.perf_counter() - start
+        finally:
+            connection.close()
+
+    def _load(self, port: int, path: str, concurrency: int, duration: float) -> tuple[list[float], int, float]:
+        '''Have `concurrency` clients GET `path` back to back for `duration` seconds.
+
+        Returns the latencies of the successful requests, the number of failures, and the elapsed time.
+        '''
+        latencies, failures, lock, start = [], 0, threading.Lock(), time.perf_counter()
+        stop_at = start + duration
+
+        def client():
+            nonlocal failures
+            while time.perf_counter() < stop_at:
+                try:
+                    status, elapsed = self._request(port, path)
+                    ok = status == 200
+                except OSError:
+                    ok = False
+                with lock:
+                    if ok:
+                        latencies.append(elapsed)
+                    else:
+                        failures += 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(client) for i in range(concurrency)]:
+                future.result()
+        return latencies, failures, time.perf_counter() - start
+
+    def _report(self, label: str, latencies: list[float], failures: int, elapsed: float):
+        if not latencies:
+            self.stdout.write(f'{label:<16} no successful requests, {failures} failures')
+            return
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000.0
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000.0
+        rps = len(latencies) / elapsed
+        self.stdout.write(f'{label:<16} {rps:10.1f} req/s {p50:10.1f} ms p50 {p99:10.1f} ms p99 {failures:6} failures')
+
+    def handle(self, *args, **options):
+        dit = DirectoryInformationTree.objects.filter(slug=options['dit']).first()
+        if not dit: raise CommandError(f'No DIT with slug «{options["dit"]}»')
+        uid, latency, port = options['uid'], options['latency'], options['port']
+        if options['directory'] == 'real':
+            target = urlsplit(dit.uri)
+            directory = _LatencyProxy(
+                target.hostname, target.port or (636 if target.scheme == 'ldaps' else 389), latency
+            )
+            directory.start()
+            bench_dit = self._bench_dit(dit, f'{target.scheme}://localhost:{directory.listen_port}')
+        else:
+            directory = self._stand_in(dit, uid, latency)
+            bench_dit = self._bench_dit(dit, directory.uri)
+        try:
+            account = _ldap.get_account_by_uid(uid, bench_dit)
+            if not account: raise CommandError(f'No account «{uid}» in {dit.slug}')
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+            token = _ldap.generate_reset_token(account, expiration, bench_dit)
+            path = f'/pwreset/{bench_dit.slug}/{uid}/{token}'
+            self.stdout.write(
+                f'GET {path} for {options["duration"]}s per trial with {options["workers"]} workers, '
+                f'{latency * 1000.0} ms added to each LDAP request'
+            )
+            for name in options['server'] or _servers.keys():
+                server = self._start_server(name, port, options['workers'], options['threads'])
+                try:
+                    self._request(port, path)  # Warm up
+                    for concurrency in options['concurrency']:
+                        label = f'{name} ×{concurrency}'
+                        self._report(label, *self._load(port, path, concurrency, options['duration']))
+                finally:
+                    server.terminate()
+                    server.wait()
+        finally:
+            bench_dit.delete()
+            directory.stop()
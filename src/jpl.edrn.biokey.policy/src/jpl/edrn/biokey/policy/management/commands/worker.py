@@ -4,7 +4,7 @@
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-import os, sys
+import os, sys, tempfile
 
 
 class Command(BaseCommand):
@@ -30,7 +30,9 @@ class Command(BaseCommand):
         args = [
             'celery', '--no-color', '--app', 'jpl.edrn.biokey.policy',
             'worker',
-            '--hostname', 'worker', '--loglevel', self._log_levels[options['verbosity']]
+            '--hostname', 'worker', '--loglevel', self._log_levels[options['verbosity']],
+            # Run the beat too, for periodic tasks like keeping the directory mirrors current
+            '--beat', '--schedule', os.path.join(tempfile.gettempdir(), 'biokey-celerybeat-schedule'),
         ]
         self.stdout.flush()
         os.execvp('celery', args)
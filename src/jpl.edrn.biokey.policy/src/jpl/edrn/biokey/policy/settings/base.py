@@ -88,6 +88,9 @@ MIDDLEWARE = [
 
     # Wagtail:
     'wagtail.contrib.redirects.middleware.RedirectMiddleware',
+
+    # BioKey:
+    'jpl.edrn.biokey.usermgmt.middleware.DirectoryUnavailableMiddleware',
 ]
 
 
@@ -249,6 +252,34 @@ CELERY_RESULT_BACKEND = 'django-db'
 CELERY_TIMEZONE = TIME_ZONE
 
 
+# Directory Mirror
+# ----------------
+#
+# BioKey keeps a copy of each DIT's users in the database so lookups by email and name don't
+# have to go to LDAP. The worker's beat polls for changes and deletions every poll interval and
+# does a full sync every full sync period. If a DIT's mirror hasn't been updated in
+# max staleness seconds, lookups go to LDAP instead. All times are in seconds.
+
+BIOKEY_DIRECTORY_MIRROR         = os.getenv('DIRECTORY_MIRROR', 'True') == 'True'
+BIOKEY_MIRROR_POLL_INTERVAL     = int(os.getenv('MIRROR_POLL_INTERVAL', '60'))
+BIOKEY_MIRROR_MAX_STALENESS     = int(os.getenv('MIRROR_MAX_STALENESS', '300'))
+BIOKEY_MIRROR_FULL_SYNC_PERIOD  = int(os.getenv('MIRROR_FULL_SYNC_PERIOD', '86400'))
+BIOKEY_MIRROR_SYNC_LOCK_TTL     = int(os.getenv('MIRROR_SYNC_LOCK_TTL', '3600'))
+
+# When someone signs up, the mirror's name index finds accounts with names like theirs. Surnames
+# that share no fuzzy key must be at least this similar by trigrams (0 to 1), and we show at most
+# the match limit of possible existing accounts.
+BIOKEY_NAME_MATCH_SIMILARITY    = float(os.getenv('NAME_MATCH_SIMILARITY', '0.5'))
+BIOKEY_NAME_MATCH_LIMIT         = int(os.getenv('NAME_MATCH_LIMIT', '10'))
+
+CELERY_BEAT_SCHEDULE = {
+    'sync-directory-mirrors': {
+        'task': 'jpl.edrn.biokey.usermgmt.tasks.sync_directory_mirrors',
+        'schedule': BIOKEY_MIRROR_POLL_INTERVAL,
+    },
+}
+
+
 # Caching
 # -------
 #
@@ -281,6 +312,60 @@ CACHES = {
 }
 
 
+# Account Name Reservations
+# -------------------------
+#
+# When signing up, BioKey claims a new account name in the cache for this many seconds so
+# concurrent sign-ups for the same name on other workers or hosts don't collide.
+
+BIOKEY_UID_RESERVATION_TTL = int(os.getenv('UID_RESERVATION_TTL', '60'))  # seconds
+
+
+# Lookup Misses
+# -------------
+#
+# When looking up a username or email address in a DIT finds nothing, BioKey remembers that in
+# the cache for this many seconds and gives the same answer without asking the directory again.
+# Creating an account forgets the misses for its name and address. 0 turns this off.
+
+BIOKEY_NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', '60'))  # seconds
+
+
+# Background Sign-Ups
+# -------------------
+#
+# With this on, the sign-up page hands account creation to a Celery task and answers right away
+# with a page that checks back until the account's made. How each sign-up went is kept in the
+# cache for the given seconds.
+
+BIOKEY_ASYNC_SIGNUP       = os.getenv('ASYNC_SIGNUP', 'False') == 'True'
+BIOKEY_SIGNUP_STATUS_TTL  = int(os.getenv('SIGNUP_STATUS_TTL', '86400'))  # seconds
+
+
+# Forgotten Details
+# -----------------
+#
+# When someone's forgotten their username or password, the page queues a Celery task to look
+# them up and email them, and answers right away with the same page whether or not they're
+# known. That keeps its response time from giving away who is, and keeps bots from tying up
+# the web workers on the directory. It needs a running Celery worker, without which the mail
+# would never go, so it's off by default and the lookups happen in the request instead.
+
+BIOKEY_ASYNC_FORGOTTEN = os.getenv('ASYNC_FORGOTTEN', 'False') == 'True'
+
+
+# Duplicate Submissions
+# ---------------------
+#
+# When the same form is submitted again from the same browser within the TTL in seconds (say,
+# by a double-click), the sign-up, forgotten details, and change password pages answer with the
+# first submission's response instead of doing it all again, waiting up to the given seconds for
+# it if need be. A TTL of 0 turns this off.
+
+BIOKEY_DEDUPE_TTL  = int(os.getenv('DEDUPE_TTL', '30'))     # seconds
+BIOKEY_DEDUPE_WAIT = float(os.getenv('DEDUPE_WAIT', '10'))  # seconds
+
+
 # CSRF
 #
 # 🔗 https://docs.djangoproject.com/en/dev/ref/settings/#csrf-trusted-origins
@@ -307,6 +392,15 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', 'True') == 'True'
 EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', 'False') == 'True'
 
+# The worker keeps its SMTP connection open between messages, replacing it once it's been idle
+# this many seconds; 0 opens a new connection for every message.
+BIOKEY_SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '30'))  # seconds
+
+# Messages queued while the connection's busy go out together, up to this many at once, after
+# waiting up to the window in seconds for more to join them; 0 doesn't wait.
+BIOKEY_SMTP_BATCH_SIZE   = int(os.getenv('SMTP_BATCH_SIZE', '50'))
+BIOKEY_SMTP_BATCH_WINDOW = float(os.getenv('SMTP_BATCH_WINDOW', '0'))  # seconds
+
 
 # Search
 #
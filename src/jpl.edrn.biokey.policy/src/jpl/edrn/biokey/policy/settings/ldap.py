@@ -104,3 +104,128 @@ AUTH_LDAP_USER_FLAGS_BY_GROUP = {
     'is_staff':     'cn=ic-accounts,ou=personnel,dc=dir,dc=jpl,dc=nasa,dc=gov',
     'is_superuser': 'cn=ic-accounts,ou=personnel,dc=dir,dc=jpl,dc=nasa,dc=gov',
 }
+
+
+# BioKey's Own Directory Connections
+# ----------------------------------
+#
+# BioKey's user management keeps bound connections to each directory information tree's server
+# in a pool per process. These say how many idle connections to keep per server and manager DN,
+# how many seconds an idle connection may sit before it's evicted, how many seconds before a
+# re-used connection gets a health check, and how hard to try reconnecting when the server goes
+# away. A pool size of zero turns off pooling.
+
+BIOKEY_LDAP_POOL_SIZE           = int(os.getenv('LDAP_POOL_SIZE', '4'))
+BIOKEY_LDAP_POOL_MAX_IDLE       = int(os.getenv('LDAP_POOL_MAX_IDLE', '300'))
+BIOKEY_LDAP_POOL_CHECK_INTERVAL = int(os.getenv('LDAP_POOL_CHECK_INTERVAL', '30'))
+BIOKEY_LDAP_RETRY_MAX           = int(os.getenv('LDAP_RETRY_MAX', '2'))
+BIOKEY_LDAP_RETRY_DELAY         = float(os.getenv('LDAP_RETRY_DELAY', '0.5'))
+
+
+# Paged Searches
+# --------------
+#
+# Big searches in BioKey's user management come back a page at a time. These set the page
+# size, an overall cap on how many results to take (zero for no cap), and a time limit in
+# seconds for each page (zero for none).
+
+BIOKEY_LDAP_PAGE_SIZE  = int(os.getenv('LDAP_PAGE_SIZE', '500'))
+BIOKEY_LDAP_SIZE_LIMIT = int(os.getenv('LDAP_SIZE_LIMIT', '0'))
+BIOKEY_LDAP_TIME_LIMIT = float(os.getenv('LDAP_TIME_LIMIT', '0'))
+
+
+# Asynchronous Directory Access
+# -----------------------------
+#
+# With this on, the password reset views and the forgotten details form wait on the directory
+# asynchronously rather than tying up a thread each. It's meant for when BioKey is served with
+# ASGI. The timeout is how many seconds to wait for any one asynchronous directory operation
+# on a DIT that doesn't set an operation timeout of its own.
+
+BIOKEY_ASYNC_LDAP   = os.getenv('ASYNC_LDAP', 'False') == 'True'
+BIOKEY_LDAP_TIMEOUT = float(os.getenv('LDAP_TIMEOUT', '30'))
+
+
+# Replicas
+# --------
+#
+# A DIT can list read-only replicas of its LDAP server; reads go to the healthiest replica and
+# writes to the primary. A server that fails is avoided for the failure backoff in seconds.
+# After a write about an account, reads about it stay on the primary for the pin time in
+# seconds, which should cover how long the replicas take to catch up.
+
+BIOKEY_LDAP_FAILURE_BACKOFF = float(os.getenv('LDAP_FAILURE_BACKOFF', '30'))
+BIOKEY_LDAP_PIN_SECONDS     = float(os.getenv('LDAP_PIN_SECONDS', '5'))
+
+
+# Circuit Breakers
+# ----------------
+#
+# Each DIT sets its own connect, bind, and operation timeouts. After this many failures in a
+# row to reach a DIT's servers, BioKey stops trying them for the cooldown in seconds and shows a
+# "directory temporarily unavailable" page instead; then it tries one operation to see if
+# they're back.
+
+BIOKEY_LDAP_BREAKER_THRESHOLD = int(os.getenv('LDAP_BREAKER_THRESHOLD', '5'))
+BIOKEY_LDAP_BREAKER_COOLDOWN  = float(os.getenv('LDAP_BREAKER_COOLDOWN', '30'))
+
+
+# Admission Control
+# -----------------
+#
+# Each process lets this many reads and writes at once through to each DIT's directory, with up
+# to the queue length more waiting for up to the queue timeout in seconds; across all processes,
+# each DIT gets at most the given reads and writes a second (0 for no limit). Beyond those,
+# requests get a "directory busy" page straight away.
+
+BIOKEY_LDAP_READ_CONCURRENCY  = int(os.getenv('LDAP_READ_CONCURRENCY', '8'))
+BIOKEY_LDAP_WRITE_CONCURRENCY = int(os.getenv('LDAP_WRITE_CONCURRENCY', '2'))
+BIOKEY_LDAP_QUEUE_LENGTH      = int(os.getenv('LDAP_QUEUE_LENGTH', '16'))
+BIOKEY_LDAP_QUEUE_TIMEOUT     = float(os.getenv('LDAP_QUEUE_TIMEOUT', '2'))
+BIOKEY_LDAP_READ_RATE         = float(os.getenv('LDAP_READ_RATE', '200'))
+BIOKEY_LDAP_WRITE_RATE        = float(os.getenv('LDAP_WRITE_RATE', '20'))
+
+
+# Coalescing Reads
+# ----------------
+#
+# Identical lookups by uid or email address that arrive while one is already under way share
+# its answer instead of searching again. That's always so within a process; with this on, it's
+# so across processes and hosts too, through the cache, waiting up to the given seconds.
+
+BIOKEY_LDAP_COALESCE_CLUSTER = os.getenv('LDAP_COALESCE_CLUSTER', 'False') == 'True'
+BIOKEY_LDAP_COALESCE_WAIT    = float(os.getenv('LDAP_COALESCE_WAIT', '2'))
+
+
+# Cross-Consortium Lookups
+# ------------------------
+#
+# With this on, someone who's forgotten their username gets reminded of the accounts with their
+# email address in every DIT, not just the one whose page they used. The DITs are searched at
+# once by a pool of this many threads, and each gets the timeout in seconds before it's left out.
+
+BIOKEY_CROSS_DIT_LOOKUP  = os.getenv('CROSS_DIT_LOOKUP', 'False') == 'True'
+BIOKEY_CROSS_DIT_TIMEOUT = float(os.getenv('CROSS_DIT_TIMEOUT', '5'))
+BIOKEY_CROSS_DIT_WORKERS = int(os.getenv('CROSS_DIT_WORKERS', '8'))
+
+
+# Password Reset Tokens
+# ---------------------
+#
+# With this on, password reset links carry tokens signed with `SECRET_KEY` rather than random
+# tokens stored in the directory, so sending a reset link needs no directory write and bad or
+# expired links are turned away without a directory read. Links sent before the switch still work.
+# Signing needs the manager DN to be able to read `userPassword`; accounts where it can't get
+# stored tokens as before.
+
+BIOKEY_SIGNED_RESET_TOKENS = os.getenv('SIGNED_RESET_TOKENS', 'False') == 'True'
+
+
+# Password Changes
+# ----------------
+#
+# People changing their own passwords bind and change them on one connection as themselves. By
+# default we hash the new password and replace it ourselves; with this on, we ask the directory
+# to do that with the Password Modify extended operation, so it hashes it however it's set up to.
+
+BIOKEY_LDAP_PASSWORD_MODIFY = os.getenv('LDAP_PASSWORD_MODIFY', 'False') == 'True'
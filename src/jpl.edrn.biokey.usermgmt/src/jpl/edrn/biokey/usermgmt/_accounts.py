@@ -0,0 +1,99 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: account records.'''
+
+import json, logging, re
+
+
+_logger = logging.getLogger(__name__)
+
+_biokey_json_re = re.compile(r'([^@]*)(@@biokey=(.*$))?')
+
+# How an account's LDAP attributes map to the keys an `Account` offers: key → (attribute, required)
+_account_fields = {
+    'email': ('mail', True),
+    'sn':    ('sn', True),
+    'cn':    ('cn', True),
+    'uid':   ('uid', True),
+    'phone': ('telephoneNumber', False),
+}
+
+
+class Account:
+    '''An account in a directory information tree, made from an LDAP search result.
+
+    The search result is a tuple of (string DN and dict of byte-encoded attributes). Rather
+    than decode everything up front, an `Account` keeps the raw attributes and decodes only
+    what's asked for. The `@@biokey` JSON in the description is parsed the first time `biokey`
+    is accessed and then kept, so changes made to it stick around.
+
+    Accounts act like the dicts we used to make: `dn`, `email`, `sn`, `cn`, `uid`, `phone`,
+    `desc`, and `biokey` are all available with `account[key]` or `account.get(key)`. Search
+    with the `account` attribute set to get everything this needs.
+    '''
+    __slots__ = ('dn', '_raw', '_biokey')
+
+    def __init__(self, search_result: tuple):
+        self.dn, self._raw = search_result
+        self._biokey = None
+
+    def _first(self, attr: str) -> str | None:
+        values = self._raw.get(attr)
+        return values[0].decode('utf-8') if values else None
+
+    @property
+    def desc(self) -> str:
+        return self._first('description') or ''
+
+    @property
+    def biokey(self) -> dict:
+        if self._biokey is None:
+            biokey_match, self._biokey = _biokey_json_re.match(self.desc), {}
+            if biokey_match and biokey_match.group(3):
+                try:
+                    self._biokey = json.loads(biokey_match.group(3))
+                except json.JSONDecodeError as ex:
+                    _logger.warning('Corrupted biokey json in %s: %s', self.dn, ex.msg)
+        return self._biokey
+
+    def __getitem__(self, key: str):
+        if key == 'dn': return self.dn
+        if key == 'desc': return self.desc
+        if key == 'biokey': return self.biokey
+        attr, required = _account_fields.get(key, (None, False))
+        value = self._first(attr) if attr else None
+        if value is None: raise KeyError(key)
+        return value
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def keys(self) -> list[str]:
+        return ['dn', 'desc', 'biokey'] + [k for k, (attr, required) in _account_fields.items() if attr in self._raw]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def to_dict(self) -> dict:
+        '''Decode everything into a plain dict.'''
+        return {key: self[key] for key in self.keys()}
+
+    def __getstate__(self):
+        return self.dn, self._raw, self._biokey
+
+    def __setstate__(self, state):
+        self.dn, self._raw, self._biokey = state
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.dn}>'
+
+
+def decode_accounts(results: list) -> list[Account]:
+    '''Turn a page of LDAP search `results` into `Account`s, skipping any search references.'''
+    return [Account(result) for result in results if result[0] is not None]
@@ -0,0 +1,235 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: admission control for directories.
+
+A burst of sign-ups or password changes can put more binds and searches on a directory than
+it can handle, and then everything slows down at once. So before an operation gets a
+connection, it has to be admitted, and when the directory's already as busy as we'll let it
+get, we turn the request away at once with `DirectoryBusy` (which people see as a 503 with
+`Retry-After`) rather than pile on.
+
+Reads and writes have separate budgets, so a flood of sign-ups can't starve password reset
+lookups and vice versa. Each budget has two limits:
+
+•   Per process, at most `BIOKEY_LDAP_READ_CONCURRENCY` (or `…_WRITE_CONCURRENCY`) operations
+    on a DIT at once. Up to `BIOKEY_LDAP_QUEUE_LENGTH` more may wait in line for up to
+    `BIOKEY_LDAP_QUEUE_TIMEOUT` seconds for a turn; anyone beyond that is turned away.
+•   Across every process and host, at most `BIOKEY_LDAP_READ_RATE` (or `…_WRITE_RATE`)
+    operations a second on a DIT, enforced by a token bucket in Redis that holds up to a
+    second's worth of tokens. 0 turns this off, and so does a cache that isn't Redis or can't be
+    reached, in which case the per-process limit still holds.
+
+Each process counts what it admitted and turned away, which operators see on a DIT's page.
+'''
+
+from ._breaker import DirectoryUnavailable
+from asgiref.sync import sync_to_async
+from contextlib import asynccontextmanager, contextmanager
+from django.conf import settings
+import asyncio, hashlib, logging, math, threading, time
+
+
+_logger = logging.getLogger(__name__)
+
+READ, WRITE = 'read', 'write'
+
+_defaults = {
+    'BIOKEY_LDAP_READ_CONCURRENCY': 8,
+    'BIOKEY_LDAP_WRITE_CONCURRENCY': 2,
+    'BIOKEY_LDAP_QUEUE_LENGTH': 16,
+    'BIOKEY_LDAP_QUEUE_TIMEOUT': 2.0,  # seconds
+    'BIOKEY_LDAP_READ_RATE': 200.0,    # per second
+    'BIOKEY_LDAP_WRITE_RATE': 20.0,    # per second
+}
+_async_poll_interval = 0.01  # seconds
+
+
+def _setting(name: str):
+    return getattr(settings, name, _defaults[name])
+
+
+class DirectoryBusy(DirectoryUnavailable):
+    '''Raised instead of adding to the load on a DIT that's as busy as we'll let it get.'''
+
+    def __init__(self, slug: str, kind: str, retry_after: float):
+        super().__init__(slug, retry_after)
+        self.kind = kind
+        self.args = (f'Directory for {slug} is too busy for another {kind}; retry after {retry_after:.0f} seconds',)
+
+
+# Per-Process Limits
+# ------------------
+
+class _Limiter:
+    '''How many operations of one kind on one DIT this process has under way, and who's waiting.'''
+
+    def __init__(self):
+        self.active = self.waiting = self.admitted = self.queued = self.rejected = self.throttled = 0
+        self.condition = threading.Condition()
+
+    def _take(self, limit: int) -> bool:
+        if self.active >= limit: return False
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def acquire(self, limit: int, queue_length: int, timeout: float) -> bool:
+        with self.condition:
+            if self._take(limit): return True
+            if self.waiting >= queue_length:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            self.queued += 1
+            try:
+                if self.condition.wait_for(lambda: self.active < limit, timeout) and self._take(limit): return True
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+
+    async def aacquire(self, limit: int, queue_length: int, timeout: float) -> bool:
+        # Waiting on the condition would block the event loop, so look for a turn every so often instead
+        with self.condition:
+            if self._take(limit): return True
+            if self.waiting >= queue_length:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            self.queued += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(_async_poll_interval)
+                with self.condition:
+                    if self._take(limit): return True
+            with self.condition:
+                self.rejected += 1
+            return False
+        finally:
+            with self.condition:
+                self.waiting -= 1
+
+    def throttle(self):
+        with self.condition:
+            self.throttled += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def statistics(self) -> dict:
+        with self.condition:
+            return {
+                'active': self.active, 'waiting': self.waiting, 'admitted': self.admitted, 'queued': self.queued,
+                'rejected': self.rejected, 'throttled': self.throttled,
+            }
+
+
+_limiters: dict[tuple[str, str], _Limiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _limiter(dit, kind: str) -> _Limiter:
+    with _limiters_lock:
+        limiter = _limiters.get((dit.slug, kind))
+        if limiter is None:
+            limiter = _limiters[(dit.slug, kind)] = _Limiter()
+        return limiter
+
+
+def _limits(kind: str) -> tuple[int, int, float]:
+    concurrency = 'BIOKEY_LDAP_WRITE_CONCURRENCY' if kind == WRITE else 'BIOKEY_LDAP_READ_CONCURRENCY'
+    return _setting(concurrency), _setting('BIOKEY_LDAP_QUEUE_LENGTH'), _setting('BIOKEY_LDAP_QUEUE_TIMEOUT')
+
+
+# Cluster-Wide Rate
+# -----------------
+
+# Refill the bucket for the time since it was last touched, then take a token if there is one.
+# Redis's own clock is the only one that counts, so hosts with skewed clocks still agree.
+_token_bucket_script = '''
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens, at = tonumber(state[1]) or burst, tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - at, 0) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+_token_bucket = None
+
+
+def _bucket_key(dit, kind: str) -> str:
+    where = hashlib.sha1(f'{dit.uri}\0{dit.user_base}'.encode('utf-8')).hexdigest()
+    return f'biokey:ldap-bucket:{where}:{kind}'
+
+
+def _take_token(dit, kind: str) -> float:
+    '''Take a token from the cluster-wide bucket for `kind` operations on `dit`.
+
+    Returns 0 if we got one, or else how many seconds until there'll be one.
+    '''
+    global _token_bucket
+    rate = _setting('BIOKEY_LDAP_WRITE_RATE' if kind == WRITE else 'BIOKEY_LDAP_READ_RATE')
+    if rate <= 0: return 0.0
+    try:
+        if _token_bucket is None:
+            from django_redis import get_redis_connection
+            _token_bucket = get_redis_connection('default').register_script(_token_bucket_script)
+        return float(_token_bucket(keys=[_bucket_key(dit, kind)], args=[rate, max(rate, 1.0)]))
+    except Exception as ex:
+        _logger.warning('Cannot check the %s rate for %s in the cache due to %r; admitting', kind, dit.slug, ex)
+        return 0.0
+
+
+# Admission
+# ---------
+
+def _turn_away(dit, kind: str, retry_after: float):
+    _logger.warning('Directory for %s is too busy for another %s; turning it away', dit.slug, kind)
+    raise DirectoryBusy(dit.slug, kind, max(math.ceil(retry_after), 1))
+
+
+@contextmanager
+def admitted(dit, kind: str):
+    '''Context manager that admits an operation of `kind` (`READ` or `WRITE`) on `dit` or raises `DirectoryBusy`.'''
+    limiter = _limiter(dit, kind)
+    wait = _take_token(dit, kind)
+    if wait > 0:
+        limiter.throttle()
+        _turn_away(dit, kind, wait)
+    limit, queue_length, timeout = _limits(kind)
+    if not limiter.acquire(limit, queue_length, timeout): _turn_away(dit, kind, timeout)
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+@asynccontextmanager
+async def aadmitted(dit, kind: str):
+    '''Asynchronously admit an operation of `kind` on `dit` or raise `DirectoryBusy`; see `admitted`.'''
+    limiter = _limiter(dit, kind)
+    # Redis is synchronous and could be slow, so ask it in a thread rather than hold up the event loop;
+    # it's no database query, so any thread will do
+    wait = await sync_to_async(_take_token, thread_sensitive=False)(dit, kind)
+    if wait > 0:
+        limiter.throttle()
+        _turn_away(dit, kind, wait)
+    limit, queue_length, timeout = _limits(kind)
+    if not await limiter.aacquire(limit, queue_length, timeout): _turn_away(dit, kind, timeout)
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+def admission_statistics(dit) -> dict:
+    '''Report how admission to `dit` has gone in this process, for reads and writes.'''
+    return {kind: _limiter(dit, kind).statistics() for kind in (READ, WRITE)}
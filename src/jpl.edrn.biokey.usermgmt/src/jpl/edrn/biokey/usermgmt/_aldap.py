@@ -0,0 +1,258 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: asynchronous LDAP utilities.
+
+These are `asyncio` counterparts to the functions in `._ldap`. Rather than tie up a thread
+per directory operation, each event loop keeps one connection per server and manager DN and
+multiplexes every outstanding operation over it using python-ldap's message IDs: we start an
+operation, park a future under its message ID, and resolve the future when the event loop
+sees its result arrive on the connection's socket. A single process can therefore have
+hundreds of directory operations in flight at once.
+
+Reads and writes are routed between a DIT's primary and replicas just as in `._routing`.
+Connecting and binding still happen synchronously, but in the default executor so
+the event loop isn't held up. Connections belong to an event loop and go away with it, so this
+pays off when the loop is long-lived, as it is under ASGI.
+'''
+
+from ._accounts import Account, decode_accounts
+from ._admission import READ, WRITE, aadmitted
+from ._breaker import circuit
+from ._dits import DirectoryInformationTree
+from ._ldap import _attribute_sets, _default_cross_dit_timeout, _hash_password, _make_reset_token, _unavailable
+from ._ldap import _update_biokey_description, cross_dit_lookup_dits
+from ._metadata import aclear_reset_token, asave_reset_token
+from ._mirror import amirror_is_fresh, amirrored_accounts_by_email
+from ._pool import Timeouts
+from ._misses import aknown_miss, arecord_miss
+from ._routing import apin_to_primary, aread_uris, record_failure, record_success
+from ._tokens import can_sign_token, make_signed_token, signed_tokens_enabled
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from ldap.filter import filter_format
+import asyncio, datetime, ldap, logging, time, weakref
+
+
+_logger = logging.getLogger(__name__)
+
+_default_timeout = 30.0   # seconds
+_poll_interval   = 0.05   # seconds
+
+
+class _AsyncLDAPConnection:
+    '''A manager-bound connection on which many operations can be outstanding at once.'''
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, uri: str, bind_dn: str, password: str, timeouts: Timeouts = Timeouts()
+    ):
+        self._loop, self.uri, self.bind_dn, self.password, self.timeouts = loop, uri, bind_dn, password, timeouts
+        self._connection, self._fileno, self._poller = None, None, None
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._connecting = asyncio.Lock()
+
+    def _open(self) -> ldap.ldapobject.LDAPObject:
+        connection = ldap.initialize(self.uri)
+        if self.timeouts.connect > 0: connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeouts.connect)
+        connection.timeout = self.timeouts.bind or -1
+        connection.simple_bind_s(self.bind_dn, self.password)
+        return connection
+
+    async def _ensure_connected(self) -> ldap.ldapobject.LDAPObject:
+        async with self._connecting:
+            if self._connection is None:
+                _logger.debug('Opening asynchronous LDAP connection to %s as %s', self.uri, self.bind_dn)
+                self._connection = await self._loop.run_in_executor(None, self._open)
+                self._fileno = self._connection.fileno()
+                self._loop.add_reader(self._fileno, self._drain)
+            return self._connection
+
+    def _disconnect(self, ex: Exception):
+        '''Fail everything outstanding with `ex` and forget the connection; the next operation reconnects.'''
+        if self._fileno is not None:
+            self._loop.remove_reader(self._fileno)
+        self._connection, self._fileno = None, None
+        waiters, self._waiters = self._waiters, {}
+        for future in waiters.values():
+            if not future.done(): future.set_exception(ex)
+
+    def _drain(self):
+        '''Collect every result that's arrived and hand each one to the future waiting for it.'''
+        self._poller = None
+        while self._connection is not None and self._waiters:
+            try:
+                rtype, rdata, msgid, controls = self._connection.result3(ldap.RES_ANY, all=1, timeout=0)
+            except ldap.SERVER_DOWN as ex:
+                _logger.warning('Asynchronous LDAP connection to %s went down: %s', self.uri, ex)
+                self._disconnect(ex)
+                return
+            except ldap.LDAPError as ex:
+                info = ex.args[0] if ex.args and isinstance(ex.args[0], dict) else {}
+                future = self._waiters.pop(info.get('msgid'), None)
+                if future is None:
+                    _logger.warning('Unattributable LDAP error on asynchronous connection to %s: %s', self.uri, ex)
+                    return
+                if not future.done(): future.set_exception(ex)
+                continue
+            if rtype is None: break
+            future = self._waiters.pop(msgid, None)
+            if future is not None and not future.done():
+                future.set_result((rtype, rdata, controls))
+
+        # TLS can leave decrypted data buffered where the socket won't signal it, so keep polling
+        # while anyone is still waiting
+        if self._waiters and self._poller is None:
+            self._poller = self._loop.call_later(_poll_interval, self._drain)
+
+    async def submit(self, start, timeout: float | None = None) -> tuple:
+        '''Start an operation by calling `start` with the connection, then wait for its result.
+
+        `start` must return the message ID of the operation it started. The result is a tuple of
+        result type, result data, and response controls.
+        '''
+        connection = await self._ensure_connected()
+        try:
+            msgid = start(connection)
+        except ldap.SERVER_DOWN as ex:
+            self._disconnect(ex)
+            raise
+        future = self._loop.create_future()
+        self._waiters[msgid] = future
+        self._drain()
+        try:
+            timeout = timeout or self.timeouts.operation or getattr(settings, 'BIOKEY_LDAP_TIMEOUT', _default_timeout)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._waiters.pop(msgid, None)
+            if self._connection is not None:
+                self._connection.abandon(msgid)
+            raise ldap.TIMEOUT({'desc': f'No result for message {msgid} from {self.uri}'})
+
+
+# Each event loop gets its own connections; when a loop goes away, so do they
+_connections: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _async_connection(dit: DirectoryInformationTree, uri: str) -> _AsyncLDAPConnection:
+    '''Get the asynchronous connection to `uri`, one of the servers of `dit`, for the running event loop.'''
+    loop = asyncio.get_running_loop()
+    per_loop = _connections.setdefault(loop, {})
+    key, timeouts = (uri, dit.manager_dn), Timeouts(dit.connect_timeout, dit.bind_timeout, dit.operation_timeout)
+    connection = per_loop.get(key)
+    if connection is None or connection.password != dit.manager_password or connection.timeouts != timeouts:
+        connection = per_loop[key] = _AsyncLDAPConnection(loop, uri, dit.manager_dn, dit.manager_password, timeouts)
+    return connection
+
+
+async def _asubmit(dit: DirectoryInformationTree, uri: str, start, kind: str = READ) -> tuple:
+    '''Submit an operation to `uri`, admitted against the `kind` budget, and track how the server and breaker do.'''
+    began = time.monotonic()
+    with circuit(dit):
+        async with aadmitted(dit, kind):
+            try:
+                result = await _async_connection(dit, uri).submit(start)
+            except _unavailable as ex:
+                record_failure(uri, ex)
+                raise
+    record_success(uri, time.monotonic() - began)
+    return result
+
+
+async def _asearch(dit: DirectoryInformationTree, filterstr: str, attrlist: list[str], subject: str) -> list:
+    '''Search the best server in `dit` for reading about `subject`, failing over as needed.'''
+    uris = await aread_uris(dit, subject)
+    for index, uri in enumerate(uris):
+        try:
+            rtype, rdata, controls = await _asubmit(
+                dit, uri, lambda c: c.search_ext(dit.user_base, dit.user_scope, filterstr, attrlist)
+            )
+            return rdata
+        except _unavailable:
+            if index == len(uris) - 1: raise
+            _logger.info('Failing over asynchronous read from %s to %s', uri, uris[index + 1])
+
+
+async def _amodify(dit: DirectoryInformationTree, dn: str, modlist: list, subject: str):
+    '''Modify `dn` on the primary of `dit`, then pin reads about `subject` there.'''
+    await _asubmit(dit, dit.uri, lambda c: c.modify_ext(dn, modlist), WRITE)
+    await apin_to_primary(dit, subject)
+
+
+async def aget_account_by_uid(
+    uid: str, dit: DirectoryInformationTree, attribute_set: str = 'account'
+) -> Account | None:
+    _logger.info('Asynchronously looking up account by uid «%s»', uid)
+    if await aknown_miss(dit, 'uid', uid): return None
+    results = await _asearch(dit, filter_format('(uid=%s)', [uid]), _attribute_sets[attribute_set], uid)
+    accounts = decode_accounts(results)
+    if not accounts: await arecord_miss(dit, 'uid', uid)
+    return accounts[0] if accounts else None
+
+
+async def aget_accounts_by_email(email: str, dit: DirectoryInformationTree) -> list[Account]:
+    _logger.info('Asynchronously looking up accounts by email «%s»', email)
+    if await aknown_miss(dit, 'mail', email): return []
+    if await amirror_is_fresh(dit): return await amirrored_accounts_by_email(email, dit)
+    results = await _asearch(dit, filter_format('(mail=%s)', [email]), _attribute_sets['account'], email)
+    accounts = decode_accounts(results)
+    if not accounts: await arecord_miss(dit, 'mail', email)
+    return accounts
+
+
+async def aget_accounts_by_email_everywhere(
+    email: str, dit: DirectoryInformationTree
+) -> list[tuple[DirectoryInformationTree, list[Account]]]:
+    '''Asynchronously look up the accounts with `email` in every DIT at once; see `get_accounts_by_email_everywhere`.'''
+    timeout = getattr(settings, 'BIOKEY_CROSS_DIT_TIMEOUT', _default_cross_dit_timeout)
+    dits = await sync_to_async(cross_dit_lookup_dits)(dit)
+    results = await asyncio.gather(
+        *(asyncio.wait_for(aget_accounts_by_email(email, i), timeout) for i in dits), return_exceptions=True
+    )
+    found = []
+    for i, result in zip(dits, results):
+        if isinstance(result, asyncio.TimeoutError):
+            _logger.warning('Gave up looking up accounts by email in %s after %.1f seconds', i.slug, timeout)
+        elif isinstance(result, Exception):
+            _logger.warning('Cannot look up accounts by email in %s: %r', i.slug, result)
+        elif result:
+            found.append((i, result))
+    return found
+
+
+async def agenerate_reset_token(
+    account: Account, expiration: datetime.datetime, dit: DirectoryInformationTree
+) -> str:
+    _logger.info(
+        'Asynchronously generating a reset token for %s expiring at %s in %s', account['dn'], expiration, dit.slug
+    )
+    if signed_tokens_enabled():
+        if not can_sign_token(account):
+            account = await aget_account_by_uid(account['uid'], dit, 'reset') or account
+        if can_sign_token(account): return make_signed_token(dit.slug, account, expiration)
+        _logger.warning('Cannot read the userPassword of %s; issuing a classic reset token instead', account['dn'])
+    token = _make_reset_token(account['dn'], expiration)
+    await asave_reset_token(dit, account, token, expiration)
+    return token
+
+
+async def areset_password_in_dit(dit: DirectoryInformationTree, uid: str, new_password: str):
+    '''Asynchronously set the password for `uid` to `new_password` and clear any reset tokens.'''
+    _logger.info('Asynchronously resetting password for %s in %s and clearing reset info', uid, dit.slug)
+
+    # Read from the primary so we don't base the new description on a stale replica
+    filterstr = filter_format('(uid=%s)', [uid])
+    rtype, rdata, controls = await _asubmit(
+        dit, dit.uri, lambda c: c.search_ext(dit.user_base, dit.user_scope, filterstr, _attribute_sets['account']),
+        WRITE
+    )
+    accounts = decode_accounts(rdata)
+    account = accounts[0] if accounts else None
+    if not account:
+        raise ValueError(f"uid {uid} doesn't exist in {dit.slug}")
+    biokey = account.get('biokey', {})
+    modlist = [(ldap.MOD_REPLACE, 'userPassword', [_hash_password(new_password)])]
+    if 'reset_token' in biokey or 'reset_time' in biokey:
+        for key in ('reset_token', 'reset_time'):
+            biokey.pop(key, None)
+        modlist.insert(0, (ldap.MOD_REPLACE, 'description', [_update_biokey_description(account, biokey)]))
+    await _amodify(dit, account['dn'], modlist, uid)
+    await aclear_reset_token(dit, uid)
@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: circuit breakers for directories.
+
+When a DIT's directory hangs or goes away, waiting on it (even with timeouts) ties up a worker
+per request, and soon the whole site stalls. So each DIT has a circuit breaker. It starts
+closed and lets everything through. After `BIOKEY_LDAP_BREAKER_THRESHOLD` failures in a row
+(servers down, refusing connections, or timing out), it opens: for the next
+`BIOKEY_LDAP_BREAKER_COOLDOWN` seconds every operation on the DIT fails at once with
+`DirectoryUnavailable`, which people see as a "directory temporarily unavailable" page rather
+than a spinning browser. After the cooldown it's half-open: one operation goes through as a
+probe. If it works, the breaker closes; if not, it opens for another cooldown. Anything else
+that arrives during the probe fails at once.
+
+Only failures to reach a server count. An error like "no such object" means the server is
+answering just fine, so it counts as a success.
+
+Like server health in `._routing`, breakers are per process. Staff see their state on a DIT's
+page.
+'''
+
+from contextlib import contextmanager
+from django.conf import settings
+import ldap, logging, threading, time
+
+
+_logger = logging.getLogger(__name__)
+
+_default_threshold = 5
+_default_cooldown  = 30.0  # seconds
+
+# Errors that mean a server is unavailable rather than that the request was bad
+_unavailable = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class DirectoryUnavailable(Exception):
+    '''Raised instead of trying a DIT whose circuit breaker is open.'''
+
+    def __init__(self, slug: str, retry_after: float):
+        super().__init__(f'Directory for {slug} is temporarily unavailable; retry after {retry_after:.0f} seconds')
+        self.slug, self.retry_after = slug, retry_after
+
+
+class _Breaker:
+    '''The circuit breaker for one DIT.'''
+    __slots__ = ('state', 'failures', 'opened_at', 'probing', 'trips', 'rejections')
+
+    def __init__(self):
+        self.state, self.failures, self.opened_at, self.probing = CLOSED, 0, 0.0, False
+        self.trips = self.rejections = 0
+
+
+_breakers: dict[str, _Breaker] = {}
+_lock = threading.Lock()
+
+
+def _threshold() -> int:
+    return getattr(settings, 'BIOKEY_LDAP_BREAKER_THRESHOLD', _default_threshold)
+
+
+def _cooldown() -> float:
+    return getattr(settings, 'BIOKEY_LDAP_BREAKER_COOLDOWN', _default_cooldown)
+
+
+def _breaker(dit) -> _Breaker:
+    breaker = _breakers.get(dit.slug)
+    if breaker is None:
+        breaker = _breakers[dit.slug] = _Breaker()
+    return breaker
+
+
+def _admit(dit) -> bool:
+    '''Let an operation on `dit` through or raise `DirectoryUnavailable`; return True if it's the probe.'''
+    now, cooldown = time.monotonic(), _cooldown()
+    with _lock:
+        breaker = _breaker(dit)
+        if breaker.state == CLOSED: return False
+        if breaker.state == OPEN and now - breaker.opened_at >= cooldown:
+            breaker.state = HALF_OPEN
+        if breaker.state == HALF_OPEN and not breaker.probing:
+            breaker.probing = True
+            _logger.info('Probing the directory for %s with its breaker half-open', dit.slug)
+            return True
+        breaker.rejections += 1
+        retry_after = max(cooldown - (now - breaker.opened_at), 1.0)
+    raise DirectoryUnavailable(dit.slug, retry_after)
+
+
+def _succeeded(dit):
+    with _lock:
+        breaker = _breaker(dit)
+        if breaker.state != CLOSED:
+            _logger.warning('Directory for %s is back; closing its breaker', dit.slug)
+        breaker.state, breaker.failures, breaker.probing = CLOSED, 0, False
+
+
+def _release_probe(dit):
+    with _lock:
+        _breaker(dit).probing = False
+
+
+def _failed(dit, ex: Exception):
+    with _lock:
+        breaker = _breaker(dit)
+        breaker.failures += 1
+        if breaker.state == HALF_OPEN or breaker.failures >= _threshold():
+            if breaker.state == CLOSED: breaker.trips += 1
+            breaker.state, breaker.opened_at, breaker.probing = OPEN, time.monotonic(), False
+            _logger.warning(
+                'Directory for %s failed %d times in a row (latest: %s); failing fast for %.1f seconds',
+                dit.slug, breaker.failures, ex, _cooldown()
+            )
+
+
+@contextmanager
+def circuit(dit):
+    '''Context manager that runs directory operations on `dit` through its circuit breaker.
+
+    It raises `DirectoryUnavailable` right away if the breaker's open, and otherwise notes how
+    the operations in its body go.
+    '''
+    probe = _admit(dit)
+    try:
+        yield
+    except _unavailable as ex:
+        _failed(dit, ex)
+        raise
+    except ldap.LDAPError:
+        _succeeded(dit)  # The server answered, if only to say no
+        raise
+    except BaseException:
+        # We never got an answer either way, so let the next operation be the probe
+        if probe: _release_probe(dit)
+        raise
+    _succeeded(dit)
+
+
+def breaker_state(dit) -> dict:
+    '''Report the state of the breaker of `dit` in this process.'''
+    now, cooldown = time.monotonic(), _cooldown()
+    with _lock:
+        breaker = _breaker(dit)
+        state = breaker.state
+        if state == OPEN and now - breaker.opened_at >= cooldown: state = HALF_OPEN
+        return {
+            'state': state, 'failures': breaker.failures, 'trips': breaker.trips, 'rejections': breaker.rejections,
+            'retry_after': max(cooldown - (now - breaker.opened_at), 0.0) if state == OPEN else 0.0,
+        }
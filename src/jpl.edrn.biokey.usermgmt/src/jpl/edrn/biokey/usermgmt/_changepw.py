@@ -3,8 +3,8 @@
 '''🧬🔑🕴️ BioKey user management: change password form.'''
 
 from . import PACKAGE_NAME
+from ._dedupe import deduplicate
 from ._forms import AbstractForm, AbstractFormPage
-from ._ldap import verify_password
 from ._passwords import check_complexity
 from .constants import MAX_UID_LENGTH, MAX_PASSWORD_LENGTH, GENERIC_FORM_TEMPLATE
 from captcha.fields import ReCaptchaField
@@ -13,6 +13,7 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import render
+import ldap
 
 
 class PasswordChangeForm(AbstractForm):
@@ -44,25 +45,27 @@ class PasswordChangeForm(AbstractForm):
         n, c = cleaned_data.get('new_password'), cleaned_data.get('confirm_new_password')
         if n != c: raise ValidationError('New passwords do not match')
 
-        uid, pw = cleaned_data.get('uid'), cleaned_data.get('current_password')
-        if not verify_password(self.page.get_parent().specific, uid, pw):
-            raise ValidationError('Username and/or password are invalid')
-
+        # The current password gets checked by binding with it when we change it, in `serve`
         return cleaned_data
 
 
 class PasswordChangeFormPage(AbstractFormPage):
+    @deduplicate
     def serve(self, request: HttpRequest) -> HttpResponse:
         if request.method == 'POST':
             form = PasswordChangeForm(request.POST, page=self)
             if form.is_valid():
                 dit = self.get_parent().specific
-                uid, newpw = form.cleaned_data['uid'], form.cleaned_data['new_password']
-                template = dit.change_password(uid, newpw)
-                if not template:
-                    template = PACKAGE_NAME + '/password-changed.html'
-                params = {'page': self, 'uid': uid, 'consortium': dit.slug.upper()}
-                return render(request, template, params)
+                uid, pw = form.cleaned_data['uid'], form.cleaned_data['current_password']
+                try:
+                    template = dit.change_own_password(uid, pw, form.cleaned_data['new_password'])
+                except ldap.INVALID_CREDENTIALS:
+                    form.add_error(None, 'Username and/or password are invalid')
+                else:
+                    if not template:
+                        template = PACKAGE_NAME + '/password-changed.html'
+                    params = {'page': self, 'uid': uid, 'consortium': dit.slug.upper()}
+                    return render(request, template, params)
         else:
             form = PasswordChangeForm(page=self)
         self._bootstrap(form)
@@ -0,0 +1,146 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: coalescing identical directory reads.
+
+When a reset email goes out to a mailing list, or an outage elsewhere has everyone retrying,
+lots of requests ask the directory the very same question at the very same moment. Rather
+than each borrowing a connection and searching, the first to ask becomes the leader and does
+the search; everyone who asks the same question while it's under way waits for it and shares
+its answer (or its exception). Once the answer is in, the next request asks afresh, so nothing
+is cached beyond the one search that was already in flight.
+
+That's within one process. With `BIOKEY_LDAP_COALESCE_CLUSTER` on, leaders also claim the
+question in the shared cache (which is Redis), and other processes and hosts asking it wait up
+to `BIOKEY_LDAP_COALESCE_WAIT` seconds for the leader's answer to show up there. If the leader
+fails, takes too long, or the cache is unreachable, they search for themselves.
+
+Each process counts how many questions it actually sent to the directory, how many it
+answered by joining a search in the same process, and how many by picking up another
+process's answer. Operators see these on a DIT's page.
+
+Answers shared through the cache are pickled into Redis for a moment, so searches whose
+answers hold secrets, such as password hashes, pass `cluster=False` and only coalesce within
+the process.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+import copy, hashlib, logging, threading, time, uuid
+
+
+_logger = logging.getLogger(__name__)
+
+_default_wait  = 2.0   # seconds
+_poll_interval = 0.02  # seconds between looks for another process's answer
+
+
+class _Flight:
+    '''A search under way and, once it's done, its outcome.'''
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done, self.result, self.exception = threading.Event(), None, None
+
+
+class _Statistics:
+    '''How coalescing has gone for one DIT in this process.'''
+    __slots__ = ('searched', 'joined', 'shared')
+
+    def __init__(self):
+        self.searched, self.joined, self.shared = 0, 0, 0
+
+
+_flights: dict[str, _Flight] = {}
+_statistics: dict[str, _Statistics] = {}
+_lock = threading.Lock()
+
+
+def _count(dit, what: str):
+    with _lock:
+        statistics = _statistics.setdefault(dit.slug, _Statistics())
+        setattr(statistics, what, getattr(statistics, what) + 1)
+
+
+def _flight_key(dit, question: str) -> str:
+    '''Make the key for `question` in `dit`; like pins, it's by where users live, not which page asks.'''
+    where = hashlib.sha1(f'{dit.uri}\0{dit.user_base}'.encode('utf-8')).hexdigest()
+    what = hashlib.sha1(question.lower().encode('utf-8')).hexdigest()
+    return f'biokey:ldap-flight:{where}:{what}'
+
+
+def _cluster_search(dit, key: str, search):
+    '''Call `search` unless another process is already doing so, in which case wait for its answer.'''
+    wait = getattr(settings, 'BIOKEY_LDAP_COALESCE_WAIT', _default_wait)
+    flight = uuid.uuid4().hex
+    try:
+        leader = cache.add(key, flight, wait)
+        if not leader: flight = cache.get(key)
+    except Exception as ex:
+        _logger.warning('Cannot coalesce reads through the cache due to %r; searching on our own', ex)
+        leader, flight = True, None
+
+    if not leader and flight:
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            try:
+                answer = cache.get(f'{key}:{flight}')
+                if answer is not None:
+                    _count(dit, 'shared')
+                    return answer[0]
+                if cache.get(key) != flight: break  # The leader gave up without an answer
+            except Exception as ex:
+                _logger.warning('Cannot get a coalesced answer due to %r; searching on our own', ex)
+                break
+            time.sleep(_poll_interval)
+
+    _count(dit, 'searched')
+    result = search()
+    if leader and flight:
+        try:
+            # Wrapped in a tuple so an answer of None is distinguishable from no answer yet
+            cache.set(f'{key}:{flight}', (result,), wait)
+            cache.delete(key)
+        except Exception as ex:
+            _logger.warning('Cannot share a coalesced answer due to %r', ex)
+    return result
+
+
+def coalesced(dit, question: str, search, cluster: bool = True):
+    '''Get the answer to `question` about `dit` by calling `search`, sharing it with anyone asking at the same time.
+
+    The `question` must be the same for any two searches that would give the same answer, such
+    as the kind of lookup, the attributes wanted, and the uid or email address. Callers each get
+    their own copy of a list answer, but the items in it are shared, so don't change them. With
+    `cluster` false, the answer's never shared through the cache, even if cluster mode is on.
+    '''
+    key = _flight_key(dit, question)
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader: flight = _flights[key] = _Flight()
+    if not leader:
+        _count(dit, 'joined')
+        flight.done.wait()
+        if flight.exception is not None: raise flight.exception
+        return copy.copy(flight.result)
+    try:
+        if cluster and getattr(settings, 'BIOKEY_LDAP_COALESCE_CLUSTER', False):
+            flight.result = _cluster_search(dit, key, search)
+        else:
+            _count(dit, 'searched')
+            flight.result = search()
+        return flight.result
+    except BaseException as ex:
+        flight.exception = ex
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def coalescing_statistics(dit) -> dict:
+    '''Report how coalescing reads has gone for `dit` in this process.'''
+    with _lock:
+        statistics = _statistics.get(dit.slug, _Statistics())
+        return {'searched': statistics.searched, 'joined': statistics.joined, 'shared': statistics.shared}
@@ -0,0 +1,101 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: de-duplicating repeated form submissions.
+
+People double-click "Submit", and a slow answer makes them click again. Each click used to run
+the whole sign-up, reminder, or password change again, making accounts like `jsmith` and
+`jsmith123` or sending the same reset email twice. So the `serve` methods of those form pages
+are wrapped with `deduplicate`. It fingerprints each POST by the page, the browser's CSRF
+cookie, and the fields submitted (less the CSRF and reCAPTCHA tokens, which change from try to
+try). The first submission with a fingerprint does the work; anyone repeating it within
+`BIOKEY_DEDUPE_TTL` seconds gets the first one's response instead, waiting up to
+`BIOKEY_DEDUPE_WAIT` seconds for it if it's still under way.
+
+Fingerprints are keyed hashes, so passwords in the forms never reach the cache in a form anyone
+could guess from. If the first submission fails, or the cache can't be reached, or the wait
+runs out, the repeat does the work itself; better that than no answer at all.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+import functools, hashlib, hmac, logging, time
+
+
+_logger = logging.getLogger(__name__)
+
+_default_ttl   = 30    # seconds
+_default_wait  = 10.0  # seconds
+_poll_interval = 0.05  # seconds between looks for the first submission's response
+_in_flight     = 'in-flight'
+_ignored       = frozenset(('csrfmiddlewaretoken', 'g-recaptcha-response'))
+
+
+def _fingerprint(page, request: HttpRequest) -> str:
+    message = [str(page.pk), request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')]
+    for name in sorted(request.POST.keys()):
+        if name in _ignored: continue
+        message.extend([name] + request.POST.getlist(name))
+    digest = hmac.new(settings.SECRET_KEY.encode('utf-8'), '\0'.join(message).encode('utf-8'), hashlib.sha256)
+    return f'biokey:submission:{digest.hexdigest()}'
+
+
+def _freeze(response: HttpResponse) -> tuple | None:
+    '''Turn `response` into something to keep in the cache, or None if it's not worth repeating.'''
+    if response.streaming or response.status_code >= 500: return None
+    return response.status_code, response.content, dict(response.headers)
+
+
+def _thaw(frozen: tuple) -> HttpResponse:
+    status, content, headers = frozen
+    return HttpResponse(content, status=status, headers=headers)
+
+
+def _await_first(key: str, wait: float) -> HttpResponse | None:
+    '''Wait up to `wait` seconds for the first submission with `key` to finish; return its response if it does.'''
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        value = cache.get(key)
+        if value is None: return None  # The first one failed, or it wasn't worth keeping
+        if value != _in_flight: return _thaw(value)
+        time.sleep(_poll_interval)
+    return None
+
+
+def deduplicate(serve):
+    '''Decorate a form page's `serve` so repeated POSTs of the same form get the first one's response.'''
+
+    @functools.wraps(serve)
+    def wrapper(page, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        ttl = getattr(settings, 'BIOKEY_DEDUPE_TTL', _default_ttl)
+        if request.method != 'POST' or ttl <= 0: return serve(page, request, *args, **kwargs)
+        key = _fingerprint(page, request)
+        try:
+            if not cache.add(key, _in_flight, ttl):
+                _logger.info('Repeated submission to %s; answering with the first response', request.path)
+                response = _await_first(key, getattr(settings, 'BIOKEY_DEDUPE_WAIT', _default_wait))
+                if response is not None: return response
+                _logger.info('First submission to %s has no response for us; handling this one', request.path)
+        except Exception as ex:
+            _logger.warning('Cannot de-duplicate submissions in the cache due to %r; handling this one', ex)
+            return serve(page, request, *args, **kwargs)
+
+        try:
+            response = serve(page, request, *args, **kwargs)
+        except BaseException:
+            try:
+                cache.delete(key)
+            except Exception:
+                pass
+            raise
+        try:
+            frozen = _freeze(response)
+            if frozen is None:
+                cache.delete(key)
+            else:
+                cache.set(key, frozen, ttl)
+        except Exception as ex:
+            _logger.warning('Cannot keep the response to %s for repeats due to %r', request.path, ex)
+        return response
+
+    return wrapper
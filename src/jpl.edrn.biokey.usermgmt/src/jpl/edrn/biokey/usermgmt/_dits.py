@@ -6,13 +6,21 @@ Note: we cannot import ._ldap up top here as it'll result in a circular dependen
 '''
 
 from . import PACKAGE_NAME
-from ._paths import make_pwreset_url
+from ._accounts import Account
+from ._admission import admission_statistics
+from ._breaker import breaker_state
+from ._coalesce import coalescing_statistics
+from ._metadata import outstanding_resets
+from ._paths import make_pwreset_url, request_site, site_base_url
+from ._pool import pool_statistics
+from ._routing import server_health
 from ._settings import EmailSettings, PasswordSettings
 from ._users import PendingUser
 from .constants import MAX_EMAIL_LENGTH
 from .tasks import send_email
 from django import forms
-from django.core.validators import URLValidator
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator, URLValidator
 from django.db import models
 from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
 from django.utils import timezone
@@ -24,6 +32,18 @@ import ldap, logging, humanize, datetime
 
 _logger = logging.getLogger(__name__)
 
+
+def _validate_replica_uris(value: str):
+    '''Make sure every non-blank line of `value` is an "ldap:" or "ldaps:" URL.'''
+    validator = URLValidator(schemes=['ldap', 'ldaps'])
+    for line in value.splitlines():
+        if not line.strip(): continue
+        try:
+            validator(line.strip())
+        except ValidationError:
+            raise ValidationError(f'«{line.strip()}» is not an "ldap:" or "ldaps:" URL')
+
+
 _scope_choices = {
     ldap.SCOPE_BASE: 'base',
     ldap.SCOPE_ONELEVEL: 'one-level',
@@ -71,6 +91,19 @@ You can visit {url} to change the password for "{uid}" (if you know it), or rese
 
 Note that if you did not request this, then simply ignore this email.
 
+Thank you.
+'''
+
+    _requested_uids = '''Hello!
+
+Someone, perhaps you, asked for the usernames of the accounts that go with this email address. We found these:
+
+{accounts}
+
+You can visit the address next to each one to change its password (if you know it), or reset the password (if forgotten).
+
+Note that if you did not request this, then simply ignore this email.
+
 Thank you.
 '''
 
@@ -116,12 +149,28 @@ We regret any inconvenience.
         blank=False, max_length=200, help_text='URI to the LDAP server as an "ldap:" or "ldaps: URL',
         validators=[URLValidator(schemes=['ldap', 'ldaps'])]
     )
+    replica_uris = models.TextField(
+        blank=True, default='', validators=[_validate_replica_uris],
+        help_text='URIs to read-only replicas of the LDAP server, one per line; reads are spread across these'
+    )
     manager_dn = models.CharField(
         blank=False, max_length=200, help_text='DN of the manager of the server', default='uid=admin,ou=system'
     )
     manager_password = models.CharField(
         blank=False, max_length=80, help_text='Password of manager DN', default='password'
     )
+    connect_timeout = models.FloatField(
+        default=5.0, validators=[MinValueValidator(0.0)],
+        help_text='Seconds to wait to connect to a server before giving up on it (0 to wait forever)'
+    )
+    bind_timeout = models.FloatField(
+        default=5.0, validators=[MinValueValidator(0.0)],
+        help_text='Seconds to wait for a server to accept the manager DN (0 to wait forever)'
+    )
+    operation_timeout = models.FloatField(
+        default=30.0, validators=[MinValueValidator(0.0)],
+        help_text='Seconds to wait for the results of a search or change (0 to wait forever)'
+    )
     user_base = models.CharField(
         blank=False, max_length=600, help_text='Base DN where to find users', default='ou=users,o=organization'
     )
@@ -149,6 +198,10 @@ We regret any inconvenience.
         blank=False, help_text="Email template for end users' to recover forgotten usernames, not forgotten passwords",
         default=_requested_uid
     )
+    forgotten_uids_template = models.TextField(
+        blank=False, default=_requested_uids,
+        help_text='Email template for end users to recover forgotten usernames when more than one account was found',
+    )
     help_address = models.EmailField(
         blank=False, max_length=MAX_EMAIL_LENGTH, help_text='Email address if users need help',
         default='help@email.address',
@@ -173,12 +226,20 @@ We regret any inconvenience.
         FieldPanel('page_title'),
         FieldPanel('logo'),
         FieldPanel('uri'),
+        FieldPanel('replica_uris'),
         MultiFieldPanel(heading='LDAP Manager', children=(
             FieldRowPanel(children=(
                 FieldPanel('manager_dn'),
                 FieldPanel('manager_password', widget=forms.PasswordInput),
             )),
         )),
+        MultiFieldPanel(heading='Timeouts', children=(
+            FieldRowPanel(children=(
+                FieldPanel('connect_timeout'),
+                FieldPanel('bind_timeout'),
+                FieldPanel('operation_timeout'),
+            )),
+        )),
         MultiFieldPanel(heading='Bases and Scopes', children=(
             FieldRowPanel((
                 FieldPanel('user_base'),
@@ -194,6 +255,7 @@ We regret any inconvenience.
         FieldPanel('creation_email_template'),
         FieldPanel('reset_request_email_template'),
         FieldPanel('forgotten_uid_template'),
+        FieldPanel('forgotten_uids_template'),
         FieldPanel('approval_template'),
         FieldPanel('rejection_template'),
         FieldPanel('creation_notification_template'),
@@ -231,6 +293,15 @@ We regret any inconvenience.
         if forgotten: context['forgotten'] = forgotten.url
         context['pending_users'] = self.pending_users.all().order_by('created_at')
         context['have_pending_users'] = context['pending_users'].count() > 0
+        if request.user.is_staff:
+            servers = server_health(self)
+            uris = {i['uri'] for i in servers}
+            context['ldap_pools'] = [i for i in pool_statistics() if i['uri'] in uris]
+            context['ldap_servers'] = servers
+            context['outstanding_resets'] = outstanding_resets(self)
+            context['coalescing'] = coalescing_statistics(self)
+            context['breaker'] = breaker_state(self)
+            context['admission'] = admission_statistics(self)
         return context
 
     def accept_pending_user(self, pending: PendingUser, request: HttpRequest):
@@ -270,15 +341,22 @@ We regret any inconvenience.
         pending.delete()
         self.refresh_from_db()
 
-    def send_reset_email(self, account: dict, request: HttpRequest):
+    def send_reset_email(
+        self, account: Account, request: HttpRequest | None = None, site: Site | None = None,
+        base_url: str | None = None
+    ):
+        '''Email `account` a link to reset its password.
+
+        As with `create_account`, without a `request` give the `site` and `base_url` for the link.
+        '''
         # Generate a timer and a token
-        site = Site.find_for_request(request)
+        site = site or request_site(request)
         email, pwd = EmailSettings.for_site(site), PasswordSettings.for_site(site)
         window, now = datetime.timedelta(minutes=pwd.reset_window), timezone.now()
         expiration = now + window
         from ._ldap import generate_reset_token
         token = generate_reset_token(account, expiration, self)
-        link = make_pwreset_url(self.slug, account['uid'], token, request)
+        link = make_pwreset_url(self.slug, account['uid'], token, request, base_url)
         message = self.reset_request_email_template.format(
             uid=account['uid'], natural_delta=humanize.naturaldelta(window), link=link, 
             expiration_time=expiration.ctime(), url=self.get_full_url(request),
@@ -288,18 +366,25 @@ We regret any inconvenience.
             attachment=None, delay=0
         )
 
-    def create_account(self, fn: str, ln: str, phone: str, email: str, request: HttpRequest) -> str:
-        from ._ldap import create_new_account, generate_reset_token, get_account_by_uid
-        site = Site.find_for_request(request)
-        account_name = create_new_account(fn, ln, phone, email, self)
-        PendingUser(uid=account_name, fn=fn, ln=ln, phone=phone, email=email, page=self).save()
-        account = get_account_by_uid(account_name, self)
+    def create_account(
+        self, fn: str, ln: str, phone: str, email: str, request: HttpRequest | None = None,
+        site: Site | None = None, base_url: str | None = None
+    ) -> str:
+        '''Create a pending account for `fn` `ln`, email them and the approvers, and return its name.
+
+        Settings and links are for the site of `request`. Without one, as in a Celery task, give
+        the `site` and the `base_url` that `site_base_url` made while there was a request.
+        '''
+        from ._ldap import provision_account
+        site, base_url = site or request_site(request), base_url or site_base_url(request)
         email_settings, pwd_settings = EmailSettings.for_site(site), PasswordSettings.for_site(site)
         window, now = datetime.timedelta(minutes=pwd_settings.reset_window), timezone.now()
         expiration = now + window
+        account, token = provision_account(fn, ln, phone, email, expiration, self)
+        account_name = account['uid']
+        PendingUser(uid=account_name, fn=fn, ln=ln, phone=phone, email=email, page=self).save()
         consortium = self.slug.upper()
-        token = generate_reset_token(account, expiration, self)
-        link = make_pwreset_url(self.slug, account_name, token, request)
+        link = make_pwreset_url(self.slug, account_name, token, base_url=base_url)
         message = self.creation_email_template.format(
             uid=account_name, consortium=self.title, natural_delta=humanize.naturaldelta(window), link=link,
             expiration_time=expiration.ctime(), url=self.get_full_url(request)
@@ -317,13 +402,38 @@ We regret any inconvenience.
         )
         return account_name
 
-    def send_uid_reminders(self, accounts: list[dict], request: HttpRequest):
-        delay, consortium, settings = 0, self.slug.upper(), EmailSettings.for_site(Site.find_for_request(request))
-        subject = f'Your {consortium} account username'
-        for account in accounts:
-            email, uid = account['email'], account['uid']
-            message = self.forgotten_uid_template.format(consortium=consortium, url=self.get_full_url(request), uid=uid)
-            send_email(settings.from_address, [email], subject, message, attachment=None, delay=delay)
+    def send_uid_reminders(
+        self, accounts: list[Account], request: HttpRequest | None = None,
+        elsewhere: list[tuple['DirectoryInformationTree', list[Account]]] | None = None, site: Site | None = None
+    ):
+        '''Email the usernames of `accounts` in this DIT, and those found `elsewhere`, to their owners.
+
+        `elsewhere` has accounts found in other DITs paired with their DITs. Each address gets a
+        single message: our `forgotten_uid_template` if there's just the one account, or our
+        `forgotten_uids_template` listing them all if there are more. Without a `request`, give the
+        `site` whose email settings to use.
+        '''
+        delay, settings = 0, EmailSettings.for_site(site or request_site(request))
+        by_address = {}
+        for dit, found in [(self, accounts)] + list(elsewhere or []):
+            for account in found:
+                by_address.setdefault(account['email'].lower(), []).append((dit, account))
+        for matches in by_address.values():
+            if len(matches) == 1:
+                dit, account = matches[0]
+                consortium = dit.slug.upper()
+                subject = f'Your {consortium} account username'
+                message = dit.forgotten_uid_template.format(
+                    consortium=consortium, url=dit.get_full_url(request), uid=account['uid']
+                )
+            else:
+                subject = 'Your account usernames'
+                listing = '\n'.join(
+                    f'• {account["uid"]} for {dit.slug.upper()}: {dit.get_full_url(request)}'
+                    for dit, account in matches
+                )
+                message = self.forgotten_uids_template.format(accounts=listing)
+            send_email(settings.from_address, [matches[0][1]['email']], subject, message, attachment=None, delay=delay)
             delay += 2
 
     def change_password(self, uid: str, new_password: str) -> str | None:
@@ -336,6 +446,22 @@ We regret any inconvenience.
         change_password(self, uid, new_password)
         return None
 
+    def change_own_password(self, uid: str, current_password: str, new_password: str) -> str | None:
+        '''Change the password for `uid` from `current_password` to `new_password` as `uid` itself.
+
+        Return None if it worked, or the name of a template explaining why it wasn't changed. A
+        wrong `current_password` raises `ldap.INVALID_CREDENTIALS`.
+        '''
+        from ._ldap import change_own_password
+        return change_own_password(self, uid, current_password, new_password, self.password_change_refusal)
+
+    def password_change_refusal(self, account: Account) -> str | None:
+        '''Tell if `account` can't change its password here by returning the name of a template saying why.
+
+        This implementation always returns None.
+        '''
+        return None
+
 
 class EDRNDirectoryInformationTree(DirectoryInformationTree):
     page_description = 'A data information tree with users backed by the DMCC'
@@ -360,7 +486,10 @@ Thank you.
         FieldPanel('dmcc_managed_email_template'),
     ]
 
-    def send_reset_email(self, account: dict, request: HttpRequest):
+    def send_reset_email(
+        self, account: Account, request: HttpRequest | None = None, site: Site | None = None,
+        base_url: str | None = None
+    ):
         '''Send a password reset email for EDRN.
 
         If it's a "secure" site account, send the message that directs people to 
@@ -379,11 +508,16 @@ Thank you.
             send_email(settings.from_address, [to_address], 'EDRN Password Reset', message, attachment=None, delay=0)
         else:
             # It's one of "our own"
-            super().send_reset_email(account, request)
+            super().send_reset_email(account, request, site, base_url)
 
     def change_password(self, uid: str, new_password: str) -> str | None:
         from ._ldap import get_account_by_uid
         account = get_account_by_uid(uid, self)
+        template = self.password_change_refusal(account) if account is not None else None
+        return template or super().change_password(uid, new_password)
+
+    def password_change_refusal(self, account: Account) -> str | None:
+        '''Accounts imported from the DMCC have their passwords changed at the DMCC.'''
         if account.get('desc', '').startswith('imported via EDRN dmccsync'):
             return PACKAGE_NAME + '/dmcc-password-change-required.html'
-        return super().change_password(uid, new_password)
+        return None
@@ -4,16 +4,23 @@
 
 
 from . import PACKAGE_NAME
+from ._dedupe import deduplicate
+from ._aldap import aget_account_by_uid, aget_accounts_by_email, aget_accounts_by_email_everywhere
 from ._forms import AbstractForm, AbstractFormPage
-from ._ldap import get_account_by_uid, get_accounts_by_email
+from ._ldap import get_account_by_uid, get_accounts_by_email, get_accounts_by_email_everywhere
 from ._passwords import check_complexity
+from ._paths import request_site, site_base_url
 from .constants import MAX_UID_LENGTH, MAX_EMAIL_LENGTH, MAX_PASSWORD_LENGTH, GENERIC_FORM_TEMPLATE
+from .tasks import forgotten_details
+from asgiref.sync import async_to_sync, sync_to_async
 from captcha.fields import ReCaptchaField
 from django import forms
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import render
+from wagtail.models import Site
 
 
 class ForgottenDetailsForm(AbstractForm):
@@ -37,35 +44,101 @@ class ForgottenDetailsForm(AbstractForm):
         return cleaned_data
 
 
+def _split_found(dit, found: list[tuple]) -> tuple[list, list[tuple]]:
+    '''Split accounts `found` across DITs into those in `dit` and those elsewhere.'''
+    here = [accounts for i, accounts in found if i.pk == dit.pk]
+    return (here[0] if here else []), [(i, accounts) for i, accounts in found if i.pk != dit.pk]
+
+
+def send_forgotten_details(
+    dit, uid: str, email: str, request: HttpRequest | None = None, site: Site | None = None,
+    base_url: str | None = None
+):
+    '''Email a password reset link for `uid`, or reminders of the user IDs for `email`, from `dit`.
+
+    Without a `request`, as in the `.tasks.forgotten_details` Celery task, give the `site` and the
+    `base_url` that `site_base_url` made while there was one.
+    '''
+    if uid:
+        account = get_account_by_uid(uid, dit, 'reset')
+        if account:
+            dit.send_reset_email(account, request, site, base_url)
+    else:
+        # With cross-DIT lookups, people who came to the wrong consortium's page still get
+        # reminded of every account they have, in one message
+        if getattr(settings, 'BIOKEY_CROSS_DIT_LOOKUP', False):
+            accounts, elsewhere = _split_found(dit, get_accounts_by_email_everywhere(email, dit))
+        else:
+            accounts, elsewhere = get_accounts_by_email(email, dit), []
+        dit.send_uid_reminders(accounts, request, elsewhere, site)
+
+
 class ForgottenDetailsFormPage(AbstractFormPage):
+    @deduplicate
     def serve(self, request: HttpRequest) -> HttpResponse:
         if request.method == 'POST':
             form = ForgottenDetailsForm(request.POST, page=self)
             if form.is_valid():
                 dit = self.get_parent().specific
                 uid, email = form.cleaned_data['uid'], form.cleaned_data['email']
-                if uid:
-                    account = get_account_by_uid(uid, dit)
-                    # If account is found or not, tell the user the process has begun anyway; this
-                    # prevents information leakage about which are known account names.
-                    params = {'page': self, 'uid': uid, 'us': dit.help_address}
-                    if account:
-                        dit.send_reset_email(account, request)
-                    return render(request, PACKAGE_NAME + '/password-reset-email-sent.html', params)
-                elif email:
-                    accounts = get_accounts_by_email(email, dit)
-                    # If accounts are found or not, tell the user we've sent the reminders by email.
-                    # As with the `uid` case, this prevents the leakage of known email addresses.
-                    dit.send_uid_reminders(accounts, request)
-                    params = {'page': self, 'email': email, 'dit': dit, 'url': dit.get_full_url(request)}
-                    return render(request, PACKAGE_NAME + '/uid-reminder-email-sent.html', params)
+                if getattr(settings, 'BIOKEY_ASYNC_FORGOTTEN', False):
+                    # Leave every directory lookup to the worker, so this answers just as quickly
+                    # whether or not the account exists and however slow the directory is
+                    forgotten_details.delay(dit.pk, uid, email, request_site(request).pk, site_base_url(request))
+                    return self.forgotten_response(request, dit, uid, email)
+                # Only under ASGI is there a long-lived event loop to run on; under WSGI,
+                # `async_to_sync` would make a new loop, with new directory connections, every time
+                if getattr(settings, 'BIOKEY_ASYNC_LDAP', False) and isinstance(request, ASGIRequest):
+                    return async_to_sync(self.aserve_forgotten)(request, dit, uid, email)
+                return self.serve_forgotten(request, dit, uid, email)
         else:
             form = ForgottenDetailsForm(page=self)
         self._bootstrap(form)
         return render(request, GENERIC_FORM_TEMPLATE, {'page': self, 'form': form})
 
+    def forgotten_response(self, request: HttpRequest, dit, uid: str, email: str) -> HttpResponse:
+        '''Tell the user we're emailing them about the `uid` or `email` they gave.
+
+        Whether or not the account or address is known, the page is the same; this prevents
+        information leakage about which are known account names and email addresses.
+        '''
+        if uid:
+            params = {'page': self, 'uid': uid, 'us': dit.help_address}
+            return render(request, PACKAGE_NAME + '/password-reset-email-sent.html', params)
+        params = {'page': self, 'email': email, 'dit': dit, 'url': dit.get_full_url(request)}
+        return render(request, PACKAGE_NAME + '/uid-reminder-email-sent.html', params)
+
+    def serve_forgotten(self, request: HttpRequest, dit, uid: str, email: str) -> HttpResponse:
+        '''Handle a valid forgotten details submission of either a `uid` or an `email` for `dit` right away.'''
+        send_forgotten_details(dit, uid, email, request)
+        return self.forgotten_response(request, dit, uid, email)
+
+    async def aserve_forgotten(self, request: HttpRequest, dit, uid: str, email: str) -> HttpResponse:
+        '''Asynchronously handle a valid forgotten details submission; see `serve_forgotten`.
+
+        The directory lookups wait on the event loop; sending email and rendering touch the
+        database, so they happen in a thread.
+        '''
+        if uid:
+            account = await aget_account_by_uid(uid, dit, 'reset')
+            params = {'page': self, 'uid': uid, 'us': dit.help_address}
+            if account:
+                await sync_to_async(dit.send_reset_email)(account, request)
+            return await sync_to_async(render)(request, PACKAGE_NAME + '/password-reset-email-sent.html', params)
+        else:
+            if getattr(settings, 'BIOKEY_CROSS_DIT_LOOKUP', False):
+                accounts, elsewhere = _split_found(dit, await aget_accounts_by_email_everywhere(email, dit))
+            else:
+                accounts, elsewhere = await aget_accounts_by_email(email, dit), []
+            await sync_to_async(dit.send_uid_reminders)(accounts, request, elsewhere)
+            url = await sync_to_async(dit.get_full_url)(request)
+            params = {'page': self, 'email': email, 'dit': dit, 'url': url}
+            return await sync_to_async(render)(request, PACKAGE_NAME + '/uid-reminder-email-sent.html', params)
+
 
 class ResetForgottenPasswordForm(AbstractForm):
+    # The form posts to the URL without the token, so it carries the token itself
+    token = forms.CharField(widget=forms.HiddenInput(), max_length=1024)
     new_password = forms.CharField(
         help_text='Enter a new password', max_length=MAX_PASSWORD_LENGTH, widget=forms.PasswordInput()
     )
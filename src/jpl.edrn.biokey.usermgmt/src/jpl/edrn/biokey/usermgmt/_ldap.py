@@ -3,72 +3,143 @@
 '''🧬🔑🕴️ BioKey user management: LDAP utilities.'''
 
 
+from ._accounts import Account, decode_accounts, _account_fields, _biokey_json_re
+from ._admission import READ, WRITE, admitted
+from ._breaker import OPEN, breaker_state, circuit, _unavailable
+from ._coalesce import coalesced
 from ._dits import DirectoryInformationTree
 from .constants import MAX_EMAIL_LENGTH
+from ._mirror import forget_account, mirror_account, mirror_is_fresh, mirrored_accounts_by_email
+from ._metadata import clear_reset_token, forget_metadata, record_account, save_reset_token
+from ._mirror import mirrored_potential_accounts
+from ._misses import forget_misses, known_miss, record_miss
 from ._passwords import generate_random_password
+from ._pool import Timeouts, pooled_connection
+from ._reservations import reserve_account_name, release_account_name
+from ._routing import pin_to_primary, read_uris, record_failure, record_success
+from ._tokens import can_sign_token, make_signed_token, signed_tokens_enabled
 from contextlib import contextmanager
-import logging, ldap, random, re, hashlib, base64, ldap.modlist, json, datetime, os
+from django.conf import settings
+from django.db import close_old_connections
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.readentry import PostReadControl
+from ldap.filter import filter_format
+import logging, ldap, random, re, hashlib, base64, ldap.dn, ldap.modlist, json, datetime, os, time, threading
+import concurrent.futures
 
 
 _logger = logging.getLogger(__name__)
 
 _account_name_cleaner        = re.compile(r'[^A-Za-z]')
-_account_name_total_attempts = 20
-_biokey_json_re              = re.compile(r'([^@]*)(@@biokey=(.*$))?')
+_account_name_suffix_digits  = 3
+_fallback_account_name       = 'user'  # For names with no ASCII letters, like 李
 _edrn_object_classes         = ['top', 'person', 'organizationalPerson', 'inetOrgPerson', 'edrnPerson']
+_default_page_size           = 500
 _max_bare_account            = max(MAX_EMAIL_LENGTH - 3, 4)
 _reset_token_random_bytes    = 32
 _reset_token_length          = 16
+_default_cross_dit_timeout   = 5.0   # seconds
+_default_cross_dit_workers   = 8
 
 
-def _ldap_to_dict(search_result: tuple) -> dict:
-    '''Convert an LDAP search result into a dict.
+# Attribute sets: the attributes each kind of search asks the server for, so we never pull back
+# whole entries (passwords, object classes, and all) when we only need a few fields. Only the
+# password reset flows use `reset`, which adds the password hash to fingerprint signed tokens.
+_attribute_sets = {
+    'account': [attr for attr, required in _account_fields.values()] + ['description'],
+    'mail':    ['mail'],
+    'uid':     ['uid'],
+}
+_attribute_sets['reset'] = _attribute_sets['account'] + ['userPassword']
 
-    LDAP search result is a tuple of (string DN and dict of byte-encoded attributes).
-    Convert the byte-encoded attributes into UTF-8 strings and return that dict, adding
-    the DN to it. Simplify some of the attribute names too. This makes many assumptions
-    about our user schema. Leave out the password.
 
-    If the `@@biokey` string is found in the description, parse it as json and return
-    its dict representation in the `biokey` key.
+@contextmanager
+def ldap_connection(dit: DirectoryInformationTree, uri: str | None = None, kind: str | None = None):
+    '''Lend out a connection to the directory of `dit` bound as its manager.
+
+    By default this is to the primary server, which is where all writes must go; give `uri` to
+    use one of the replicas instead. The connection comes from a pool, so don't rebind it as
+    anyone else. How it goes counts towards the server's health and the DIT's circuit breaker;
+    if the breaker's open, this raises `DirectoryUnavailable` without trying the server at all.
+
+    The connection counts against the `kind` budget of `._admission`, `READ` or `WRITE`; by
+    default, that's reads when a `uri` is given and writes when it isn't. If the budget's spent,
+    this raises `DirectoryBusy`.
     '''
-    dn, d = search_result
-    try:
-        desc = d['description'][0].decode('utf-8')
-    except KeyError:
-        desc = ''
-    biokey_match, biokey = _biokey_json_re.match(desc), None
-    if biokey_match and biokey_match.group(3):
+    kind = kind or (READ if uri else WRITE)
+    uri, start = uri or dit.uri, time.monotonic()
+    timeouts = Timeouts(dit.connect_timeout, dit.bind_timeout, dit.operation_timeout)
+    with circuit(dit), admitted(dit, kind):
         try:
-            biokey = json.loads(biokey_match.group(3))
-        except json.JSONDecodeError as ex:
-            _logger.warning('Corrupted biokey json in %s: %s', dn, ex.msg)
-    else:
-        biokey = {}
-    attributes = {
-        'dn': dn,
-        'email': d['mail'][0].decode('utf-8'),
-        'sn': d['sn'][0].decode('utf-8'),
-        'cn': d['cn'][0].decode('utf-8'),
-        'desc': desc,
-        'uid': d['uid'][0].decode('utf-8'),
-    }
-    if 'telephoneNumber' in d:
-        attributes['phone'] = d['telephoneNumber'][0].decode('utf-8')
-    if 'biokey':
-        attributes['biokey'] = biokey
-    return attributes
+            with pooled_connection(uri, dit.manager_dn, dit.manager_password, timeouts) as connection:
+                yield connection
+        except _unavailable as ex:
+            record_failure(uri, ex)
+            raise
+    record_success(uri, time.monotonic() - start)
 
 
-@contextmanager
-def ldap_connection(dit: DirectoryInformationTree):
-    connection = None
-    try:
-        connection = ldap.initialize(dit.uri)
-        connection.simple_bind_s(dit.manager_dn, dit.manager_password)
-        yield connection
-    finally:
-        if connection is not None: del connection
+def _read(dit: DirectoryInformationTree, operation, subject: str | None = None):
+    '''Call `operation` with a connection to the best server in `dit` for reading about `subject`.
+
+    The `subject` is the uid or email address the read is about, if any, so reads right after
+    a write about it go to the primary. If a server is unavailable, try the next one. Since the
+    `operation` may be retried, it should get all its results before it returns.
+    '''
+    uris = read_uris(dit, subject)
+    for index, uri in enumerate(uris):
+        try:
+            with ldap_connection(dit, uri) as connection:
+                return operation(connection)
+        except _unavailable:
+            if index == len(uris) - 1: raise
+            _logger.info('Failing over read from %s to %s', uri, uris[index + 1])
+
+
+def paged_search(
+    connection, base: str, scope: int, filterstr: str, attrlist: list[str] | None = None,
+    page_size: int | None = None, size_limit: int | None = None, time_limit: float | None = None
+):
+    '''Search a page at a time, yielding each (DN, attributes) result as its page arrives.
+
+    This uses the Simple Paged Results control so big result sets neither trip the server's size
+    limit nor have to sit in memory all at once. Stop after `size_limit` results if it's given;
+    `time_limit` is in seconds and applies to each page. Defaults for all three come from the
+    `BIOKEY_LDAP_PAGE_SIZE`, `BIOKEY_LDAP_SIZE_LIMIT`, and `BIOKEY_LDAP_TIME_LIMIT` settings.
+    '''
+    page_size = page_size or getattr(settings, 'BIOKEY_LDAP_PAGE_SIZE', _default_page_size)
+    size_limit = size_limit or getattr(settings, 'BIOKEY_LDAP_SIZE_LIMIT', None)
+    # Zero means no limit, but python-ldap takes a zero timeout as "poll", so make it -1 instead
+    time_limit = time_limit or getattr(settings, 'BIOKEY_LDAP_TIME_LIMIT', None) or None
+    control, count = SimplePagedResultsControl(True, size=page_size, cookie=b''), 0
+    while True:
+        msgid = connection.search_ext(base, scope, filterstr, attrlist, serverctrls=[control], timeout=time_limit or -1)
+        _, results, _, controls = connection.result3(msgid, timeout=time_limit or -1)
+        cookie = next((i.cookie for i in controls or [] if i.controlType == control.controlType), b'')
+        for dn, attrs in results:
+            if dn is None: continue  # Search continuation reference
+            yield dn, attrs
+            count += 1
+            if size_limit and count >= size_limit:
+                if cookie:
+                    # Tell the server we're done with this result set so it can let go of it
+                    control.size, control.cookie = 0, cookie
+                    connection.search_ext_s(base, scope, filterstr, attrlist, serverctrls=[control])
+                return
+        if not cookie: return
+        control.cookie = cookie
+
+
+def iter_accounts(
+    filterstr: str, dit: DirectoryInformationTree, attrlist: list[str] = _attribute_sets['account'], **kw
+):
+    '''Stream the `Account`s in `dit` matching `filterstr`, a page at a time.
+
+    Keyword arguments go to `paged_search`. Bulk tools should use this rather than one big search.
+    '''
+    with ldap_connection(dit, read_uris(dit)[0]) as connection:
+        for result in paged_search(connection, dit.user_base, dit.user_scope, filterstr, attrlist, **kw):
+            yield Account(result)
 
 
 def _hash_password(password: str) -> bytes:
@@ -84,25 +155,42 @@ def generate_random_ldap_password() -> bytes:
 
 
 def get_potential_accounts(fn: str, ln: str, dit: DirectoryInformationTree) -> list:
-    matches = set()
-    with ldap_connection(dit) as connection:
-        if not fn:
-            results = connection.search_s(dit.user_base, dit.user_scope, f'(sn={ln})')
-        else:
-            results = connection.search_s(dit.user_base, dit.user_scope, f'(cn={fn} {ln})')
-        for match in results:
-            matches.add(match[1]['mail'][0].decode('utf-8'))
+    '''Find email addresses of accounts that might belong to `fn` `ln`.
+
+    The mirror matches names fuzzily; the directory itself, only exactly.
+    '''
+    if mirror_is_fresh(dit): return mirrored_potential_accounts(fn, ln, dit)
+    if not fn:
+        filterstr = filter_format('(sn=%s)', [ln])
+    else:
+        filterstr = filter_format('(cn=%s)', [f'{fn} {ln}'])
+
+    def search(connection) -> list:
+        matches = set()
+        results = paged_search(connection, dit.user_base, dit.user_scope, filterstr, _attribute_sets['mail'])
+        for dn, attrs in results:
+            matches.add(attrs['mail'][0].decode('utf-8'))
         matches = list(matches)
         matches.sort()
         return matches
 
+    return _read(dit, search)
 
-def create_account(
-    uid: str, fn: str, ln: str, email: str, phone: str, ocs: list[str], consortium: str, dit: DirectoryInformationTree
-):
-    dn = f'uid={uid},{dit.user_base}'
+
+def _user_dn(uid: str, dit: DirectoryInformationTree) -> str:
+    '''Make the DN of the user `uid` in `dit`, escaping the `uid` since it may have come from anyone.'''
+    return f'uid={ldap.dn.escape_dn_chars(uid)},{dit.user_base}'
+
+
+def _new_account_modlist(
+    uid: str, fn: str, ln: str, email: str, phone: str, ocs: list[str], dit: DirectoryInformationTree
+) -> tuple[str, list]:
+    '''Make the DN and the add modlist for a new account.
+
+    BioKey's own metadata about the account goes in the database (see `._metadata`), not the description.
+    '''
+    dn = _user_dn(uid, dit)
     cn = f'{fn} {ln}' if fn else ln
-    description = f'@@biokey={json.dumps({"consortium": consortium})}'.encode('utf-8')
     attrs = {
         'uid': uid.encode('utf-8'),
         'sn': ln.encode('utf-8'),
@@ -110,38 +198,63 @@ def create_account(
         'mail': email.encode('utf-8'),
         'userPassword': generate_random_ldap_password(),
         'objectClass': [i.encode('utf-8') for i in ocs],
-        'description': [description]
     }
     if phone:
         attrs['telephoneNumber'] = phone.encode('utf-8')
-    modlist = ldap.modlist.addModlist(attrs)
-    with ldap_connection(dit) as connection:
-        _logger.info('Creating user «%s»', dn)
-        connection.add_s(dn, modlist)
+    return dn, ldap.modlist.addModlist(attrs)
 
 
-def generate_account_name(fn: str, ln: str, dit: DirectoryInformationTree) -> str:
-    _logger.info('Generating a new account name for fn «%s» and ln «%s» in «%s»', fn, ln, dit.title)
+def _account_name_base(fn: str, ln: str) -> str:
+    '''Make the starting point for a new account name from first name `fn` and last name `ln`.
+
+    This is never empty: an empty base would make the prefix search `(uid=*)`, paging through
+    the whole directory, so names with no ASCII letters get a generic base instead.
+    '''
     original_uid = f'{fn[0]}{ln}' if fn else ln
     original_uid = re.sub(_account_name_cleaner, '', original_uid)
-    original_uid = original_uid[:_max_bare_account].lower()
-    uid = original_uid
-    attempts = 0
+    return original_uid[:_max_bare_account].lower() or _fallback_account_name
 
-    # Possible race here
-    with ldap_connection(dit) as connection:
-        while attempts < _account_name_total_attempts:
-            results = connection.search_s(dit.user_base, dit.user_scope, f'(uid={uid})')
-            if len(results) == 0:
-                _logger.info('UID «%s» is currently available in «%s»', uid, dit.title)
-                return uid
-            else:
-                uid = f'{uid}{random.randrange(start=100, stop=399, step=1)}'
-                attempts += 1
-    raise ValueError(f"Tried {attempts} variations on {original_uid} but couldn't find any unusued ones")
 
+def _candidate_account_names(base: str, taken: set[str]):
+    '''Yield account names starting with `base` that aren't in the set of `taken` names.
 
-def _update_biokey_description(account: dict, biokey: dict):
+    The bare `base` is best. After that come numeric suffixes in random order, starting with
+    three digits and widening only once every one of those has been offered.
+    '''
+    if base not in taken: yield base
+    digits = _account_name_suffix_digits
+    while True:
+        free = [i for i in range(10 ** (digits - 1), 10 ** digits) if f'{base}{i}' not in taken]
+        random.shuffle(free)
+        for i in free:
+            yield f'{base}{i}'
+        digits += 1
+
+
+def _generate_account_name(connection, fn: str, ln: str, dit: DirectoryInformationTree) -> str:
+    '''Find and reserve an unused account name for `fn` and `ln` in `dit`.
+
+    One prefix search tells us which names are taken in the directory; then we claim the first
+    free candidate nobody else has reserved. Claims are local cache operations, so losing a race
+    to another sign-up costs no further trips to the directory.
+    '''
+    _logger.info('Generating a new account name for fn «%s» and ln «%s» in «%s»', fn, ln, dit.title)
+    base = _account_name_base(fn, ln)
+
+    # The base is only ever letters, so no escaping is needed for the filter
+    results = paged_search(connection, dit.user_base, dit.user_scope, f'(uid={base}*)', _attribute_sets['uid'])
+    taken = {uid.decode('utf-8').lower() for _, attrs in results for uid in attrs.get('uid', [])}
+    for uid in _candidate_account_names(base, taken):
+        if reserve_account_name(dit, uid):
+            _logger.info(
+                'UID «%s» is available and reserved in «%s»; %d others start with «%s»', uid, dit.title,
+                len(taken), base
+            )
+            return uid
+        _logger.info('UID «%s» is free in «%s» but reserved by another sign-up', uid, dit.title)
+
+
+def _update_biokey_description(account: Account, biokey: dict):
     '''Update the `@@biokey` in the description of the given `account`.
 
     This preserves any text preceding the `@@biokey`. It'll encode it as UTF-8 too.
@@ -151,103 +264,321 @@ def _update_biokey_description(account: dict, biokey: dict):
     return f'{preceding} @@biokey={json.dumps(biokey)}'.strip().encode('utf-8')
 
 
-def generate_reset_token(account: dict, expiration: datetime.datetime, dit: DirectoryInformationTree) -> str:
-    _logger.info('Generating a reset token for %s expiring at %s in %s', account['dn'], expiration, dit.slug)
+def _make_reset_token(dn: str, expiration: datetime.datetime) -> str:
+    '''Make a fresh random reset token for the account at `dn` that expires at `expiration`.'''
     random_bytes = os.urandom(_reset_token_random_bytes)
-    token_bytes = random_bytes + f'{account["dn"]}{expiration}'.encode('utf-8')
-    token = base64.urlsafe_b64encode(hashlib.sha256(token_bytes).digest()[:_reset_token_length]).decode('utf-8')
-    biokey = account.get('biokey', {})
-    biokey['reset_token'] = token
-    biokey['reset_time'] = expiration.isoformat()
-    new_desc = _update_biokey_description(account, biokey)
-    with ldap_connection(dit) as connection:
-        desc_mod = [(ldap.MOD_REPLACE, 'description', [new_desc])]
-        connection.modify_s(account['dn'], desc_mod)
+    token_bytes = random_bytes + f'{dn}{expiration}'.encode('utf-8')
+    return base64.urlsafe_b64encode(hashlib.sha256(token_bytes).digest()[:_reset_token_length]).decode('utf-8')
+
+
+def generate_reset_token(account: Account, expiration: datetime.datetime, dit: DirectoryInformationTree) -> str:
+    _logger.info('Generating a reset token for %s expiring at %s in %s', account['dn'], expiration, dit.slug)
+    if signed_tokens_enabled():
+        # No write needed; just make sure we have the password hash to fingerprint
+        if not can_sign_token(account):
+            account = get_account_by_uid(account['uid'], dit, 'reset') or account
+        if can_sign_token(account): return make_signed_token(dit.slug, account, expiration)
+        _logger.warning('Cannot read the userPassword of %s; issuing a classic reset token instead', account['dn'])
+    token = _make_reset_token(account['dn'], expiration)
+    save_reset_token(dit, account, token, expiration)
     return token
 
 
-def create_new_account(fn: str, ln: str, telephone: str, email: str, dit: DirectoryInformationTree) -> str:
-    _logger.info('Creating new account for «%s» at «%s» in %s', ln, email, dit.slug)
-    account_name = generate_account_name(fn, ln, dit)
-    create_account(account_name, fn, ln, email, telephone, _edrn_object_classes, dit.slug, dit)
-    return account_name
+def _add_new_account(connection, uid: str, dn: str, modlist: list, dit: DirectoryInformationTree, **kw):
+    '''Add the new account `uid` at `dn`, releasing its reservation if the add fails.'''
+    _logger.info('Creating user «%s»', dn)
+    try:
+        return connection.add_ext_s(dn, modlist, **kw)
+    except ldap.LDAPError:
+        release_account_name(dit, uid)
+        raise
+
+
+def _provision_account(
+    connection, fn: str, ln: str, telephone: str, email: str, expiration: datetime.datetime,
+    dit: DirectoryInformationTree
+) -> tuple[Account, str]:
+    uid = _generate_account_name(connection, fn, ln, dit)
+    dn, modlist = _new_account_modlist(uid, fn, ln, email, telephone, _edrn_object_classes, dit)
+    _, _, _, controls = _add_new_account(
+        connection, uid, dn, modlist, dit,
+        serverctrls=[PostReadControl(criticality=False, attrList=_attribute_sets['reset'])]
+    )
+    account = None
+    for control in controls or []:
+        if control.controlType == PostReadControl.controlType and control.entry:
+            account = Account((control.dn, control.entry))
+    if account is None:
+        filterstr = filter_format('(uid=%s)', [uid])
+        results = connection.search_s(dit.user_base, dit.user_scope, filterstr, _attribute_sets['reset'])
+        account = Account(results[0])
+    if signed_tokens_enabled() and can_sign_token(account):
+        record_account(dit, uid, dit.slug)
+        return account, make_signed_token(dit.slug, account, expiration)
+    token = _make_reset_token(dn, expiration)
+    record_account(dit, uid, dit.slug, token, expiration)
+    return account, token
+
+
+def provision_account(
+    fn: str, ln: str, telephone: str, email: str, expiration: datetime.datetime, dit: DirectoryInformationTree
+) -> tuple[Account, str]:
+    '''Create a brand new account for sign-up in a single directory session.
+
+    Within one bound connection, pick a free account name, add the entry, and read it back. The
+    read back comes for free with the add if the server honors the post-read control; otherwise
+    it's one more search on the same connection. Then record the account's metadata with a
+    password reset token good until `expiration` (for signed tokens, made from the entry read
+    back). Return the new account and the token.
+    '''
+    _logger.info('Provisioning new account for «%s» at «%s» in %s', ln, email, dit.slug)
+    with ldap_connection(dit) as connection:
+        account, token = _provision_account(connection, fn, ln, telephone, email, expiration, dit)
+    # The sign-up flow reads the new account right back, so make sure it's there to be read
+    forget_misses(dit, account['uid'], email)
+    pin_to_primary(dit, account['uid'], email)
+    mirror_account(dit, account)
+    return account, token
+
+
+def _account_by_uid(
+    connection, uid: str, dit: DirectoryInformationTree, attribute_set: str = 'account'
+) -> Account | None:
+    filterstr = filter_format('(uid=%s)', [uid])
+    results = connection.search_s(dit.user_base, dit.user_scope, filterstr, _attribute_sets[attribute_set])
+    if len(results) == 0: return None
+    return Account(results[0])
 
 
-def get_account_by_uid(uid: str, dit: DirectoryInformationTree) -> dict:
+def get_account_by_uid(uid: str, dit: DirectoryInformationTree, attribute_set: str = 'account') -> Account | None:
+    '''Find the account `uid` in `dit`; use the `reset` attribute set when it's for a password reset.'''
     _logger.info('Looking up EDRN account by uid «%s»', uid)
-    with ldap_connection(dit) as connection:
-        results = connection.search_s(dit.user_base, dit.user_scope, f'(uid={uid})')
-        if len(results) == 0: return None
-        return _ldap_to_dict(results[0])
+    if known_miss(dit, 'uid', uid): return None
+
+    def search() -> Account | None:
+        return _read(dit, lambda connection: _account_by_uid(connection, uid, dit, attribute_set), uid)
+
+    # Reset lookups include the password hash, which mustn't be put in the shared cache
+    account = coalesced(dit, f'uid:{attribute_set}:{uid}', search, cluster=attribute_set != 'reset')
+    if account is None: record_miss(dit, 'uid', uid)
+    return account
 
 
-def get_accounts_by_email(email: str, dit: DirectoryInformationTree) -> list:
+def get_accounts_by_email(email: str, dit: DirectoryInformationTree) -> list[Account]:
     _logger.info('Looking up EDRN accounts by email «%s»', email)
-    accounts = []
-    with ldap_connection(dit) as connection:
-        results = connection.search_s(dit.user_base, dit.user_scope, f'(mail={email})')
-        for i in results:
-            accounts.append(_ldap_to_dict(i))
-        return accounts
+    if known_miss(dit, 'mail', email): return []
+    if mirror_is_fresh(dit): return mirrored_accounts_by_email(email, dit)
+    filterstr = filter_format('(mail=%s)', [email])
+
+    def search(connection) -> list[Account]:
+        return decode_accounts(
+            connection.search_s(dit.user_base, dit.user_scope, filterstr, _attribute_sets['account'])
+        )
+
+    accounts = coalesced(dit, f'mail:{email}', lambda: _read(dit, search, email))
+    if not accounts: record_miss(dit, 'mail', email)
+    return accounts
+
+
+_cross_dit_executor = None
+_cross_dit_executor_lock = threading.Lock()
+_cross_dit_in_flight = set()  # Primary keys of DITs with a cross-DIT lookup still running
+
+
+def _cross_dit_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _cross_dit_executor
+    with _cross_dit_executor_lock:
+        if _cross_dit_executor is None:
+            workers = getattr(settings, 'BIOKEY_CROSS_DIT_WORKERS', _default_cross_dit_workers)
+            _cross_dit_executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='biokey-cross-dit')
+        return _cross_dit_executor
+
+
+def _cross_dit_done(pk: int):
+    with _cross_dit_executor_lock:
+        _cross_dit_in_flight.discard(pk)
+
+
+def _accounts_by_email_in_thread(email: str, dit: DirectoryInformationTree) -> list[Account]:
+    # Pool threads outlive requests, so tidy up their database connections as a request would
+    close_old_connections()
+    return get_accounts_by_email(email, dit)
+
+
+def cross_dit_lookup_dits(dit: DirectoryInformationTree) -> list[DirectoryInformationTree]:
+    '''Get the DITs to search along with `dit` when someone forgets their username: `dit` first, then every other.'''
+    others = DirectoryInformationTree.objects.live().exclude(pk=dit.pk).specific().order_by('title')
+    return [dit] + list(others)
+
+
+def get_accounts_by_email_everywhere(
+    email: str, dit: DirectoryInformationTree
+) -> list[tuple[DirectoryInformationTree, list[Account]]]:
+    '''Look up the accounts with `email` in `dit` and in every other DIT, all at once.
+
+    Each DIT gets `BIOKEY_CROSS_DIT_TIMEOUT` seconds; since they're searched concurrently on a
+    bounded pool of threads, the whole lookup takes about as long as the slowest DIT rather than
+    all of them added up. A DIT that fails or runs out of time is logged and left out. Results
+    come back as (DIT, accounts) pairs, `dit` first, leaving out DITs with no such accounts.
+
+    Giving up on a DIT doesn't stop the thread searching it, so a hung DIT could tie up the whole
+    pool. To keep that from happening, each DIT gets one lookup at a time: while one's still
+    running, later lookups leave that DIT out, as they do any DIT whose circuit breaker is open.
+    '''
+    timeout = getattr(settings, 'BIOKEY_CROSS_DIT_TIMEOUT', _default_cross_dit_timeout)
+    dits, pool, futures = cross_dit_lookup_dits(dit), _cross_dit_pool(), []
+    for i in dits:
+        if breaker_state(i)['state'] == OPEN:
+            _logger.info('Leaving %s out of the cross-DIT lookup since its circuit breaker is open', i.slug)
+            continue
+        with _cross_dit_executor_lock:
+            if i.pk in _cross_dit_in_flight:
+                _logger.warning('Leaving %s out of the cross-DIT lookup since an earlier one is still running', i.slug)
+                continue
+            _cross_dit_in_flight.add(i.pk)
+        future = pool.submit(_accounts_by_email_in_thread, email, i)
+        future.add_done_callback(lambda future, pk=i.pk: _cross_dit_done(pk))
+        futures.append((i, future))
+    concurrent.futures.wait([future for i, future in futures], timeout=timeout)
+    found = []
+    for i, future in futures:
+        if not future.done():
+            future.cancel()
+            _logger.warning('Gave up looking up accounts by email in %s after %.1f seconds', i.slug, timeout)
+        elif future.exception() is not None:
+            _logger.warning('Cannot look up accounts by email in %s: %r', i.slug, future.exception())
+        elif future.result():
+            found.append((i, future.result()))
+    return found
 
 
 def reset_password_in_dit(dit: DirectoryInformationTree, uid: str, new_password: str):
     '''Set the password for `uid` to `new_password` in the `dit` and clear any reset tokens in the `biokey`.'''
     _logger.info('Resetting password for %s in %s and clearing reset info', uid, dit.slug)
-    account = get_account_by_uid(uid, dit)
-    if not account:
-        raise ValueError(f"uid {uid} doesn't exist in {dit.slug}")
-    biokey = account.get('biokey', {})
-    for key in ('reset_token', 'reset_time'):
-        try:
-            del biokey[key]
-        except KeyError:
-            pass
-    description = _update_biokey_description(account, biokey)
-    pw = _hash_password(new_password)
 
+    # Read and modify on the primary so we don't base the new description on a stale replica
     with ldap_connection(dit) as connection:
-        modlist = [
-            (ldap.MOD_REPLACE, 'description', [description]),
-            (ldap.MOD_REPLACE, 'userPassword', [pw])
-        ]
+        account = _account_by_uid(connection, uid, dit)
+        if not account:
+            raise ValueError(f"uid {uid} doesn't exist in {dit.slug}")
+        biokey = account.get('biokey', {})
+        pw = _hash_password(new_password)
+        modlist = [(ldap.MOD_REPLACE, 'userPassword', [pw])]
+
+        # Only accounts whose metadata haven't moved to the database have a reset in the description
+        if 'reset_token' in biokey or 'reset_time' in biokey:
+            for key in ('reset_token', 'reset_time'):
+                biokey.pop(key, None)
+            modlist.insert(0, (ldap.MOD_REPLACE, 'description', [_update_biokey_description(account, biokey)]))
         connection.modify_s(account['dn'], modlist)
+    clear_reset_token(dit, uid)
+    pin_to_primary(dit, uid)
+
+
+def _user_connection(dit: DirectoryInformationTree):
+    '''Make a throwaway connection to the primary of `dit` for binding as a user.
+
+    Binding as a user would spoil a pooled manager connection, hence the throwaway. Callers
+    should set the operation timeout once they've bound.
+    '''
+    connection = ldap.initialize(dit.uri)
+    if dit.connect_timeout > 0: connection.set_option(ldap.OPT_NETWORK_TIMEOUT, dit.connect_timeout)
+    connection.timeout = dit.bind_timeout or -1
+    return connection
 
 
 def verify_password(dit: DirectoryInformationTree, uid: str, password: str) -> bool:
     '''Check if `uid` has valid `password` in the LDAP of `dit`.'''
-    dn = f'uid={uid},{dit.user_base}'
-    with ldap_connection(dit) as connection:
+    dn = _user_dn(uid, dit)
+
+    # It's a bind on the primary, so it counts against the write budget
+    with circuit(dit), admitted(dit, WRITE):
+        connection = _user_connection(dit)
         try:
-            connection.bind_s(dn, password)
+            connection.simple_bind_s(dn, password)
             return True
         except ldap.INVALID_CREDENTIALS:
-            pass
-    return False
+            return False
+        finally:
+            connection.unbind_s()
+
+
+def change_own_password(
+    dit: DirectoryInformationTree, uid: str, current_password: str, new_password: str, refusal=None
+) -> str | None:
+    '''Change the password of `uid` in `dit` from `current_password` to `new_password` as `uid` itself.
+
+    This takes one connection to the primary, bound as the user with `current_password`; if that's
+    wrong, `ldap.INVALID_CREDENTIALS` is raised and nothing changes. On the same bind we read the
+    user's own entry and, if given, call `refusal` with the `Account`. If it returns the name of a
+    template explaining why the password can't be changed here, return that without changing it.
+    Otherwise the user replaces their own `userPassword`, or, with `BIOKEY_LDAP_PASSWORD_MODIFY`
+    on, asks the server to do it with the Password Modify extended operation, and we return None.
+
+    If the directory doesn't let users read or write their own entries, fall back to doing that
+    part as the manager.
+    '''
+    dn, manager_write = _user_dn(uid, dit), False
+    with circuit(dit), admitted(dit, WRITE):
+        connection = _user_connection(dit)
+        try:
+            connection.simple_bind_s(dn, current_password)
+            connection.timeout = dit.operation_timeout or -1
+            try:
+                results = connection.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)', _attribute_sets['account'])
+                account = Account(results[0]) if results else None
+            except (ldap.INSUFFICIENT_ACCESS, ldap.NO_SUCH_OBJECT):
+                account = None
+            if refusal is not None:
+                if account is None:
+                    _logger.info('Cannot read %s as itself; looking it up as the manager', dn)
+                    account = get_account_by_uid(uid, dit)
+                template = refusal(account) if account is not None else None
+                if template: return template
+            if getattr(settings, 'BIOKEY_LDAP_PASSWORD_MODIFY', False):
+                connection.passwd_s(dn, current_password, new_password)
+            else:
+                try:
+                    connection.modify_s(dn, [(ldap.MOD_REPLACE, 'userPassword', [_hash_password(new_password)])])
+                except ldap.INSUFFICIENT_ACCESS:
+                    manager_write = True
+        finally:
+            connection.unbind_s()
+    if manager_write:
+        # Outside the admission above so this doesn't hold two write turns at once
+        _logger.info('Directory for %s does not let %s change its own password; doing so as the manager', dit.slug, uid)
+        change_password(dit, uid, new_password)
+    else:
+        pin_to_primary(dit, uid)
+    return None
 
 
 def change_password(dit: DirectoryInformationTree, uid: str, password: str):
     '''Change the password in the directory represented by `dit` for `uid` to `password`.'''
-    dn = f'uid={uid},{dit.user_base}'
+    dn = _user_dn(uid, dit)
     with ldap_connection(dit) as connection:
         modlist = [(ldap.MOD_REPLACE, 'userPassword', [_hash_password(password)])]
         connection.modify_s(dn, modlist)
+    pin_to_primary(dit, uid)
 
 
 def delete_account(dit: DirectoryInformationTree, uid: str):
     '''Delete the account with the given `uid` from `dit`.'''
-    dn = f'uid={uid},{dit.user_base}'
+    dn = _user_dn(uid, dit)
     with ldap_connection(dit) as connection:
         try:
             _logger.info('Deleting DN %s from LDAP', dn)
             connection.delete_s(dn)
         except ldap.NO_SUCH_OBJECT:
             _logger.info('The DN I was trying to delete, %s, does not exist! Pressing on', dn)
+    pin_to_primary(dit, uid)
+    forget_account(dit, uid)
+    forget_metadata(dit, uid)
 
 
 def add_to_group(dit: DirectoryInformationTree, uid: str, group_dn: str):
     '''Add the user with the given `uid` in `dit` to the group with the DN `group_dn`.'''
-    dn = f'uid={uid},{dit.user_base}'
+    dn = _user_dn(uid, dit)
     _logger.info('Adding %s as uniqueMember to %s', dn, group_dn)
     modlist = [(ldap.MOD_ADD, 'uniqueMember', [dn.encode('utf-8')])]
     with ldap_connection(dit) as connection:
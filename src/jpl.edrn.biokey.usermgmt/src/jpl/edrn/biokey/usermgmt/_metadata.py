@@ -0,0 +1,148 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: account metadata.
+
+BioKey's own facts about an account—which consortium it signed up with, and any outstanding
+password reset token and when it expires—used to be packed as `@@biokey={json}` into the
+LDAP `description`. That meant parsing JSON out of every entry we read, a directory write
+whenever a reset was requested, and no way to ask questions like "how many resets are
+outstanding?" without scanning the whole directory. Now they live in the database, keyed by
+DIT and uid.
+
+Entries that haven't been moved over yet still work: when there's no row for an account, we
+fall back to whatever `@@biokey` its description has. The `biokey_metadata` management
+command moves everything over (and optionally strips the descriptions) in one streaming pass.
+'''
+
+from ._accounts import Account
+from .constants import MAX_DIRECTORY_UID_LENGTH
+from django.db import models
+from django.utils import timezone
+import datetime, logging
+
+
+_logger = logging.getLogger(__name__)
+
+# The keys of the legacy `@@biokey` JSON that get their own columns; anything else goes in `extra`
+_known_keys = ('consortium', 'reset_token', 'reset_time')
+
+
+class AccountMetadata(models.Model):
+    '''What BioKey knows about an account beyond what's in the directory.'''
+    page = models.ForeignKey(
+        'jpledrnbiokeyusermgmt.DirectoryInformationTree', on_delete=models.CASCADE, related_name='account_metadata'
+    )
+    uid = models.CharField(max_length=MAX_DIRECTORY_UID_LENGTH)
+    consortium = models.CharField(max_length=255, blank=True, help_text='Consortium the account signed up with')
+    reset_token = models.CharField(max_length=255, blank=True, help_text='Outstanding password reset token')
+    reset_expires = models.DateTimeField(null=True, blank=True, help_text='When the reset token expires')
+    extra = models.JSONField(default=dict, blank=True, help_text='Any other legacy @@biokey values')
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.uid} in {self.page_id}'
+
+    def as_biokey(self) -> dict:
+        '''Give these metadata in the shape of the legacy `@@biokey` JSON.'''
+        biokey = dict(self.extra)
+        if self.consortium: biokey['consortium'] = self.consortium
+        if self.reset_token: biokey['reset_token'] = self.reset_token
+        if self.reset_expires: biokey['reset_time'] = self.reset_expires.isoformat()
+        return biokey
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['page', 'uid'], name='unique_account_metadata_uid')]
+        indexes = [
+            models.Index(fields=['consortium'], name='account_metadata_consortium'),
+            models.Index(fields=['reset_expires'], name='account_metadata_reset'),
+        ]
+
+
+def from_biokey(dit, uid: str, biokey: dict) -> AccountMetadata:
+    '''Make (but don't save) metadata for `uid` in `dit` out of legacy `@@biokey` JSON.'''
+    reset_time = biokey.get('reset_time')
+    try:
+        reset_expires = datetime.datetime.fromisoformat(reset_time) if reset_time else None
+    except (TypeError, ValueError):
+        _logger.warning('Ignoring unreadable reset time %r for %s in %s', reset_time, uid, dit.slug)
+        reset_expires = None
+    return AccountMetadata(
+        page_id=dit.pk, uid=uid, consortium=biokey.get('consortium') or '', reset_token=biokey.get('reset_token') or '',
+        reset_expires=reset_expires, extra={k: v for k, v in biokey.items() if k not in _known_keys}
+    )
+
+
+# Reading
+# -------
+
+def account_biokey(dit, account: Account) -> dict:
+    '''Get BioKey's metadata on `account` in `dit`, from the database or else from its description.'''
+    metadata = AccountMetadata.objects.filter(page_id=dit.pk, uid=account['uid']).first()
+    return metadata.as_biokey() if metadata else account.get('biokey', {})
+
+
+async def aaccount_biokey(dit, account: Account) -> dict:
+    '''Asynchronously get BioKey's metadata on `account`; see `account_biokey`.'''
+    metadata = await AccountMetadata.objects.filter(page_id=dit.pk, uid=account['uid']).afirst()
+    return metadata.as_biokey() if metadata else account.get('biokey', {})
+
+
+def outstanding_resets(dit) -> int:
+    '''Count the password resets in `dit` that haven't been used or expired yet.'''
+    return AccountMetadata.objects.filter(page_id=dit.pk, reset_expires__gt=timezone.now()).count()
+
+
+# Writing
+# -------
+
+def _defaults(account: Account | None, consortium: str) -> dict:
+    '''Make the starting values for a new row, carrying over anything from a legacy description.'''
+    biokey = account.get('biokey', {}) if account is not None else {}
+    return {
+        'consortium': biokey.get('consortium') or consortium,
+        'extra': {k: v for k, v in biokey.items() if k not in _known_keys},
+    }
+
+
+def record_account(dit, uid: str, consortium: str, token: str = '', expiration: datetime.datetime | None = None):
+    '''Note that `uid` was just created in `dit` for `consortium`, with a reset `token` good until `expiration`.'''
+    AccountMetadata.objects.update_or_create(
+        page_id=dit.pk, uid=uid, defaults={'consortium': consortium, 'reset_token': token, 'reset_expires': expiration}
+    )
+
+
+def save_reset_token(dit, account: Account, token: str, expiration: datetime.datetime):
+    '''Give `account` in `dit` the reset `token` good until `expiration`.'''
+    metadata, created = AccountMetadata.objects.get_or_create(
+        page_id=dit.pk, uid=account['uid'], defaults=_defaults(account, dit.slug)
+    )
+    metadata.reset_token, metadata.reset_expires = token, expiration
+    metadata.save(update_fields=['reset_token', 'reset_expires', 'updated'])
+
+
+async def asave_reset_token(dit, account: Account, token: str, expiration: datetime.datetime):
+    '''Asynchronously give `account` a reset token; see `save_reset_token`.'''
+    metadata, created = await AccountMetadata.objects.aget_or_create(
+        page_id=dit.pk, uid=account['uid'], defaults=_defaults(account, dit.slug)
+    )
+    metadata.reset_token, metadata.reset_expires = token, expiration
+    await metadata.asave(update_fields=['reset_token', 'reset_expires', 'updated'])
+
+
+def clear_reset_token(dit, uid: str):
+    '''Use up any reset token `uid` in `dit` has.'''
+    AccountMetadata.objects.filter(page_id=dit.pk, uid=uid).update(
+        reset_token='', reset_expires=None, updated=timezone.now()
+    )
+
+
+async def aclear_reset_token(dit, uid: str):
+    '''Asynchronously use up any reset token `uid` has; see `clear_reset_token`.'''
+    await AccountMetadata.objects.filter(page_id=dit.pk, uid=uid).aupdate(
+        reset_token='', reset_expires=None, updated=timezone.now()
+    )
+
+
+def forget_metadata(dit, uid: str):
+    '''Drop what we know about `uid`, just deleted from `dit`.'''
+    AccountMetadata.objects.filter(page_id=dit.pk, uid=uid).delete()
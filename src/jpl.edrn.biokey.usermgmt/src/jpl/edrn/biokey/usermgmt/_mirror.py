@@ -0,0 +1,304 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: directory mirror.
+
+We keep a copy of each DIT's user entries in the database so read-only lookups—such as
+finding accounts by email address or by name—are indexed SQL queries rather than trips to
+the directory. The Celery worker fills the mirror with a full paged sync, then keeps it
+current by polling for entries whose `modifyTimestamp` is at or after the newest one it's
+seen. That can't see deletions, so each poll also lists every DN in the directory, without
+attributes, and sweeps out the entries that are gone; a full sync still runs every so often to
+catch anything else. Accounts BioKey itself deletes or creates are updated in the mirror right
+away.
+
+Each entry also carries fuzzy keys for its name (see `._names`) plus its normalized surname,
+indexed by trigram, so asking "do you already have an account?" during sign-up can find "Bob
+Smyth-Jones" when someone types "Robert Jones". The keys are computed whenever an entry is
+mirrored, so the name index stays current along with everything else. Entries mirrored before
+there were keys get theirs from their stored names on the next poll, without asking the directory.
+
+If a DIT's mirror hasn't been brought up to date within `BIOKEY_MIRROR_MAX_STALENESS` seconds
+(or has never been synced), lookups go to the directory as before, with exact name matching.
+
+Note: we cannot import ._ldap up top here as it'll result in a circular dependency.
+'''
+
+from ._accounts import Account, _account_fields
+from ._names import given_name_keys, name_keys, normalize, surname_keys
+from .constants import MAX_DIRECTORY_UID_LENGTH
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+import datetime, logging
+
+
+_logger = logging.getLogger(__name__)
+
+_default_max_staleness    = 300     # seconds
+_default_full_sync_period = 86400   # seconds
+_batch_size               = 1000
+_default_name_similarity  = 0.5
+_default_name_match_limit = 10
+
+
+class DirectoryEntry(models.Model):
+    '''A user entry in a DIT as of the last time we synchronized with its directory.'''
+    page = models.ForeignKey(
+        'jpledrnbiokeyusermgmt.DirectoryInformationTree', on_delete=models.CASCADE, related_name='directory_entries'
+    )
+    dn = models.CharField(max_length=600)
+    uid = models.CharField(max_length=MAX_DIRECTORY_UID_LENGTH)
+    email = models.CharField(max_length=255, blank=True)
+    email_key = models.CharField(max_length=255, blank=True, help_text='Lowercased email')
+    cn = models.CharField(max_length=255, blank=True)
+    cn_key = models.CharField(max_length=255, blank=True, help_text='Lowercased common name')
+    sn = models.CharField(max_length=255, blank=True)
+    sn_key = models.CharField(max_length=255, blank=True, help_text='Lowercased surname')
+    sn_normalized = models.CharField(max_length=255, blank=True, help_text='Surname without accents or punctuation')
+    name_keys = ArrayField(models.CharField(max_length=64), blank=True, default=list, help_text='Fuzzy name keys')
+    phone = models.CharField(max_length=255, blank=True)
+    description = models.TextField(blank=True)
+    modified = models.CharField(max_length=32, blank=True, help_text='modifyTimestamp as the directory gave it')
+    synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.dn
+
+    def account(self) -> Account:
+        '''Make an `Account` out of this entry, just as if it came from the directory.'''
+        values = {
+            'uid': self.uid, 'mail': self.email, 'cn': self.cn, 'sn': self.sn, 'telephoneNumber': self.phone,
+            'description': self.description
+        }
+        return Account((self.dn, {attr: [value.encode('utf-8')] for attr, value in values.items() if value}))
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['page', 'dn'], name='unique_directory_entry_dn')]
+        indexes = [
+            models.Index(fields=['page', 'uid'], name='directory_entry_uid'),
+            models.Index(fields=['page', 'email_key'], name='directory_entry_email'),
+            models.Index(fields=['page', 'cn_key'], name='directory_entry_cn'),
+            models.Index(fields=['page', 'sn_key'], name='directory_entry_sn'),
+            GinIndex(fields=['name_keys'], name='directory_entry_name_keys'),
+            GinIndex(fields=['sn_normalized'], name='directory_entry_sn_trigrams', opclasses=['gin_trgm_ops']),
+        ]
+
+
+class DirectorySyncState(models.Model):
+    '''How far we've gotten in mirroring a DIT.'''
+    page = models.OneToOneField(
+        'jpledrnbiokeyusermgmt.DirectoryInformationTree', on_delete=models.CASCADE, primary_key=True,
+        related_name='mirror_state'
+    )
+    full_sync_at = models.DateTimeField(null=True, blank=True, help_text='When the last full sync started')
+    polled_at = models.DateTimeField(null=True, blank=True, help_text='When the last successful sync started')
+    high_water = models.CharField(max_length=32, blank=True, help_text='Newest modifyTimestamp seen')
+    entries = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'Mirror of {self.page_id} as of {self.polled_at}'
+
+
+# Lookups
+# -------
+
+def _fresh_states(dit) -> models.QuerySet:
+    max_staleness = getattr(settings, 'BIOKEY_MIRROR_MAX_STALENESS', _default_max_staleness)
+    cutoff = timezone.now() - datetime.timedelta(seconds=max_staleness)
+    return DirectorySyncState.objects.filter(page_id=dit.pk, polled_at__gte=cutoff)
+
+
+def mirror_is_fresh(dit) -> bool:
+    '''Tell if the mirror of `dit` is recent enough to answer lookups instead of the directory.'''
+    if not getattr(settings, 'BIOKEY_DIRECTORY_MIRROR', False): return False
+    return _fresh_states(dit).exists()
+
+
+async def amirror_is_fresh(dit) -> bool:
+    '''Asynchronously tell if the mirror of `dit` is fresh; see `mirror_is_fresh`.'''
+    if not getattr(settings, 'BIOKEY_DIRECTORY_MIRROR', False): return False
+    return await _fresh_states(dit).aexists()
+
+
+def mirrored_accounts_by_email(email: str, dit) -> list[Account]:
+    return [i.account() for i in DirectoryEntry.objects.filter(page_id=dit.pk, email_key=email.lower())]
+
+
+async def amirrored_accounts_by_email(email: str, dit) -> list[Account]:
+    return [i.account() async for i in DirectoryEntry.objects.filter(page_id=dit.pk, email_key=email.lower())]
+
+
+def mirrored_potential_accounts(fn: str, ln: str, dit) -> list[str]:
+    '''Find the email addresses of accounts whose names resemble `fn` `ln`, most alike first.
+
+    The surname must share a key with `ln` or be similar to it by trigrams; if there's a `fn`,
+    the given name must share a key with it too. We return at most `BIOKEY_NAME_MATCH_LIMIT`.
+
+    Surnames with no letters we can key, like 李, fall back to the exact match the directory
+    itself would make: on the common name `fn` `ln`, or on the surname alone if there's no `fn`.
+    '''
+    surname, given, sn = surname_keys(ln), given_name_keys(fn), normalize(ln)
+    similarity = getattr(settings, 'BIOKEY_NAME_MATCH_SIMILARITY', _default_name_similarity)
+    limit = getattr(settings, 'BIOKEY_NAME_MATCH_LIMIT', _default_name_match_limit)
+    if not surname:
+        entries = DirectoryEntry.objects.filter(page_id=dit.pk).exclude(email='')
+        entries = entries.filter(cn_key=f'{fn} {ln}'.lower()) if fn else entries.filter(sn_key=ln.lower())
+        return sorted(set(entries.values_list('email', flat=True)))[:limit]
+
+    # `trigram_similar` narrows by the index at pg_trgm's own threshold; we then apply ours
+    entries = DirectoryEntry.objects.filter(page_id=dit.pk).exclude(email='').annotate(
+        similarity=TrigramSimilarity('sn_normalized', sn)
+    ).filter(Q(name_keys__overlap=sorted(surname)) | Q(sn_normalized__trigram_similar=sn, similarity__gte=similarity))
+    if given: entries = entries.filter(name_keys__overlap=sorted(given))
+    emails = []
+    for email in entries.order_by('-similarity', 'email').values_list('email', flat=True)[:limit * 2]:
+        if email not in emails: emails.append(email)
+    return emails[:limit]
+
+
+# Updates
+# -------
+
+def _first(attrs: dict, attr: str) -> str:
+    values = attrs.get(attr)
+    return values[0].decode('utf-8') if values else ''
+
+
+def _entry(dit, dn: str, attrs: dict, now: datetime.datetime) -> DirectoryEntry:
+    email, cn, sn = _first(attrs, 'mail'), _first(attrs, 'cn'), _first(attrs, 'sn')
+    return DirectoryEntry(
+        page_id=dit.pk, dn=dn, uid=_first(attrs, 'uid'), email=email, email_key=email.lower(), cn=cn,
+        cn_key=cn.lower(), sn=sn, sn_key=sn.lower(), sn_normalized=normalize(sn), name_keys=name_keys(cn, sn),
+        phone=_first(attrs, 'telephoneNumber'), description=_first(attrs, 'description'),
+        modified=_first(attrs, 'modifyTimestamp'), synced_at=now
+    )
+
+
+_updated_fields = [
+    'uid', 'email', 'email_key', 'cn', 'cn_key', 'sn', 'sn_key', 'sn_normalized', 'name_keys', 'phone', 'description',
+    'modified', 'synced_at'
+]
+
+
+def _save(entries: list[DirectoryEntry]):
+    if entries:
+        DirectoryEntry.objects.bulk_create(
+            entries, update_conflicts=True, unique_fields=['page', 'dn'], update_fields=_updated_fields
+        )
+
+
+def mirror_account(dit, account: Account):
+    '''Put `account`, just written to the directory of `dit`, into the mirror right away.'''
+    attrs = {attr: account._raw[attr] for attr, required in _account_fields.values() if attr in account._raw}
+    attrs['description'] = account._raw.get('description', [])
+    _save([_entry(dit, account.dn, attrs, timezone.now())])
+
+
+def forget_account(dit, uid: str):
+    '''Take the account `uid`, just deleted from the directory of `dit`, out of the mirror.'''
+    DirectoryEntry.objects.filter(page_id=dit.pk, uid=uid).delete()
+
+
+def _pull(dit, filterstr: str, now: datetime.datetime) -> tuple[int, str]:
+    '''Copy every entry in `dit` matching `filterstr` into the mirror a page at a time.
+
+    Return how many entries there were and the newest `modifyTimestamp` among them.
+    '''
+    from ._ldap import _attribute_sets, ldap_connection, paged_search
+    from ._routing import read_uris
+
+    attrlist = _attribute_sets['account'] + ['modifyTimestamp']
+    count, high_water, batch = 0, '', []
+    with ldap_connection(dit, read_uris(dit)[0]) as connection:
+        for dn, attrs in paged_search(connection, dit.user_base, dit.user_scope, filterstr, attrlist):
+            entry = _entry(dit, dn, attrs, now)
+            high_water = max(high_water, entry.modified)
+            batch.append(entry)
+            count += 1
+            if len(batch) >= _batch_size:
+                _save(batch)
+                batch = []
+    _save(batch)
+    return count, high_water
+
+
+def _sweep(dit) -> int:
+    '''Take every entry the directory of `dit` no longer has out of the mirror; return how many.
+
+    This asks only for DNs, with no attributes, so it's cheap enough to do on every poll.
+    '''
+    from ._ldap import ldap_connection, paged_search
+    from ._routing import read_uris
+
+    with ldap_connection(dit, read_uris(dit)[0]) as connection:
+        dns = {dn.lower() for dn, attrs in paged_search(connection, dit.user_base, dit.user_scope, '(uid=*)', ['1.1'])}
+    size_limit = getattr(settings, 'BIOKEY_LDAP_SIZE_LIMIT', None)
+    if size_limit and len(dns) >= size_limit:
+        _logger.warning('Cannot sweep the mirror of %s since the size limit cut its DNs short', dit.slug)
+        return 0
+    mirrored = DirectoryEntry.objects.filter(page_id=dit.pk).values_list('pk', 'dn')
+    gone = [pk for pk, dn in mirrored.iterator() if dn.lower() not in dns]
+    for i in range(0, len(gone), _batch_size):
+        DirectoryEntry.objects.filter(pk__in=gone[i:i + _batch_size]).delete()
+    return len(gone)
+
+
+def _key_names(dit) -> int:
+    '''Compute the name keys of entries in the mirror of `dit` that don't have any; return how many got some.
+
+    Entries mirrored before we had name keys have none, and neither do those whose surnames have
+    no letters we can key, like 李. Recomputing from the names we already have tells them apart
+    without a trip to the directory, and only the former get written.
+    '''
+    unkeyed = DirectoryEntry.objects.filter(page_id=dit.pk, sn_normalized='', name_keys=[]).exclude(sn='')
+    keyed, batch = 0, []
+    for entry in unkeyed.only('cn', 'sn').iterator(chunk_size=_batch_size):
+        entry.sn_normalized, entry.name_keys = normalize(entry.sn), name_keys(entry.cn, entry.sn)
+        if not entry.sn_normalized and not entry.name_keys: continue
+        batch.append(entry)
+        if len(batch) >= _batch_size:
+            DirectoryEntry.objects.bulk_update(batch, ['sn_normalized', 'name_keys'])
+            keyed, batch = keyed + len(batch), []
+    DirectoryEntry.objects.bulk_update(batch, ['sn_normalized', 'name_keys'])
+    return keyed + len(batch)
+
+
+def sync_mirror(dit, full: bool = False) -> DirectorySyncState:
+    '''Bring the mirror of `dit` up to date.
+
+    Do a full sync if asked, if there's never been one, or if the last one was more than
+    `BIOKEY_MIRROR_FULL_SYNC_PERIOD` seconds ago; otherwise just pick up what's changed.
+    '''
+    from ldap.filter import filter_format
+
+    state, created = DirectorySyncState.objects.get_or_create(page_id=dit.pk)
+    period = getattr(settings, 'BIOKEY_MIRROR_FULL_SYNC_PERIOD', _default_full_sync_period)
+    now = timezone.now()
+    full = full or not state.high_water or not state.full_sync_at or (
+        now - state.full_sync_at > datetime.timedelta(seconds=period)
+    )
+    if full:
+        _logger.info('Fully synchronizing the mirror of %s', dit.slug)
+        count, high_water = _pull(dit, '(uid=*)', now)
+        swept, _ = DirectoryEntry.objects.filter(page_id=dit.pk, synced_at__lt=now).delete()
+        _logger.info('Mirrored %d entries of %s and swept %d that are gone', count, dit.slug, swept)
+        state.full_sync_at = now
+    else:
+        # Entries modified in the same second as the high water mark come back again; that's harmless
+        filterstr = filter_format('(&(uid=*)(modifyTimestamp>=%s))', [state.high_water])
+        count, high_water = _pull(dit, filterstr, now)
+        swept = _sweep(dit)
+        _logger.info(
+            'Mirrored %d changed entries of %s since %s and swept %d that are gone', count, dit.slug, state.high_water,
+            swept
+        )
+        keyed = _key_names(dit)
+        if keyed: _logger.info('Computed name keys for %d entries of %s mirrored without them', keyed, dit.slug)
+    state.polled_at, state.high_water = now, max(state.high_water, high_water)
+    state.entries = DirectoryEntry.objects.filter(page_id=dit.pk).count()
+    state.save()
+    return state
@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: remembering lookups that found nothing.
+
+Anyone can type any username or email address into the forgotten details form or a password
+reset link, and bots do, over and over. Each of those would cost a directory search that
+finds nothing. So when a lookup by uid or email comes up empty, we remember that in the shared
+cache (which is Redis) for `BIOKEY_NEGATIVE_CACHE_TTL` seconds, and asking again in that time
+gets the same empty answer without a search. Setting it to 0 turns this off.
+
+Creating an account forgets any misses for its uid and email address, so a brand new account
+is found right away. Accounts made some other way (by an administrator straight in the
+directory, say) turn up once the miss expires.
+
+Like name reservations, misses are keyed by where users live rather than which page asked,
+since several DITs may share a directory. The uid or address itself is hashed into the key so
+arbitrary input can't make odd or outsized keys. If the cache is unreachable, every lookup
+just goes to the directory.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+import hashlib, logging
+
+
+_logger = logging.getLogger(__name__)
+
+_default_ttl = 60  # seconds
+
+
+def _ttl() -> int:
+    return getattr(settings, 'BIOKEY_NEGATIVE_CACHE_TTL', _default_ttl)
+
+
+def _miss_key(dit, kind: str, value: str) -> str:
+    '''Make the cache key for a miss looking up `kind` (`uid` or `mail`) `value` in `dit`.'''
+    where = hashlib.sha1(f'{dit.uri}\0{dit.user_base}'.encode('utf-8')).hexdigest()
+    what = hashlib.sha1(value.strip().lower().encode('utf-8')).hexdigest()
+    return f'biokey:ldap-miss:{where}:{kind}:{what}'
+
+
+def _keys(dit, uid: str | None, email: str | None) -> list[str]:
+    return [_miss_key(dit, kind, value) for kind, value in (('uid', uid), ('mail', email)) if value]
+
+
+def known_miss(dit, kind: str, value: str) -> bool:
+    '''Tell if looking up `kind` `value` in `dit` recently found nothing.'''
+    if _ttl() <= 0 or not value: return False
+    try:
+        return cache.get(_miss_key(dit, kind, value)) is not None
+    except Exception as ex:
+        _logger.warning('Cannot check for a miss on %s «%s» in %s due to %r; searching', kind, value, dit.slug, ex)
+        return False
+
+
+async def aknown_miss(dit, kind: str, value: str) -> bool:
+    '''Asynchronously tell if looking up `kind` `value` in `dit` recently found nothing; see `known_miss`.'''
+    if _ttl() <= 0 or not value: return False
+    try:
+        return await cache.aget(_miss_key(dit, kind, value)) is not None
+    except Exception as ex:
+        _logger.warning('Cannot check for a miss on %s «%s» in %s due to %r; searching', kind, value, dit.slug, ex)
+        return False
+
+
+def record_miss(dit, kind: str, value: str):
+    '''Remember that looking up `kind` `value` in `dit` just found nothing.'''
+    ttl = _ttl()
+    if ttl <= 0 or not value: return
+    try:
+        cache.set(_miss_key(dit, kind, value), 1, ttl)
+    except Exception as ex:
+        _logger.warning('Cannot remember the miss on %s «%s» in %s due to %r', kind, value, dit.slug, ex)
+
+
+async def arecord_miss(dit, kind: str, value: str):
+    '''Asynchronously remember that looking up `kind` `value` in `dit` found nothing; see `record_miss`.'''
+    ttl = _ttl()
+    if ttl <= 0 or not value: return
+    try:
+        await cache.aset(_miss_key(dit, kind, value), 1, ttl)
+    except Exception as ex:
+        _logger.warning('Cannot remember the miss on %s «%s» in %s due to %r', kind, value, dit.slug, ex)
+
+
+def forget_misses(dit, uid: str | None = None, email: str | None = None):
+    '''Forget any misses on `uid` and `email` in `dit`, such as when an account with them has just been made.'''
+    if _ttl() <= 0: return
+    try:
+        cache.delete_many(_keys(dit, uid, email))
+    except Exception as ex:
+        _logger.warning('Cannot forget misses on «%s» and «%s» in %s due to %r', uid, email, dit.slug, ex)
@@ -0,0 +1,238 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: fuzzy name keys.
+
+To tell people signing up that they might already have an account, we match the name they
+give against the names of existing accounts loosely. Each name becomes a set of keys:
+
+•   Normalized tokens: lowercase, accents and punctuation stripped, hyphenated and multi-part
+    surnames split into their parts (plus the parts run together), so "Núñez-García" has keys
+    for "nunez", "garcia", and "nunezgarcia".
+•   Phonetic codes in the manner of Double Metaphone, with a primary and (where the spelling
+    is ambiguous) an alternate code, so "Smith" and "Smyth" or "Katherine" and "Catherine" share
+    a key.
+•   For given names, the formal names that a nickname is short for, so "Bob" and "Robert" share
+    a key.
+
+Surname keys start with `s:` and `S:` (normalized and phonetic); given name keys with `g:` and
+`G:`. Two names are candidates for a match when they share a surname key and, if a given name
+was provided, a given name key. The mirror also indexes normalized surnames by trigram to
+catch typos that the keys miss.
+'''
+
+import re, unicodedata
+
+
+_max_code_length = 6
+
+# Letters that don't decompose into a base letter plus combining marks
+_transliterations = str.maketrans({
+    'ß': 'ss', 'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'đ': 'd', 'ð': 'd', 'þ': 'th', 'ł': 'l', 'ı': 'i',
+})
+
+_separators = re.compile(r"[\s\-‐‑–—_/.,]+")
+_non_letters = re.compile(r"[^a-z]+")
+
+# Name particles we drop from surnames when other parts remain, so "van der Berg" matches "Berg"
+_particles = frozenset({'van', 'von', 'der', 'den', 'de', 'del', 'della', 'di', 'da', 'du', 'la', 'le', 'st', 'y'})
+
+# Titles before names and suffixes after them, which say nothing about who someone is
+_honorifics = frozenset({'dr', 'mr', 'mrs', 'ms', 'miss', 'mx', 'prof', 'professor', 'sir', 'dame', 'rev'})
+_suffixes = frozenset({'jr', 'sr', 'ii', 'iii', 'iv', 'phd', 'md', 'esq', 'dds', 'mph'})
+
+# Nicknames and short forms, each with the formal names it can stand for
+_nicknames = {
+    'abby': ['abigail'], 'al': ['albert', 'alan', 'alexander', 'alfred'], 'alex': ['alexander', 'alexandra'],
+    'andy': ['andrew'], 'angie': ['angela'], 'ben': ['benjamin'], 'beth': ['elizabeth'], 'betty': ['elizabeth'],
+    'bill': ['william'], 'billy': ['william'], 'bob': ['robert'], 'bobby': ['robert'], 'cathy': ['catherine'],
+    'charlie': ['charles'], 'chris': ['christopher', 'christine', 'christina'], 'chuck': ['charles'],
+    'dan': ['daniel'], 'danny': ['daniel'], 'dave': ['david'], 'deb': ['deborah'], 'debbie': ['deborah'],
+    'dick': ['richard'], 'don': ['donald'], 'ed': ['edward', 'edwin'], 'eddie': ['edward'], 'frank': ['francis'],
+    'fred': ['frederick'], 'gene': ['eugene'], 'greg': ['gregory'], 'hank': ['henry'], 'harry': ['henry'],
+    'jack': ['john'], 'jake': ['jacob'], 'jan': ['janet', 'janice'], 'jen': ['jennifer'], 'jenny': ['jennifer'],
+    'jeff': ['jeffrey'], 'jim': ['james'], 'jimmy': ['james'], 'joe': ['joseph'], 'johnny': ['john'],
+    'jon': ['jonathan'], 'kate': ['katherine'], 'kathy': ['katherine'], 'katie': ['katherine'],
+    'ken': ['kenneth'], 'kim': ['kimberly'], 'larry': ['lawrence'], 'liz': ['elizabeth'], 'maggie': ['margaret'],
+    'matt': ['matthew'], 'meg': ['margaret'], 'mike': ['michael'], 'mickey': ['michael'], 'nate': ['nathan'],
+    'nick': ['nicholas'], 'pam': ['pamela'], 'pat': ['patrick', 'patricia'], 'peg': ['margaret'],
+    'peggy': ['margaret'], 'pete': ['peter'], 'phil': ['philip'], 'rich': ['richard'], 'rick': ['richard'],
+    'rob': ['robert'], 'ron': ['ronald'], 'sam': ['samuel', 'samantha'], 'sandy': ['sandra'],
+    'steve': ['stephen', 'steven'], 'sue': ['susan'], 'susie': ['susan'], 'ted': ['edward', 'theodore'],
+    'terry': ['terence', 'teresa'], 'tim': ['timothy'], 'tom': ['thomas'], 'tommy': ['thomas'],
+    'tony': ['anthony'], 'vicky': ['victoria'], 'will': ['william'],
+}
+
+
+def normalize(name: str) -> str:
+    '''Lowercase `name`, strip its accents, and turn runs of punctuation and space into single spaces.'''
+    name = unicodedata.normalize('NFKD', name.casefold().translate(_transliterations))
+    name = ''.join(c for c in name if not unicodedata.combining(c)).replace("'", '').replace('’', '')
+    return ' '.join(_non_letters.sub('', part) for part in _separators.split(name) if _non_letters.sub('', part))
+
+
+def _strip_titles(tokens: list[str]) -> list[str]:
+    '''Drop honorifics from the start of `tokens` and suffixes from the end, so long as one token's left.'''
+    start, end = 0, len(tokens)
+    while start < end - 1 and tokens[start] in _honorifics: start += 1
+    while end - 1 > start and tokens[end - 1] in _suffixes: end -= 1
+    return tokens[start:end]
+
+
+def _tokens(name: str, particles: bool = False) -> list[str]:
+    tokens = _strip_titles(normalize(name).split())
+    if particles:
+        kept = [i for i in tokens if i not in _particles]
+        tokens = kept or tokens
+    return tokens
+
+
+# Phonetic Codes
+# --------------
+
+_vowels = frozenset('aeiouy')
+
+
+def phonetic(word: str) -> tuple[str, str]:
+    '''Encode the normalized `word` into primary and alternate codes in the manner of Double Metaphone.
+
+    This covers the spellings that trip up English, German, Romance, and Slavic names most; it
+    isn't a full Double Metaphone, but like it, names that sound alike mostly share a code.
+    '''
+    primary, alternate, i, n = [], [], 0, len(word)
+
+    def at(offset: int, *options: str) -> bool:
+        return any(word.startswith(o, i + offset) for o in options)
+
+    def add(main: str, alt: str | None = None):
+        alt = main if alt is None else alt
+        if primary and primary[-1] == main and alternate[-1] == alt and word[i - 1] not in _vowels:
+            return  # "dt", "ck", and the like sound once
+        primary.append(main)
+        alternate.append(alt)
+
+    if at(0, 'gn', 'kn', 'pn', 'wr', 'ps'): i += 1
+    if at(0, 'x'):
+        add('S')
+        i += 1
+    while i < n and len(primary) < _max_code_length * 2:
+        c = word[i]
+        if c in _vowels:
+            if i == 0: add('A')
+            i += 1
+            continue
+        step = 2 if i + 1 < n and word[i + 1] == c and c != 'c' else 1
+        if c == 'b':
+            if not (i == n - 1 and i > 0 and word[i - 1] == 'm'): add('P')
+        elif c == 'c':
+            if at(0, 'ch'):
+                add('X', 'K')
+                step = 2
+            elif at(0, 'cia'):
+                add('X')
+            elif at(1, 'i', 'e', 'y'):
+                add('S')
+            elif at(0, 'ck', 'cc', 'cq', 'cg'):
+                add('K')
+                step = 2
+            else:
+                add('K')
+        elif c == 'd':
+            if at(0, 'dge', 'dgi', 'dgy'):
+                add('J')
+                step = 2
+            else:
+                add('T')
+        elif c == 'g':
+            if at(1, 'h'):
+                if i == 0 or word[i - 1] not in _vowels: add('K')
+                step = 2
+            elif at(1, 'n'):
+                if i + 2 < n: add('K')
+            elif at(1, 'i', 'e', 'y'):
+                add('J', 'K')
+            else:
+                add('K')
+        elif c == 'h':
+            if (i == 0 or word[i - 1] in _vowels) and at(1, *_vowels): add('H')
+        elif c == 'j':
+            add('J', 'H')
+        elif c == 'k':
+            if i == 0 or word[i - 1] != 'c': add('K')
+        elif c == 'p':
+            if at(1, 'h'):
+                add('F')
+                step = 2
+            else:
+                add('P')
+        elif c == 'q':
+            add('K')
+        elif c == 's':
+            if at(0, 'sch'):
+                add('SK', 'X')
+                step = 3
+            elif at(0, 'sh', 'sio', 'sia'):
+                add('X')
+                step = 2 if at(0, 'sh') else 1
+            elif at(0, 'sz'):
+                add('S', 'X')
+                step = 2
+            else:
+                add('S')
+        elif c == 't':
+            if at(0, 'tio', 'tia'):
+                add('X')
+            elif at(0, 'thom', 'tham'):
+                add('T')
+                step = 2
+            elif at(0, 'th'):
+                add('0', 'T')
+                step = 2
+            elif not at(0, 'tch'):
+                add('T')
+        elif c == 'v':
+            add('F')
+        elif c == 'w':
+            if i == 0 and at(1, *_vowels): add('A', 'F')
+        elif c == 'x':
+            add('KS')
+        elif c == 'z':
+            add('S', 'TS')
+        else:
+            add(c.upper())
+        i += step
+    return ''.join(primary)[:_max_code_length], ''.join(alternate)[:_max_code_length]
+
+
+def _phonetic_keys(prefix: str, tokens: list[str]) -> set[str]:
+    return {prefix + code for token in tokens for code in phonetic(token) if code}
+
+
+# Keys
+# ----
+
+def surname_keys(ln: str) -> set[str]:
+    '''Get the keys for the surname `ln`.'''
+    tokens = _tokens(ln, particles=True)
+    keys = {'s:' + i for i in tokens} | _phonetic_keys('S:', tokens)
+    if len(tokens) > 1: keys.add('s:' + ''.join(tokens))
+    return keys
+
+
+def given_name_keys(fn: str) -> set[str]:
+    '''Get the keys for the given name `fn`, including the formal names it may be short for.'''
+    tokens = _tokens(fn)[:1]  # Middle names vary too much between records to help
+    formal = [name for token in tokens for name in _nicknames.get(token, [])]
+    return {'g:' + i for i in tokens + formal} | _phonetic_keys('G:', tokens + formal)
+
+
+def split_name(cn: str, sn: str) -> str:
+    '''Get the given name out of the common name `cn` of someone surnamed `sn`, less any titles.'''
+    tokens, surname = _strip_titles(normalize(cn).split()), _strip_titles(normalize(sn).split())
+    if surname and tokens[-len(surname):] == surname:
+        return ' '.join(tokens[:-len(surname)])
+    return ' '.join(tokens[:-1])
+
+
+def name_keys(cn: str, sn: str) -> list[str]:
+    '''Get every key for the person with common name `cn` and surname `sn`.'''
+    return sorted(surname_keys(sn) | given_name_keys(split_name(cn, sn)))
@@ -8,21 +8,40 @@ from django.http import HttpRequest
 from wagtail.models import Site
 
 
-def make_pwreset_url(slug: str, uid: str, token: str, request: HttpRequest) -> str:
-    '''Create a password reset URL suitable for the pattern in `urls.py`.'''
-
+def request_site(request: HttpRequest | None = None) -> Site:
+    '''Find the site serving `request`, or the default site if there's no `request` or no such site.'''
     current_site = Site.find_for_request(request)
     if not current_site:
         current_site = Site.objects.get(is_default_site=True)
-
-    scheme = 'https' if request.is_secure() else 'http'
-    base_url = f'{scheme}://{current_site.hostname}'
-    if current_site.port and current_site.port not in (80, 443):
-        base_url += f':{current_site.port}'
+    return current_site
+
+
+def site_base_url(request: HttpRequest | None = None) -> str:
+    '''Make the base URL (scheme, host, port, and script name) of the site serving `request`.
+
+    Without a `request`, as in a Celery task, use the default site and its root URL.
+    '''
+    current_site = request_site(request)
+    if request is not None:
+        scheme = 'https' if request.is_secure() else 'http'
+        base_url = f'{scheme}://{current_site.hostname}'
+        if current_site.port and current_site.port not in (80, 443):
+            base_url += f':{current_site.port}'
+    else:
+        base_url = current_site.root_url
     if settings.FORCE_SCRIPT_NAME:
         base_url += settings.FORCE_SCRIPT_NAME
+    return base_url
+
+
+def make_pwreset_url(
+    slug: str, uid: str, token: str, request: HttpRequest | None = None, base_url: str | None = None
+) -> str:
+    '''Create a password reset URL suitable for the pattern in `urls.py`.
 
-    return f'{base_url}/pwreset/{slug}/{uid}/{token}'
+    Work outside of a request by giving the `base_url` that `site_base_url` made while there was one.
+    '''
+    return f'{base_url or site_base_url(request)}/pwreset/{slug}/{uid}/{token}'
 
 
 # In retrospect, this shouldn't be a view, but a child page of the
@@ -0,0 +1,216 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: pooled LDAP connections.
+
+Binding to the directory over ldaps means a TCP connect, a TLS handshake, and a bind
+before we can do any real work, so we keep bound manager connections around between
+requests. There's one pool per (URI, manager DN) pair; each pool keeps up to
+`BIOKEY_LDAP_POOL_SIZE` idle connections. If more connections than that are needed at
+once, extras are made on demand and closed when they're returned.
+
+Connections are `ReconnectLDAPObject`s, so a `SERVER_DOWN` in the middle of an operation
+causes a reconnect and a rebind as the manager before the operation is retried. Each DIT sets
+how long to wait to connect, to bind, and for each operation, so a hung server raises
+`ldap.TIMEOUT` (or `SERVER_DOWN`) instead of holding a worker forever.
+
+Gunicorn's `preload_app` means the master process imports (and could use) this module
+before forking the workers. A child must never share a socket with its parent, so after
+a fork we forget every inherited pool and start fresh.
+'''
+
+from ._breaker import _unavailable
+from contextlib import contextmanager
+from django.conf import settings
+from typing import NamedTuple
+import collections, ldap, ldap.ldapobject, logging, os, threading, time
+
+
+_logger = logging.getLogger(__name__)
+
+_default_pool_size      = 4
+_default_max_idle       = 300   # seconds
+_default_check_interval = 30    # seconds
+_default_retry_max      = 2
+_default_retry_delay    = 0.5   # seconds
+
+
+class Timeouts(NamedTuple):
+    '''Seconds to wait to connect, to bind, and for an operation's results; 0 waits forever.'''
+    connect: float = 5.0
+    bind: float = 5.0
+    operation: float = 30.0
+
+
+class _PooledConnection:
+    '''A bound LDAP connection plus when it was last handed back to the pool.'''
+    __slots__ = ('connection', 'last_used')
+
+    def __init__(self, connection: ldap.ldapobject.LDAPObject):
+        self.connection, self.last_used = connection, time.monotonic()
+
+
+class LDAPConnectionPool:
+    '''A pool of LDAP connections to the server at `uri` bound as `bind_dn`.'''
+
+    def __init__(self, uri: str, bind_dn: str, password: str, timeouts: Timeouts = Timeouts()):
+        self.uri, self.bind_dn, self.password, self.timeouts = uri, bind_dn, password, timeouts
+        self.hits = self.misses = self.evictions = self.failures = 0
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return getattr(settings, 'BIOKEY_LDAP_POOL_SIZE', _default_pool_size)
+
+    @property
+    def max_idle(self) -> float:
+        return getattr(settings, 'BIOKEY_LDAP_POOL_MAX_IDLE', _default_max_idle)
+
+    @property
+    def check_interval(self) -> float:
+        return getattr(settings, 'BIOKEY_LDAP_POOL_CHECK_INTERVAL', _default_check_interval)
+
+    def _connect(self) -> _PooledConnection:
+        _logger.debug('Opening new LDAP connection to %s as %s', self.uri, self.bind_dn)
+        connection = ldap.ldapobject.ReconnectLDAPObject(
+            self.uri,
+            retry_max=getattr(settings, 'BIOKEY_LDAP_RETRY_MAX', _default_retry_max),
+            retry_delay=getattr(settings, 'BIOKEY_LDAP_RETRY_DELAY', _default_retry_delay),
+        )
+        if self.timeouts.connect > 0: connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeouts.connect)
+        # Synchronous operations wait `timeout` seconds for their results, or forever if it's -1
+        connection.timeout = self.timeouts.bind or -1
+        connection.simple_bind_s(self.bind_dn, self.password)
+        connection.timeout = self.timeouts.operation or -1
+        return _PooledConnection(connection)
+
+    def _close(self, entry: _PooledConnection):
+        try:
+            entry.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _healthy(self, entry: _PooledConnection) -> bool:
+        '''Check if the pooled `entry` still talks to the server with a cheap "Who am I?"'''
+        try:
+            entry.connection.whoami_s()
+            return True
+        except ldap.LDAPError as ex:
+            _logger.info('Pooled LDAP connection to %s failed its health check: %s', self.uri, ex)
+            return False
+
+    def acquire(self) -> _PooledConnection:
+        '''Get a bound connection, re-using an idle one if we can.'''
+        now, entry, stale = time.monotonic(), None, []
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if now - candidate.last_used > self.max_idle:
+                    stale.append(candidate)
+                    self.evictions += 1
+                else:
+                    entry = candidate
+                    break
+        for candidate in stale:
+            self._close(candidate)
+        if entry is not None and now - entry.last_used > self.check_interval and not self._healthy(entry):
+            self._close(entry)
+            entry = None
+            with self._lock:
+                self.failures += 1
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return self._connect()
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def release(self, entry: _PooledConnection, broken: bool = False):
+        '''Give `entry` back to the pool, or close it if it's `broken` or the pool is full.'''
+        entry.last_used = time.monotonic()
+        if not broken:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(entry)
+                    return
+        self._close(entry)
+
+    def clear(self):
+        '''Close every idle connection in the pool.'''
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for entry in idle:
+            self._close(entry)
+
+    def statistics(self) -> dict:
+        with self._lock:
+            return {
+                'uri': self.uri, 'bind_dn': self.bind_dn, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'failures': self.failures, 'idle': len(self._idle), 'size': self.size,
+            }
+
+
+_pools: dict[tuple[str, str], LDAPConnectionPool] = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+# Connections inherited across a fork still share their sockets with the parent process.
+# Letting them be garbage collected would send an LDAP unbind over the parent's socket, so
+# the child just holds on to them and never uses them.
+_orphaned_pools: list[LDAPConnectionPool] = []
+
+
+def _forget_pools_after_fork():
+    global _pools, _pools_lock, _pools_pid
+    _orphaned_pools.extend(_pools.values())
+    _pools, _pools_lock, _pools_pid = {}, threading.Lock(), os.getpid()
+
+
+os.register_at_fork(after_in_child=_forget_pools_after_fork)
+
+
+def get_pool(uri: str, bind_dn: str, password: str, timeouts: Timeouts = Timeouts()) -> LDAPConnectionPool:
+    '''Get the pool for `uri` and `bind_dn` whose connections use `timeouts`, making it if necessary.'''
+    if os.getpid() != _pools_pid:
+        # Belt and braces for forks that don't go through `os.fork`
+        _forget_pools_after_fork()
+    key = (uri, bind_dn)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = LDAPConnectionPool(uri, bind_dn, password, timeouts)
+    if pool.password != password:
+        _logger.info('Manager password for %s at %s changed; emptying its pool', bind_dn, uri)
+        pool.password = password
+        pool.clear()
+    if pool.timeouts != timeouts:
+        _logger.info('Timeouts for %s at %s changed to %r; emptying its pool', bind_dn, uri, timeouts)
+        pool.timeouts = timeouts
+        pool.clear()
+    return pool
+
+
+@contextmanager
+def pooled_connection(uri: str, bind_dn: str, password: str, timeouts: Timeouts = Timeouts()):
+    '''Context manager that lends out a bound connection from the appropriate pool.
+
+    A connection that times out may still have an operation outstanding on a hung server, so
+    it's closed rather than lent to anyone else, as is one that's gone down or can't connect.
+    '''
+    pool = get_pool(uri, bind_dn, password, timeouts)
+    entry, broken = pool.acquire(), False
+    try:
+        yield entry.connection
+    except _unavailable:
+        broken = True
+        raise
+    finally:
+        pool.release(entry, broken)
+
+
+def pool_statistics() -> list[dict]:
+    '''Report hits, misses, and so forth for every pool in this process.'''
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.statistics() for pool in pools]
@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: account name reservations.
+
+Two sign-ups for the same name at the same moment—in different gunicorn workers or even on
+different hosts—can both see a name as free in the directory. So before we add an account,
+we claim its name in the shared cache (which is Redis) with an atomic add. The claim expires
+on its own after `BIOKEY_UID_RESERVATION_TTL` seconds, which just needs to be long enough for
+the new entry to land in the directory and show up in everyone else's searches.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+import hashlib, logging, os, socket
+
+
+_logger = logging.getLogger(__name__)
+
+_default_ttl = 60  # seconds
+_owner       = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _reservation_key(dit, uid: str) -> str:
+    '''Make the cache key for `uid` in `dit`.
+
+    Several DITs may share a directory, so the key comes from where users live rather than
+    from which page is asking.
+    '''
+    where = hashlib.sha1(f'{dit.uri}\0{dit.user_base}'.encode('utf-8')).hexdigest()
+    return f'biokey:uid-reservation:{where}:{uid}'
+
+
+def reserve_account_name(dit, uid: str) -> bool:
+    '''Claim `uid` in `dit` for a new account, returning True if we got it.
+
+    If the cache is unreachable, we can't coordinate with anyone, so we press on as if the
+    claim succeeded and leave it to the directory to reject a duplicate.
+    '''
+    try:
+        ttl = getattr(settings, 'BIOKEY_UID_RESERVATION_TTL', _default_ttl)
+        return cache.add(_reservation_key(dit, uid), _owner, ttl)
+    except Exception as ex:
+        _logger.warning('Cannot reserve «%s» in %s due to %r; pressing on without a reservation', uid, dit.slug, ex)
+        return True
+
+
+def release_account_name(dit, uid: str):
+    '''Give up our claim on `uid` in `dit`, such as when adding the account failed.'''
+    try:
+        cache.delete(_reservation_key(dit, uid))
+    except Exception as ex:
+        _logger.warning('Cannot release reservation of «%s» in %s due to %r; it will expire', uid, dit.slug, ex)
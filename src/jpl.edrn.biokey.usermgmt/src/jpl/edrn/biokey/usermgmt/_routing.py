@@ -0,0 +1,160 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: routing between a directory's servers.
+
+A DIT has a primary server at `uri` and optionally some read-only replicas. Writes always go
+to the primary. Reads go to a replica chosen by health: each server keeps a running average
+of how long its operations take, and we pick the better of two replicas chosen at random so
+load spreads out while slow servers get less of it. A server that fails is skipped for
+`BIOKEY_LDAP_FAILURE_BACKOFF` seconds, and reads fail over to the next replica and finally
+to the primary.
+
+Replicas lag behind the primary a little. So after we write to an account, reads about that
+account (by uid or email address) are pinned to the primary for `BIOKEY_LDAP_PIN_SECONDS`.
+Pins live in the shared cache so they hold across worker processes, such as when a sign-up
+is followed by the new user clicking their password reset link.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+import hashlib, logging, random, threading, time
+
+
+_logger = logging.getLogger(__name__)
+
+_default_failure_backoff = 30.0   # seconds
+_default_pin_seconds     = 5.0    # seconds
+_smoothing               = 0.2    # Weight of each new sample in a server's running average
+
+
+class _ServerHealth:
+    '''How a single server has been doing, as seen from this process.'''
+    __slots__ = ('uri', 'latency', 'successes', 'failures', 'down_until')
+
+    def __init__(self, uri: str):
+        self.uri, self.latency, self.successes, self.failures, self.down_until = uri, 0.0, 0, 0, 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.down_until
+
+
+_health: dict[str, _ServerHealth] = {}
+_health_lock = threading.Lock()
+
+
+def _server(uri: str) -> _ServerHealth:
+    with _health_lock:
+        server = _health.get(uri)
+        if server is None:
+            server = _health[uri] = _ServerHealth(uri)
+        return server
+
+
+def record_success(uri: str, elapsed: float):
+    '''Note that an operation on the server at `uri` succeeded in `elapsed` seconds.'''
+    server = _server(uri)
+    with _health_lock:
+        server.latency = elapsed if server.successes == 0 else (1 - _smoothing) * server.latency + _smoothing * elapsed
+        server.successes += 1
+        server.down_until = 0.0
+
+
+def record_failure(uri: str, ex: Exception):
+    '''Note that the server at `uri` failed with `ex` and take it out of rotation for a while.'''
+    backoff = getattr(settings, 'BIOKEY_LDAP_FAILURE_BACKOFF', _default_failure_backoff)
+    _logger.warning('LDAP server %s failed (%s); avoiding it for %.1f seconds', uri, ex, backoff)
+    server = _server(uri)
+    with _health_lock:
+        server.failures += 1
+        server.down_until = time.monotonic() + backoff
+
+
+def replica_uris(dit) -> list[str]:
+    '''Get the URIs of the read-only replicas of `dit`, if any.'''
+    return [i.strip() for i in (dit.replica_uris or '').splitlines() if i.strip()]
+
+
+def _pin_key(dit, subject: str) -> str:
+    where = hashlib.sha1(f'{dit.uri}\0{dit.user_base}'.encode('utf-8')).hexdigest()
+    return f'biokey:ldap-pin:{where}:{subject.lower()}'
+
+
+def pin_to_primary(dit, *subjects: str):
+    '''Send reads about any of `subjects` (uids or email addresses) in `dit` to the primary for a while.'''
+    if not replica_uris(dit): return
+    seconds = getattr(settings, 'BIOKEY_LDAP_PIN_SECONDS', _default_pin_seconds)
+    try:
+        cache.set_many({_pin_key(dit, subject): 1 for subject in subjects if subject}, seconds)
+    except Exception as ex:
+        _logger.warning('Cannot pin reads of %r in %s to the primary due to %r', subjects, dit.slug, ex)
+
+
+async def apin_to_primary(dit, *subjects: str):
+    '''Asynchronously pin reads about `subjects` to the primary; see `pin_to_primary`.'''
+    if not replica_uris(dit): return
+    seconds = getattr(settings, 'BIOKEY_LDAP_PIN_SECONDS', _default_pin_seconds)
+    try:
+        await cache.aset_many({_pin_key(dit, subject): 1 for subject in subjects if subject}, seconds)
+    except Exception as ex:
+        _logger.warning('Cannot pin reads of %r in %s to the primary due to %r', subjects, dit.slug, ex)
+
+
+def _is_pinned(dit, subject: str | None) -> bool:
+    if not subject: return False
+    try:
+        return cache.get(_pin_key(dit, subject)) is not None
+    except Exception as ex:
+        _logger.warning('Cannot check pinning of «%s» in %s due to %r; assuming none', subject, dit.slug, ex)
+        return False
+
+
+async def _ais_pinned(dit, subject: str | None) -> bool:
+    if not subject: return False
+    try:
+        return await cache.aget(_pin_key(dit, subject)) is not None
+    except Exception as ex:
+        _logger.warning('Cannot check pinning of «%s» in %s due to %r; assuming none', subject, dit.slug, ex)
+        return False
+
+
+def _order(dit, replicas: list[str]) -> list[str]:
+    '''Order the `replicas` of `dit` best first, then the primary as the last resort.'''
+    now = time.monotonic()
+    servers = [_server(uri) for uri in replicas]
+    up = [i for i in servers if i.available(now)]
+    down = sorted((i for i in servers if not i.available(now)), key=lambda i: i.down_until)
+    if len(up) >= 2:
+        # The better of two random choices spreads load without herding onto the single best
+        first, second = random.sample(up, 2)
+        best = first if first.latency <= second.latency else second
+        up.remove(best)
+        up = [best] + sorted(up, key=lambda i: i.latency)
+    return [i.uri for i in up] + [dit.uri] + [i.uri for i in down]
+
+
+def read_uris(dit, subject: str | None = None) -> list[str]:
+    '''Get the URIs to try, in order, when reading about `subject` (a uid or email) from `dit`.'''
+    replicas = replica_uris(dit)
+    if not replicas or _is_pinned(dit, subject): return [dit.uri]
+    return _order(dit, replicas)
+
+
+async def aread_uris(dit, subject: str | None = None) -> list[str]:
+    '''Asynchronously get the URIs to try when reading about `subject`; see `read_uris`.'''
+    replicas = replica_uris(dit)
+    if not replicas or await _ais_pinned(dit, subject): return [dit.uri]
+    return _order(dit, replicas)
+
+
+def server_health(dit) -> list[dict]:
+    '''Report how the primary and replicas of `dit` are doing in this process.'''
+    now = time.monotonic()
+    report = []
+    for role, uri in [('primary', dit.uri)] + [('replica', i) for i in replica_uris(dit)]:
+        server = _server(uri)
+        with _health_lock:
+            report.append({
+                'uri': uri, 'role': role, 'latency': server.latency * 1000.0, 'successes': server.successes,
+                'failures': server.failures, 'available': server.available(now),
+            })
+    return report
@@ -4,14 +4,23 @@
 
 
 from . import PACKAGE_NAME
+from ._dedupe import deduplicate
 from ._forms import AbstractForm, AbstractFormPage
 from ._ldap import get_potential_accounts
+from ._paths import request_site, site_base_url
+from ._submissions import is_submission, new_submission, submit, withdraw
 from .constants import MAX_EMAIL_LENGTH, GENERIC_FORM_TEMPLATE, MAX_PHONE_LENGTH
+from .tasks import sign_up
 from captcha.fields import ReCaptchaField
 from django import forms
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import render
+from django.urls import reverse
+import logging
+
+
+_logger = logging.getLogger(__name__)
 
 
 class NameRequestForm(AbstractForm):
@@ -32,12 +41,44 @@ class AccountSignUpForm(NameRequestForm):
     for_self = forms.BooleanField(label='Certification', help_text=_certification_text)
 
     do_sign_up = forms.CharField(initial='1', widget=forms.HiddenInput(), required=False)
+    submission = forms.CharField(widget=forms.HiddenInput(), required=False)
 
     if not settings.DEBUG:
         captcha = ReCaptchaField()
 
+    def clean_submission(self):
+        submission = self.cleaned_data.get('submission')
+        return submission if is_submission(submission) else new_submission()
+
 
 class NameRequestFormPage(AbstractFormPage):
+    def _sign_up_later(self, request: HttpRequest, form: AccountSignUpForm, dit) -> HttpResponse | None:
+        '''Hand the sign-up in `form` to a Celery task and say it's under way; see `._submissions`.
+
+        Return None if it can't be handed off, in which case the caller should sign up right away.
+        '''
+        data, parent = form.cleaned_data, self.get_parent()
+        submission = data['submission']
+        try:
+            if submit(submission):
+                try:
+                    sign_up.delay(
+                        dit.pk, data['first_name'], data['last_name'], data['telephone'], data['email'], submission,
+                        request_site(request).pk, site_base_url(request)
+                    )
+                except Exception:
+                    withdraw(submission)
+                    raise
+        except Exception as ex:
+            _logger.warning('Cannot sign up %s in the background due to %r; signing up now', data['email'], ex)
+            return None
+        params = {
+            'email': data['email'], 'account_name': None, 'parent_url': parent.url, 'consortium': parent.title,
+            'status_url': reverse('signup_status', args=[submission])
+        }
+        return render(request, PACKAGE_NAME + '/account-created.html', params)
+
+    @deduplicate
     def serve(self, request: HttpRequest) -> HttpResponse:
         if request.method == 'POST':
             form, parent, dit = NameRequestForm(request.POST, page=self), self.get_parent(), self.get_parent().specific
@@ -46,6 +87,9 @@ class NameRequestFormPage(AbstractFormPage):
                 if do_sign_up:
                     form = AccountSignUpForm(request.POST, page=self)
                     if form.is_valid() and form.cleaned_data.get('for_self'):
+                        if getattr(settings, 'BIOKEY_ASYNC_SIGNUP', False):
+                            response = self._sign_up_later(request, form, dit)
+                            if response: return response
                         email = form.cleaned_data['email']
                         account_name = dit.create_account(
                             form.cleaned_data['first_name'], form.cleaned_data['last_name'],
@@ -69,7 +113,8 @@ class NameRequestFormPage(AbstractFormPage):
                         }
                         return render(request, PACKAGE_NAME + '/potential-emails.html', params)
                     else:
-                        form = AccountSignUpForm(initial={'first_name': fn, 'last_name': ln}, page=self)
+                        initial = {'first_name': fn, 'last_name': ln, 'submission': new_submission()}
+                        form = AccountSignUpForm(initial=initial, page=self)
 
             # Else pass through to render default
 
@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: sign-ups made in the background.
+
+Creating an account takes several trips to the directory plus a database write, and with a
+slow or busy directory that can keep a sign-up waiting for seconds. With `BIOKEY_ASYNC_SIGNUP`
+on, the sign-up page hands the work to the `.tasks.sign_up` Celery task instead and answers at
+once with a page that polls the `signup_status` view until the account's made.
+
+Each sign-up form carries a submission id of its own, and the work is keyed by it: submitting
+the same form twice queues the task once, and should the task run twice, only one run creates
+the account. The status of each submission lives in the cache for `BIOKEY_SIGNUP_STATUS_TTL`
+seconds.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+import re, uuid
+
+
+PENDING, CREATED, FAILED = 'pending', 'created', 'failed'
+
+_default_ttl   = 86400  # seconds
+_submission_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _ttl() -> int:
+    return getattr(settings, 'BIOKEY_SIGNUP_STATUS_TTL', _default_ttl)
+
+
+def _status_key(submission: str) -> str:
+    return f'biokey:signup:{submission}'
+
+
+def _claim_key(submission: str) -> str:
+    return f'biokey:signup:{submission}:claim'
+
+
+def new_submission() -> str:
+    '''Make a new, unguessable submission id for a sign-up form.'''
+    return uuid.uuid4().hex
+
+
+def is_submission(value: str) -> bool:
+    '''Tell if `value` looks like a submission id from `new_submission`.'''
+    return bool(_submission_re.match(value or ''))
+
+
+def submit(submission: str) -> bool:
+    '''Note that `submission` is pending; return False if it was already submitted.'''
+    return cache.add(_status_key(submission), {'state': PENDING}, _ttl())
+
+
+def withdraw(submission: str):
+    '''Forget `submission`, as when it couldn't be queued after all.'''
+    cache.delete(_status_key(submission))
+
+
+def claim(submission: str, worker: str) -> bool:
+    '''Claim `submission` for `worker` to create its account; return False if someone else has it.'''
+    return cache.add(_claim_key(submission), worker, _ttl())
+
+
+def release(submission: str):
+    '''Let go of `submission` so a retry can claim it.'''
+    cache.delete(_claim_key(submission))
+
+
+def finish(submission: str, account_name: str):
+    '''Note that `submission` made the account `account_name`.'''
+    cache.set(_status_key(submission), {'state': CREATED, 'account_name': account_name}, _ttl())
+
+
+def fail(submission: str):
+    '''Note that `submission` couldn't make an account.'''
+    cache.set(_status_key(submission), {'state': FAILED}, _ttl())
+
+
+def submission_status(submission: str) -> dict | None:
+    '''Tell how `submission` is going: its `state` and, once it's `CREATED`, its `account_name`.
+
+    Return None if we've never heard of it or it's been forgotten.
+    '''
+    return cache.get(_status_key(submission))
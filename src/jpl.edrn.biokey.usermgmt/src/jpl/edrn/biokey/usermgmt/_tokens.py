@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: signed password reset tokens.
+
+Classic reset tokens are random strings stored in the account's `@@biokey` description, so
+issuing one costs a directory write and checking one costs a directory read. With
+`BIOKEY_SIGNED_RESET_TOKENS` on, we issue tokens signed with `SECRET_KEY` instead. Each one
+carries the DIT slug, the uid, when it expires, and a fingerprint of the account's password
+as it was when the token was issued. Issuing needs no write at all, and a token for the wrong
+account, with a bad signature, or past its expiration is turned away without asking the
+directory anything. Once the password changes, the fingerprint no longer matches, so a token
+works only once.
+
+The fingerprint is an HMAC of the `userPassword` hash, so it gives nothing away about the
+password. Without a `userPassword` to fingerprint, as when the manager DN can't read it, a
+token would stay good until it expired, however often it was used. So no signed token is
+issued for such an account (the classic kind is, instead) and none is accepted for it.
+
+Classic tokens never contain a colon and signed tokens always do, so outstanding classic
+tokens keep working after the switch.
+'''
+
+from django.conf import settings
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+import datetime
+
+
+_salt = 'jpl.edrn.biokey.usermgmt.pwreset'
+_fingerprint_length = 16
+
+
+def signed_tokens_enabled() -> bool:
+    return getattr(settings, 'BIOKEY_SIGNED_RESET_TOKENS', False)
+
+
+def is_signed_token(token: str) -> bool:
+    return ':' in token
+
+
+def can_sign_token(account) -> bool:
+    '''Tell if `account` was read with a `userPassword` to fingerprint, so it can have a signed token.'''
+    return bool(account._raw.get('userPassword'))
+
+
+def password_fingerprint(account) -> str:
+    '''Fingerprint the current password of `account`, which must have been read with its `userPassword`.
+
+    This raises `ValueError` if it wasn't; see `can_sign_token`.
+    '''
+    if not can_sign_token(account): raise ValueError(f'No userPassword to fingerprint for {account["uid"]}')
+    password = b'\0'.join(account._raw['userPassword'])
+    return salted_hmac(_salt + '.fingerprint', password).hexdigest()[:_fingerprint_length]
+
+
+def make_signed_token(slug: str, account, expiration: datetime.datetime) -> str:
+    '''Make a signed reset token for `account` in the DIT with `slug` that expires at `expiration`.'''
+    payload = {'d': slug, 'u': account['uid'], 'x': int(expiration.timestamp()), 'f': password_fingerprint(account)}
+    return signing.dumps(payload, salt=_salt, compress=True)
+
+
+def verify_signed_token(token: str, slug: str, uid: str) -> str:
+    '''Verify the signed reset `token` for `uid` in the DIT with `slug` and return its password fingerprint.
+
+    This raises `ValueError` with the reason if the token is forged, mangled, for someone else,
+    or expired. It doesn't check the fingerprint; compare that against the account yourself.
+    '''
+    try:
+        payload = signing.loads(token, salt=_salt)
+    except signing.BadSignature:
+        raise ValueError('Bad token signature')
+    if not isinstance(payload, dict) or payload.get('d') != slug or payload.get('u') != uid:
+        raise ValueError('Token mismatch')
+    if datetime.datetime.now(datetime.timezone.utc).timestamp() > payload.get('x', 0):
+        raise ValueError('Token expired')
+    return payload.get('f', '')
+
+
+def fingerprint_matches(account, fingerprint: str) -> bool:
+    '''Tell if `fingerprint` is that of the current password of `account`; never so if it has none to read.'''
+    return can_sign_token(account) and constant_time_compare(password_fingerprint(account), fingerprint)
@@ -4,6 +4,20 @@
 
 from . import PACKAGE_NAME
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+
+def _create_trigram_extension(using: str = 'default', **kwargs):
+    '''Make sure PostgreSQL's `pg_trgm` is there for the directory mirror's trigram index.
+
+    The Docker image deletes and regenerates our migrations from the models, so a migration
+    operation for it wouldn't last; instead, create it before any migration runs.
+    '''
+    connection = connections[using]
+    if connection.vendor != 'postgresql': return
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 class BioKeyUserMgmtConfig(AppConfig):
@@ -11,3 +25,6 @@ class BioKeyUserMgmtConfig(AppConfig):
     name = PACKAGE_NAME
     label = 'jpledrnbiokeyusermgmt'
     verbose_name = 'BioKey user management'
+
+    def ready(self):
+        pre_migrate.connect(_create_trigram_extension, sender=self)
@@ -8,6 +8,10 @@ from . import PACKAGE_NAME
 # Max UID length, must be at least 4 to account for random 3 digits
 MAX_UID_LENGTH = 15
 
+# Max length of a UID we keep about accounts in a directory; names we generate and those made
+# elsewhere can be far longer than the form allows
+MAX_DIRECTORY_UID_LENGTH = 255
+
 # How long an email address can be
 MAX_EMAIL_LENGTH = 50
 
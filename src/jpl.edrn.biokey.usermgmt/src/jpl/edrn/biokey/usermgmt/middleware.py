@@ -0,0 +1,47 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: middleware.'''
+
+from . import PACKAGE_NAME
+from ._admission import DirectoryBusy
+from ._breaker import DirectoryUnavailable
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpRequest, HttpResponse
+from django.shortcuts import render
+import logging, math
+
+
+_logger = logging.getLogger(__name__)
+
+
+class DirectoryUnavailableMiddleware:
+    '''Turn `DirectoryUnavailable` (or `DirectoryBusy`) from any view into a friendly "try again soon" page.
+
+    The page comes with HTTP status 503 and a `Retry-After` header saying when the DIT's circuit
+    breaker or admission control will let a request through again. This works with both
+    synchronous and asynchronous views, so it costs nothing extra under ASGI.
+    '''
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response): markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self): return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request: HttpRequest):
+        return await self.get_response(request)
+
+    def process_exception(self, request: HttpRequest, exception: Exception) -> HttpResponse | None:
+        if not isinstance(exception, DirectoryUnavailable): return None
+        busy = isinstance(exception, DirectoryBusy)
+        _logger.info(
+            'Telling %s that the directory for %s is %s', request.path, exception.slug, 'busy' if busy else 'unavailable'
+        )
+        retry_after = math.ceil(exception.retry_after)
+        context = {'retry_after': retry_after, 'busy': busy}
+        response = render(request, PACKAGE_NAME + '/directory-unavailable.html', context, status=503)
+        response['Retry-After'] = str(retry_after)
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import jpl.edrn.biokey.usermgmt._dits
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "jpledrnbiokeyusermgmt",
+            "0007_alter_directoryinformationtree_approval_template_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="directoryinformationtree",
+            name="replica_uris",
+            field=models.TextField(
+                blank=True,
+                default="",
+                help_text="URIs to read-only replicas of the LDAP server, one per line; reads are spread across these",
+                validators=[jpl.edrn.biokey.usermgmt._dits._validate_replica_uris],
+            ),
+        ),
+    ]
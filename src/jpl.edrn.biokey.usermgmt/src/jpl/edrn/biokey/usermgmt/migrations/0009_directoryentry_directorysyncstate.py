@@ -0,0 +1,121 @@
+# Generated by Django 4.2.13 on 2026-10-18 10:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jpledrnbiokeyusermgmt", "0008_directoryinformationtree_replica_uris"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DirectorySyncState",
+            fields=[
+                (
+                    "page",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="mirror_state",
+                        serialize=False,
+                        to="jpledrnbiokeyusermgmt.directoryinformationtree",
+                    ),
+                ),
+                (
+                    "full_sync_at",
+                    models.DateTimeField(
+                        blank=True, help_text="When the last full sync started", null=True
+                    ),
+                ),
+                (
+                    "polled_at",
+                    models.DateTimeField(
+                        blank=True,
+                        help_text="When the last successful sync started",
+                        null=True,
+                    ),
+                ),
+                (
+                    "high_water",
+                    models.CharField(
+                        blank=True, help_text="Newest modifyTimestamp seen", max_length=32
+                    ),
+                ),
+                ("entries", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="DirectoryEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("dn", models.CharField(max_length=600)),
+                ("uid", models.CharField(max_length=255)),
+                ("email", models.CharField(blank=True, max_length=255)),
+                (
+                    "email_key",
+                    models.CharField(
+                        blank=True, help_text="Lowercased email", max_length=255
+                    ),
+                ),
+                ("cn", models.CharField(blank=True, max_length=255)),
+                (
+                    "cn_key",
+                    models.CharField(
+                        blank=True, help_text="Lowercased common name", max_length=255
+                    ),
+                ),
+                ("sn", models.CharField(blank=True, max_length=255)),
+                (
+                    "sn_key",
+                    models.CharField(
+                        blank=True, help_text="Lowercased surname", max_length=255
+                    ),
+                ),
+                ("phone", models.CharField(blank=True, max_length=255)),
+                ("description", models.TextField(blank=True)),
+                (
+                    "modified",
+                    models.CharField(
+                        blank=True,
+                        help_text="modifyTimestamp as the directory gave it",
+                        max_length=32,
+                    ),
+                ),
+                ("synced_at", models.DateTimeField()),
+                (
+                    "page",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="directory_entries",
+                        to="jpledrnbiokeyusermgmt.directoryinformationtree",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["page", "uid"], name="directory_entry_uid"),
+                    models.Index(
+                        fields=["page", "email_key"], name="directory_entry_email"
+                    ),
+                    models.Index(fields=["page", "cn_key"], name="directory_entry_cn"),
+                    models.Index(fields=["page", "sn_key"], name="directory_entry_sn"),
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="directoryentry",
+            constraint=models.UniqueConstraint(
+                fields=("page", "dn"), name="unique_directory_entry_dn"
+            ),
+        ),
+    ]
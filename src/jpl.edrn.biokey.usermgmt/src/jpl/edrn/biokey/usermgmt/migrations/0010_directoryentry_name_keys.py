@@ -0,0 +1,48 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:27
+
+from django.db import migrations, models
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jpledrnbiokeyusermgmt", "0009_directoryentry_directorysyncstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="directoryentry",
+            name="name_keys",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.CharField(max_length=64),
+                blank=True,
+                default=list,
+                help_text="Fuzzy name keys",
+                size=None,
+            ),
+        ),
+        migrations.AddField(
+            model_name="directoryentry",
+            name="sn_normalized",
+            field=models.CharField(
+                blank=True,
+                help_text="Surname without accents or punctuation",
+                max_length=255,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="directoryentry",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name_keys"], name="directory_entry_name_keys"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="directoryentry",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["sn_normalized"],
+                name="directory_entry_sn_trigrams",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
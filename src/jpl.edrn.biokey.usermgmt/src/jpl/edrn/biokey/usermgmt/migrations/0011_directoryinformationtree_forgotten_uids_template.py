@@ -0,0 +1,20 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jpledrnbiokeyusermgmt", "0010_directoryentry_name_keys"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="directoryinformationtree",
+            name="forgotten_uids_template",
+            field=models.TextField(
+                default='Hello!\n\nSomeone, perhaps you, asked for the usernames of the accounts that go with this email address. We found these:\n\n{accounts}\n\nYou can visit the address next to each one to change its password (if you know it), or reset the password (if forgotten).\n\nNote that if you did not request this, then simply ignore this email.\n\nThank you.\n',
+                help_text="Email template for end users to recover forgotten usernames when more than one account was found",
+            ),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "jpledrnbiokeyusermgmt",
+            "0011_directoryinformationtree_forgotten_uids_template",
+        ),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccountMetadata",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uid", models.CharField(max_length=255)),
+                (
+                    "consortium",
+                    models.CharField(
+                        blank=True,
+                        help_text="Consortium the account signed up with",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "reset_token",
+                    models.CharField(
+                        blank=True,
+                        help_text="Outstanding password reset token",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "reset_expires",
+                    models.DateTimeField(
+                        blank=True, help_text="When the reset token expires", null=True
+                    ),
+                ),
+                (
+                    "extra",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        help_text="Any other legacy @@biokey values",
+                    ),
+                ),
+                ("updated", models.DateTimeField(auto_now=True)),
+                (
+                    "page",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="account_metadata",
+                        to="jpledrnbiokeyusermgmt.directoryinformationtree",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["consortium"], name="account_metadata_consortium"
+                    ),
+                    models.Index(
+                        fields=["reset_expires"], name="account_metadata_reset"
+                    ),
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="accountmetadata",
+            constraint=models.UniqueConstraint(
+                fields=("page", "uid"), name="unique_account_metadata_uid"
+            ),
+        ),
+    ]
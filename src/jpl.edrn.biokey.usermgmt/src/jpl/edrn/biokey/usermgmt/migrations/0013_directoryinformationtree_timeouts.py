@@ -0,0 +1,40 @@
+# Generated by Django 4.2.13 on 2026-10-18 15:20
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jpledrnbiokeyusermgmt", "0012_accountmetadata"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="directoryinformationtree",
+            name="bind_timeout",
+            field=models.FloatField(
+                default=5.0,
+                help_text="Seconds to wait for a server to accept the manager DN (0 to wait forever)",
+                validators=[django.core.validators.MinValueValidator(0.0)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="directoryinformationtree",
+            name="connect_timeout",
+            field=models.FloatField(
+                default=5.0,
+                help_text="Seconds to wait to connect to a server before giving up on it (0 to wait forever)",
+                validators=[django.core.validators.MinValueValidator(0.0)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="directoryinformationtree",
+            name="operation_timeout",
+            field=models.FloatField(
+                default=30.0,
+                help_text="Seconds to wait for the results of a search or change (0 to wait forever)",
+                validators=[django.core.validators.MinValueValidator(0.0)],
+            ),
+        ),
+    ]
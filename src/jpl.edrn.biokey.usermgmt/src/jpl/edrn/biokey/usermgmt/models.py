@@ -5,13 +5,18 @@
 from ._changepw import PasswordChangeFormPage
 from ._dits import DirectoryInformationTree, EDRNDirectoryInformationTree
 from ._forgotten import ForgottenDetailsFormPage
+from ._metadata import AccountMetadata
+from ._mirror import DirectoryEntry, DirectorySyncState
 from ._settings import EmailSettings, PasswordSettings
 from ._signup import NameRequestFormPage
 from ._users import PendingUser
 
 
 __all__ = (
+    AccountMetadata,
+    DirectoryEntry,
     DirectoryInformationTree,
+    DirectorySyncState,
     EDRNDirectoryInformationTree,
     EmailSettings,
     ForgottenDetailsFormPage,
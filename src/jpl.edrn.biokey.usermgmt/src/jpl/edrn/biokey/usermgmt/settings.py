@@ -25,6 +25,7 @@ MIGRATION_MODULES = {
 # 🔗 https://docs.djangoproject.com/en/dev/ref/settings/#installed-apps
 
 INSTALLED_APPS = [
+    'django.contrib.postgres',  # Trigram lookups for the directory mirror's name index
     'wagtailcaptcha',
     'captcha',
 ]
@@ -2,14 +2,154 @@
 
 '''🧬🔑🕴️ BioKey user management: asynchronous tasks.'''
 
+from ._submissions import CREATED, claim, fail, finish, release, submission_status
 from celery import shared_task
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
 from django.core.mail.message import EmailMessage
-import logging, time, base64
+import logging, math, smtplib, threading, time, base64
 
 
 _logger = logging.getLogger(__name__)
 
 
+# Mail Connection
+# ---------------
+#
+# Opening an SMTP connection takes a TCP handshake, STARTTLS, and a login before the first
+# message can go, and the worker used to pay for all that with every message. Now each worker
+# process keeps one connection open and sends every message over it. A connection that's been
+# idle a few seconds gets a NOOP to check it's still there before we use it, one that's been
+# idle `BIOKEY_SMTP_IDLE_TIMEOUT` seconds (by which time the server may well have dropped it)
+# gets replaced, and if the server hangs up on us mid-send, we reconnect and try once more.
+#
+# Messages that arrive close together go out together. Whoever gets the connection first sends
+# every message queued by then, up to `BIOKEY_SMTP_BATCH_SIZE` of them, in one batch, after
+# waiting `BIOKEY_SMTP_BATCH_WINDOW` seconds for more to arrive; everyone else just waits for
+# their message to go. With a window of 0, nobody waits any longer than they would have, and
+# batches form only from messages that queued while the connection was busy.
+
+_default_smtp_idle_timeout = 30.0  # seconds
+_default_smtp_batch_size   = 50
+_default_smtp_batch_window = 0.0   # seconds
+_smtp_check_after          = 5.0   # seconds idle before checking the connection with NOOP
+
+# What a dropped connection looks like; other errors (like a refused recipient) aren't worth a retry
+_smtp_disconnected = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class _Outgoing:
+    '''A message waiting to go out in a batch, and once it's gone, how it went.'''
+    __slots__ = ('message', 'done', 'sent', 'exception')
+
+    def __init__(self, message: EmailMessage):
+        self.message, self.done, self.sent, self.exception = message, threading.Event(), 0, None
+
+
+class _MailConnection:
+    '''The mail connection of this worker process.'''
+
+    def __init__(self):
+        self.backend, self.last_used, self.lock = None, 0.0, threading.Lock()
+        self.queue, self.queue_lock = [], threading.Lock()
+
+    def _healthy(self, idle_timeout: float) -> bool:
+        idle = time.monotonic() - self.last_used
+        if idle >= idle_timeout: return False
+        if idle < _smtp_check_after: return True
+        smtp = getattr(self.backend, 'connection', None)
+        if smtp is None or not hasattr(smtp, 'noop'): return True  # Not SMTP, so nothing to check
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _close(self):
+        try:
+            self.backend.close()
+        except Exception as ex:
+            _logger.info('Ignoring %r while closing the mail connection', ex)
+        self.backend = None
+
+    def close(self):
+        with self.lock:
+            if self.backend is not None: self._close()
+
+    def _send_messages(self, messages: list[EmailMessage]) -> int:
+        for attempt in range(2):
+            if self.backend is None:
+                backend = get_connection(fail_silently=False)
+                backend.open()
+                self.backend = backend
+            try:
+                sent = self.backend.send_messages(messages)
+                self.last_used = time.monotonic()
+                return sent
+            except _smtp_disconnected as ex:
+                self._close()
+                if attempt > 0: raise
+                _logger.info('Mail connection dropped with %r; reconnecting', ex)
+
+    def _flush(self, batch: list[_Outgoing]):
+        '''Send the `batch` of messages, noting how each one went.'''
+        try:
+            self._send_messages([i.message for i in batch])
+            for i in batch:
+                i.sent = 1
+        except Exception as ex:
+            if len(batch) == 1:
+                batch[0].exception = ex
+            else:
+                # One bad message spoils the batch, so send each on its own to see whose it was
+                _logger.info('Batch of %d messages failed with %r; sending them one at a time', len(batch), ex)
+                for i in batch:
+                    try:
+                        i.sent = self._send_messages([i.message])
+                    except Exception as ex:
+                        i.exception = ex
+        finally:
+            for i in batch:
+                i.done.set()
+
+    def send(self, message: EmailMessage) -> int:
+        idle_timeout = getattr(settings, 'BIOKEY_SMTP_IDLE_TIMEOUT', _default_smtp_idle_timeout)
+        if idle_timeout <= 0: return message.send()
+        outgoing = _Outgoing(message)
+        with self.queue_lock:
+            self.queue.append(outgoing)
+        with self.lock:
+            window = getattr(settings, 'BIOKEY_SMTP_BATCH_WINDOW', _default_smtp_batch_window)
+            if window > 0 and not outgoing.done.is_set(): time.sleep(window)
+            size = getattr(settings, 'BIOKEY_SMTP_BATCH_SIZE', _default_smtp_batch_size)
+            # Everything queued ahead of ours goes first, so keep sending batches until ours is gone
+            while not outgoing.done.is_set():
+                with self.queue_lock:
+                    batch, self.queue = self.queue[:size], self.queue[size:]
+                if self.backend is not None and not self._healthy(idle_timeout):
+                    _logger.info('Mail connection is stale; replacing it')
+                    self._close()
+                if len(batch) > 1: _logger.info('Sending a batch of %d messages', len(batch))
+                self._flush(batch)
+        outgoing.done.wait()
+        if outgoing.exception is not None: raise outgoing.exception
+        return outgoing.sent
+
+
+_mail_connection = _MailConnection()
+
+
+def close_mail_connection():
+    '''Close this process's mail connection, if it's open; the next message will open a new one.'''
+    _mail_connection.close()
+
+
+@worker_process_shutdown.connect
+def _close_mail_connection_at_shutdown(**kwargs):
+    close_mail_connection()
+
+
 @shared_task
 def _send_email_asynchronously(from_addr, to, subject, body, attachment, delay):
     _logger.info('Sending email to "%s" from "%s" with delay %d', to, from_addr, delay)
@@ -24,7 +164,7 @@ def _send_email_asynchronously(from_addr, to, subject, body, attachment, delay):
         message = EmailMessage(subject=subject, from_email=from_addr, to=to, attachments=a, body=body)
     else:
         message = EmailMessage(subject=subject, from_email=from_addr, to=to, body=body)
-    message.send()
+    _mail_connection.send(message)
 
 
 def send_email(from_addr, to, subject, body, attachment, delay):
@@ -33,3 +173,88 @@ def send_email(from_addr, to, subject, body, attachment, delay):
             assert field in attachment
         attachment['data'] = base64.b64encode(attachment['data']).decode('utf-8')
     _send_email_asynchronously.delay(from_addr, to, subject, body, attachment, delay)
+
+
+@shared_task
+def sync_directory_mirrors():
+    '''Bring the mirror of every live DIT up to date; see `._mirror`.
+
+    Celery beat runs this every `BIOKEY_MIRROR_POLL_INTERVAL` seconds. A lock in the cache keeps
+    a slow sync of one DIT from overlapping with the next run.
+    '''
+    if not getattr(settings, 'BIOKEY_DIRECTORY_MIRROR', False): return
+    from ._dits import DirectoryInformationTree
+    from ._mirror import sync_mirror
+
+    for dit in DirectoryInformationTree.objects.live().specific():
+        lock = f'biokey:mirror-sync:{dit.pk}'
+        if not cache.add(lock, 1, getattr(settings, 'BIOKEY_MIRROR_SYNC_LOCK_TTL', 3600)):
+            _logger.info('Mirror of %s is already being synchronized; skipping', dit.slug)
+            continue
+        try:
+            sync_mirror(dit)
+        except Exception:
+            _logger.exception('Cannot synchronize the mirror of %s; lookups will use the directory', dit.slug)
+        finally:
+            cache.delete(lock)
+
+
+@shared_task(bind=True, max_retries=5)
+def sign_up(self, dit_id: int, fn: str, ln: str, phone: str, email: str, submission: str, site_id: int, base_url: str):
+    '''Create the pending account for the sign-up `submission` in the DIT `dit_id`; see `._submissions`.
+
+    Running this again for the same `submission`, once its account's made or while another
+    worker's making it, does nothing. If the directory's unavailable or too busy, which we find
+    out before anything's been done, try again once it says it'll be ready.
+    '''
+    from ._breaker import DirectoryUnavailable
+    from ._dits import DirectoryInformationTree
+    from wagtail.models import Site
+
+    status = submission_status(submission) or {}
+    if status.get('state') == CREATED: return status['account_name']
+    if not claim(submission, self.request.id or ''):
+        _logger.info('Sign-up %s is already being handled; skipping', submission)
+        return None
+    try:
+        dit = DirectoryInformationTree.objects.get(pk=dit_id).specific
+        site = Site.objects.filter(pk=site_id).first()
+        account_name = dit.create_account(fn, ln, phone, email, site=site, base_url=base_url)
+    except DirectoryUnavailable as ex:
+        release(submission)
+        if self.request.retries < self.max_retries:
+            _logger.info('Directory for sign-up %s unavailable; retrying in %.0f seconds', submission, ex.retry_after)
+            raise self.retry(exc=ex, countdown=math.ceil(ex.retry_after))
+        fail(submission)
+        raise
+    except Exception:
+        # Keep the claim: part of the account may exist, so another run mustn't make a second one
+        _logger.exception('Cannot create the account for sign-up %s', submission)
+        fail(submission)
+        raise
+    finish(submission, account_name)
+    return account_name
+
+
+@shared_task(bind=True, max_retries=5)
+def forgotten_details(self, dit_id: int, uid: str, email: str, site_id: int, base_url: str):
+    '''Email a reset link for `uid`, or reminders of the user IDs for `email`, from the DIT `dit_id`.
+
+    The forgotten details page queues this so it never waits on the directory itself. If the
+    directory's unavailable or too busy, try again once it says it'll be ready.
+    '''
+    from ._breaker import DirectoryUnavailable
+    from ._dits import DirectoryInformationTree
+    from ._forgotten import send_forgotten_details
+    from wagtail.models import Site
+
+    dit = DirectoryInformationTree.objects.filter(pk=dit_id).first()
+    if dit is None:
+        _logger.warning('DIT %s for forgotten details is gone; skipping', dit_id)
+        return
+    try:
+        site = Site.objects.filter(pk=site_id).first()
+        send_forgotten_details(dit.specific, uid, email, site=site, base_url=base_url)
+    except DirectoryUnavailable as ex:
+        _logger.info('Directory for forgotten details unavailable; retrying in %.0f seconds', ex.retry_after)
+        raise self.retry(exc=ex, countdown=math.ceil(ex.retry_after))
@@ -0,0 +1,7 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: tests.
+
+These run against the stand-in LDAP server from the policy package rather than a real
+directory, so they need no more than the site's settings: `./manage.sh test jpl.edrn.biokey.usermgmt`.
+'''
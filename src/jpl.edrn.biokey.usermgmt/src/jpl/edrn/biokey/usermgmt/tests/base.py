@@ -0,0 +1,40 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: test fixtures.'''
+
+from django.test import SimpleTestCase
+from jpl.edrn.biokey.policy.management._ldapstandin import StandInLDAPServer
+import ldap
+
+
+class StandInDirectoryTestCase(SimpleTestCase):
+    '''A test case with a stand-in LDAP server that answers after `latency` seconds.
+
+    The server holds the `users` under `base`, each with a password, and every test gets its
+    own anonymous `connection` to it.
+    '''
+    latency, base = 0.0, 'ou=users,o=test'
+    users = (('jdoe', 'John', 'Doe'), ('jroe', 'Jane', 'Roe'), ('asmith', 'Alice', 'Smith'))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = StandInLDAPServer(cls.latency)
+        cls.directory.start()
+        cls.addClassCleanup(cls.directory.stop)
+        for uid, fn, ln in cls.users:
+            cls.directory.add_entry(cls.dn(uid), {
+                'objectClass': [b'inetOrgPerson'], 'uid': [uid.encode('utf-8')], 'cn': [f'{fn} {ln}'.encode('utf-8')],
+                'sn': [ln.encode('utf-8')], 'mail': [f'{uid}@example.com'.encode('utf-8')],
+                'userPassword': [f'{{SSHA}}{uid}'.encode('utf-8')],
+            })
+
+    @classmethod
+    def dn(cls, uid: str) -> str:
+        return f'uid={uid},{cls.base}'
+
+    def setUp(self):
+        super().setUp()
+        self.connection = ldap.initialize(self.directory.uri)
+        self.connection.simple_bind_s('', '')
+        self.addCleanup(self.connection.unbind_s)
@@ -0,0 +1,46 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: tests of the LDAP utilities.'''
+
+from .._ldap import _user_dn, paged_search
+from .base import StandInDirectoryTestCase
+from django.test import SimpleTestCase, override_settings
+from types import SimpleNamespace
+import ldap, ldap.dn
+
+
+class PagedSearchTest(StandInDirectoryTestCase):
+    '''Test `paged_search` against a directory that takes a while to answer.'''
+    latency = 0.2
+
+    def _uids(self, **kw) -> list[str]:
+        results = paged_search(self.connection, self.base, ldap.SCOPE_ONELEVEL, '(uid=*)', ['uid'], **kw)
+        return sorted(attrs['uid'][0].decode('utf-8') for dn, attrs in results)
+
+    def test_no_time_limit(self):
+        '''A time limit of zero means to wait as long as it takes, not to poll and give up.'''
+        for time_limit in (0, 0.0, None):
+            with self.subTest(time_limit=time_limit), override_settings(BIOKEY_LDAP_TIME_LIMIT=time_limit):
+                self.assertEqual(self._uids(), sorted(uid for uid, fn, ln in self.users))
+
+    def test_time_limit(self):
+        '''A time limit shorter than the directory takes gives up with `ldap.TIMEOUT`.'''
+        with self.assertRaises(ldap.TIMEOUT):
+            self._uids(time_limit=0.05)
+
+    def test_size_limit(self):
+        self.assertEqual(len(self._uids(size_limit=2)), 2)
+
+
+class UserDNTest(SimpleTestCase):
+    '''Test making DNs out of uids that could have come from anyone.'''
+    dit = SimpleNamespace(user_base='ou=users,o=test')
+
+    def test_plain(self):
+        self.assertEqual(_user_dn('jdoe', self.dit), 'uid=jdoe,ou=users,o=test')
+
+    def test_escaped(self):
+        '''A uid can't add RDNs or attributes of its own to the DN.'''
+        dn = ldap.dn.str2dn(_user_dn('jdoe,ou=admins+cn=x', self.dit))
+        self.assertEqual(len(dn), 3)
+        self.assertEqual(dn[0], [('uid', 'jdoe,ou=admins+cn=x', ldap.AVA_STRING)])
@@ -0,0 +1,49 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: tests of pooled LDAP connections.'''
+
+from .._pool import Timeouts, get_pool, pooled_connection
+from .base import StandInDirectoryTestCase
+import ldap
+
+
+class PooledConnectionTest(StandInDirectoryTestCase):
+    '''Test that only connections in good shape go back in the pool.'''
+    latency = 0.2
+    bind_dn, password = 'cn=manager,o=test', 'secret'
+    timeouts = Timeouts(connect=5.0, bind=5.0, operation=0.05)
+
+    def setUp(self):
+        super().setUp()
+        self.pool = get_pool(self.directory.uri, self.bind_dn, self.password, self.timeouts)
+        self.pool.clear()
+        self.addCleanup(self.pool.clear)
+
+    def _idle(self) -> int:
+        return self.pool.statistics()['idle']
+
+    def test_reused(self):
+        with pooled_connection(self.directory.uri, self.bind_dn, self.password, self.timeouts):
+            pass
+        self.assertEqual(self._idle(), 1)
+
+    def test_other_errors(self):
+        '''Errors that have nothing to do with the connection leave it fit to reuse.'''
+        with self.assertRaises(ValueError):
+            with pooled_connection(self.directory.uri, self.bind_dn, self.password, self.timeouts):
+                raise ValueError('Not the connection')
+        self.assertEqual(self._idle(), 1)
+
+    def test_timeout(self):
+        '''A connection that times out may have an operation still outstanding, so it's closed.'''
+        with self.assertRaises(ldap.TIMEOUT):
+            with pooled_connection(self.directory.uri, self.bind_dn, self.password, self.timeouts) as connection:
+                connection.search_s(self.base, ldap.SCOPE_ONELEVEL, '(uid=*)')
+        self.assertEqual(self._idle(), 0)
+
+    def test_unavailable(self):
+        for ex in (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+            with self.subTest(ex=ex), self.assertRaises(ex):
+                with pooled_connection(self.directory.uri, self.bind_dn, self.password, self.timeouts):
+                    raise ex({'desc': 'Gone'})
+            self.assertEqual(self._idle(), 0)
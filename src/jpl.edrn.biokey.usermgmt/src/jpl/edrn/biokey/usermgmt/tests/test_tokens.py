@@ -0,0 +1,63 @@
+# encoding: utf-8
+
+'''🧬🔑🕴️ BioKey user management: tests of signed password reset tokens.'''
+
+from .._accounts import Account
+from .._ldap import _attribute_sets
+from .._tokens import _fingerprint_length, _salt, can_sign_token, fingerprint_matches, make_signed_token
+from .._tokens import password_fingerprint, verify_signed_token
+from .base import StandInDirectoryTestCase
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+import datetime, ldap
+
+
+class SignedTokenTest(StandInDirectoryTestCase):
+    '''Test that signed tokens work once and only for accounts whose passwords we can read.'''
+
+    def _account(self, uid: str, attribute_set: str = 'reset') -> Account:
+        attrlist = _attribute_sets[attribute_set]
+        return Account(self.connection.search_s(self.base, ldap.SCOPE_ONELEVEL, f'(uid={uid})', attrlist)[0])
+
+    def _expiration(self) -> datetime.datetime:
+        return timezone.now() + datetime.timedelta(hours=1)
+
+    def test_works_once(self):
+        '''Once the password changes, the token's no good.'''
+        token = make_signed_token('test', self._account('jdoe'), self._expiration())
+        fingerprint = verify_signed_token(token, 'test', 'jdoe')
+        self.assertTrue(fingerprint_matches(self._account('jdoe'), fingerprint))
+        self.connection.modify_s(self.dn('jdoe'), [(ldap.MOD_REPLACE, 'userPassword', [b'{SSHA}changed'])])
+        self.assertFalse(fingerprint_matches(self._account('jdoe'), fingerprint))
+
+    def test_wrong_account(self):
+        token = make_signed_token('test', self._account('jdoe'), self._expiration())
+        with self.assertRaises(ValueError):
+            verify_signed_token(token, 'test', 'jroe')
+        with self.assertRaises(ValueError):
+            verify_signed_token(token, 'other', 'jdoe')
+
+    def test_expired(self):
+        token = make_signed_token('test', self._account('jdoe'), timezone.now() - datetime.timedelta(seconds=1))
+        with self.assertRaises(ValueError):
+            verify_signed_token(token, 'test', 'jdoe')
+
+    def test_no_password_no_token(self):
+        '''An account read without its `userPassword` can't have a signed token.'''
+        account = self._account('jroe', 'account')
+        self.assertFalse(can_sign_token(account))
+        with self.assertRaises(ValueError):
+            password_fingerprint(account)
+        with self.assertRaises(ValueError):
+            make_signed_token('test', account, self._expiration())
+
+    def test_no_password_no_replay(self):
+        '''A token fingerprinting no password at all isn't accepted for an account whose password we can't read.
+
+        Such a fingerprint never changes, so the token would otherwise work again and again until it expired.
+        '''
+        account = self._account('jroe', 'account')
+        empty = salted_hmac(_salt + '.fingerprint', b'').hexdigest()[:_fingerprint_length]
+        for fingerprint in (empty, ''):
+            with self.subTest(fingerprint=fingerprint):
+                self.assertFalse(fingerprint_matches(account, fingerprint))
@@ -3,11 +3,21 @@
 '''🧬🔑🕴️ BioKey user management: URL patterns.'''
 
 
-from .views import reset_password, reset_password_form
+from .views import reset_password, reset_password_form, signup_status
+from .views import reset_password_by_interface, reset_password_form_by_interface
+from django.conf import settings
 from django.urls import path
 
 
+# With `BIOKEY_ASYNC_LDAP` on, use the asynchronous views for requests that come in over ASGI
+if getattr(settings, 'BIOKEY_ASYNC_LDAP', False):
+    _reset_password, _reset_password_form = reset_password_by_interface, reset_password_form_by_interface
+else:
+    _reset_password, _reset_password_form = reset_password, reset_password_form
+
+
 urlpatterns = [
-    path('pwreset/<slug:consortium>/<str:uid>/', reset_password, name='pwreset'),
-    path('pwreset/<slug:consortium>/<str:uid>/<str:token>', reset_password_form, name='pwreset_token'),
+    path('pwreset/<slug:consortium>/<str:uid>/', _reset_password, name='pwreset'),
+    path('pwreset/<slug:consortium>/<str:uid>/<str:token>', _reset_password_form, name='pwreset_token'),
+    path('signup-status/<str:submission>', signup_status, name='signup_status'),
 ]
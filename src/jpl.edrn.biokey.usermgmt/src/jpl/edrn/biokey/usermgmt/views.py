@@ -3,34 +3,56 @@
 '''🧬🔑🕴️ BioKey user management: views.'''
 
 from . import PACKAGE_NAME
+from ._aldap import aget_account_by_uid, areset_password_in_dit
 from ._forgotten import ResetForgottenPasswordForm
 from ._ldap import get_account_by_uid, reset_password_in_dit
+from ._metadata import aaccount_biokey, account_biokey
+from ._submissions import is_submission, submission_status
 from ._theme import bootstrap_form_widgets
+from ._tokens import fingerprint_matches, is_signed_token, verify_signed_token
 from .constants import GENERIC_FORM_TEMPLATE
 from .models import DirectoryInformationTree
+from asgiref.sync import sync_to_async
 from django.http import HttpRequest, HttpResponse, HttpResponseNotFound, HttpResponseServerError, HttpResponseBadRequest
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse
 from django.shortcuts import render
 from django.utils import timezone
-import logging, datetime
+import functools, logging, datetime
 
 
 _logger = logging.getLogger(__name__)
 
 
-def _check(consortium, uid, token) -> HttpResponse | None:
-    '''Check the password reset parameters and see if they're valid.
+def _check_signature(consortium, uid, token) -> tuple[HttpResponse | None, str | None]:
+    '''Check a signed password reset `token` on its own, without asking the directory.
 
-    Returns a `HttpResponse` in case they're invalid, or `None` if they're all OK.
+    Returns a `HttpResponse` in case it's invalid, else `None`, plus the token's password
+    fingerprint. Classic tokens pass through with no fingerprint.
+    '''
+    if not is_signed_token(token): return None, None
+    try:
+        return None, verify_signed_token(token, consortium, uid)
+    except ValueError as ex:
+        _logger.warning('reset_password _check: signed token for %s in %s rejected: %s', uid, consortium, ex)
+        return HttpResponseBadRequest(reason=str(ex)), None
+
+
+def _check_account(
+    account, biokey: dict, consortium, uid, token, fingerprint: str | None = None
+) -> HttpResponse | None:
+    '''Check the password reset `token` against the `account` for `uid` we found in `consortium`.
+
+    The `biokey` has BioKey's metadata on the account. For signed tokens, `fingerprint` is the one
+    the token carries. Returns a `HttpResponse` in case they're invalid, or `None` if they're all OK.
     '''
-    dit = DirectoryInformationTree.objects.filter(slug=consortium).first()
-    if not dit:
-        _logger.warning('reset_password _check: consortium «%s» not found', consortium)
-        return HttpResponseNotFound(reason='Consortium unknown')
-    account = get_account_by_uid(uid, dit)
     if not account:
         _logger.warning('reset_password _check: account «%s» not found', uid)
         return HttpResponseNotFound(reason='User unknown')
-    biokey = account.get('biokey')
+    if fingerprint is not None:
+        if fingerprint_matches(account, fingerprint): return None
+        _logger.warning('reset_password _check: signed token for %s in %s already used', uid, consortium)
+        return HttpResponseBadRequest(reason='Token already used')
     if not biokey:
         _logger.warning('reset_password _check: no biokey for account «%s» in consortium «%s»', uid, consortium)
         return HttpResponseServerError(reason='No biokey')
@@ -50,6 +72,36 @@ def _check(consortium, uid, token) -> HttpResponse | None:
         return HttpResponseBadRequest(reason='Token mismatch')
 
 
+def _check(consortium, uid, token) -> HttpResponse | None:
+    '''Check the password reset parameters and see if they're valid.
+
+    Returns a `HttpResponse` in case they're invalid, or `None` if they're all OK. Bad signed
+    tokens are turned away before we look anything up.
+    '''
+    response, fingerprint = _check_signature(consortium, uid, token)
+    if response: return response
+    dit = DirectoryInformationTree.objects.filter(slug=consortium).first()
+    if not dit:
+        _logger.warning('reset_password _check: consortium «%s» not found', consortium)
+        return HttpResponseNotFound(reason='Consortium unknown')
+    account = get_account_by_uid(uid, dit, 'reset')
+    biokey = account_biokey(dit, account) if account else {}
+    return _check_account(account, biokey, consortium, uid, token, fingerprint)
+
+
+async def _acheck(consortium, uid, token) -> HttpResponse | None:
+    '''Asynchronously check the password reset parameters; see `_check`.'''
+    response, fingerprint = _check_signature(consortium, uid, token)
+    if response: return response
+    dit = await DirectoryInformationTree.objects.filter(slug=consortium).afirst()
+    if not dit:
+        _logger.warning('reset_password _check: consortium «%s» not found', consortium)
+        return HttpResponseNotFound(reason='Consortium unknown')
+    account = await aget_account_by_uid(uid, dit, 'reset')
+    biokey = await aaccount_biokey(dit, account) if account else {}
+    return _check_account(account, biokey, consortium, uid, token, fingerprint)
+
+
 def reset_password_form(request: HttpRequest, consortium: str, uid: str, token: str) -> HttpResponse:
     if request.method == 'GET':
         potential_response = _check(consortium, uid, token)
@@ -66,6 +118,9 @@ def reset_password(request: HttpRequest, consortium: str, uid: str) -> HttpRespo
     if request.method == 'POST':
         form = ResetForgottenPasswordForm(request.POST)
         if form.is_valid():
+            # The token gets the same checks here as it did for the form, or anyone could set the password
+            potential_response = _check(consortium, uid, form.cleaned_data['token'])
+            if potential_response: return potential_response
             dit = DirectoryInformationTree.objects.filter(slug=consortium).first()
             if not dit:
                 _logger.warning('reset_password: consortium %s not found', consortium)
@@ -82,3 +137,72 @@ def reset_password(request: HttpRequest, consortium: str, uid: str) -> HttpRespo
             return render(request, GENERIC_FORM_TEMPLATE, {'form': form, 'title': title})
     else:
         return HttpResponseBadRequest(reason='not POST')
+
+
+def signup_status(request: HttpRequest, submission: str) -> JsonResponse:
+    '''Tell how the background sign-up `submission` is going, for the "account created" page to poll.
+
+    This is just a look in the cache, so it's cheap enough to ask every couple of seconds.
+    '''
+    status = submission_status(submission) if is_submission(submission) else None
+    response = JsonResponse(status or {'state': 'unknown'}, status=200 if status else 404)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+# Asynchronous versions of the views above. These wait on the directory without tying up
+# a thread, so they're the ones to use when serving with ASGI. Rendering templates can touch
+# the database (for site settings, for example), so that still happens in a thread.
+
+async def areset_password_form(request: HttpRequest, consortium: str, uid: str, token: str) -> HttpResponse:
+    if request.method == 'GET':
+        potential_response = await _acheck(consortium, uid, token)
+        if potential_response: return potential_response
+        form = ResetForgottenPasswordForm(initial={'token': token})
+        bootstrap_form_widgets(form)
+        title = f'Reset {consortium.upper()} Password'
+        return await sync_to_async(render)(request, GENERIC_FORM_TEMPLATE, {'form': form, 'title': title})
+    else:
+        return HttpResponseBadRequest(reason='GET only')
+
+
+async def areset_password(request: HttpRequest, consortium: str, uid: str) -> HttpResponse:
+    if request.method == 'POST':
+        form = ResetForgottenPasswordForm(request.POST)
+        if form.is_valid():
+            potential_response = await _acheck(consortium, uid, form.cleaned_data['token'])
+            if potential_response: return potential_response
+            dit = await DirectoryInformationTree.objects.filter(slug=consortium).afirst()
+            if not dit:
+                _logger.warning('reset_password: consortium %s not found', consortium)
+                return HttpResponseNotFound(reason='consortium not found')
+            await areset_password_in_dit(dit, uid, form.cleaned_data['new_password'])
+            pending = await dit.pending_users.filter(uid=uid).aexists()
+            return await sync_to_async(render)(
+                request, PACKAGE_NAME + '/password-reset-success.html',
+                {'uid': uid, 'consortium': consortium.upper(), 'pending': pending}
+            )
+        else:
+            bootstrap_form_widgets(form)
+            title = f'Reset {consortium.upper()} Password'
+            return await sync_to_async(render)(request, GENERIC_FORM_TEMPLATE, {'form': form, 'title': title})
+    else:
+        return HttpResponseBadRequest(reason='not POST')
+
+
+def _by_interface(view, aview):
+    '''Make a view that runs `aview` for requests that came in over ASGI and `view` for the rest.
+
+    The asynchronous views keep a directory connection for each event loop. Under ASGI that's
+    the server's loop, which lasts; under WSGI, Django makes a new loop for every request to an
+    asynchronous view, so the synchronous view, with its pooled connections, gets the request.
+    '''
+    @functools.wraps(aview)
+    async def dispatch(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        if isinstance(request, ASGIRequest): return await aview(request, *args, **kwargs)
+        return await sync_to_async(view)(request, *args, **kwargs)
+    return dispatch
+
+
+reset_password_form_by_interface = _by_interface(reset_password_form, areset_password_form)
+reset_password_by_interface = _by_interface(reset_password, areset_password)